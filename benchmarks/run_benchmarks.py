@@ -0,0 +1,325 @@
+"""
+Benchmarks of the host-side kernels of brainseg on synthetic phantoms (see
+brainseg.phantoms), without any container. Every kernel runs in a fresh process,
+which records the best wall time of a few repeats and the peak memory the
+kernel adds to the process. The results are compared against stored
+baselines; the script exits with status 1 if a kernel got slower or needs
+more memory than its baseline allows.
+
+    python benchmarks/run_benchmarks.py                      # 1 and 0.5 mm
+    python benchmarks/run_benchmarks.py --resolutions 1 0.5 0.3
+    python benchmarks/run_benchmarks.py --update-baseline    # after intended changes
+
+Timings depend on the machine, so the baselines are stored per CPU count and
+only compared on a machine with as many CPUs as the one that recorded them.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+BASELINE_PATH = Path(__file__).with_name("baselines.json")
+DEFAULT_RESOLUTIONS = [1.0, 0.5]
+# A kernel regresses if it needs more than tolerance * baseline plus the slack
+TIME_TOLERANCE = 1.5
+MEMORY_TOLERANCE = 1.2
+TIME_SLACK_SECONDS = 0.05
+MEMORY_SLACK_MB = 16
+# Import time budget of the CLI entry point (see brainseg.clients.runner)
+CLI_IMPORT_BUDGET_SECONDS = 0.2
+CLI_HEAVY_MODULES = ["numpy", "nibabel", "fastremap", "ants", "skimage", "nbmorph"]
+
+
+def _load_label_map(paths, out_dir, voxel_size):
+    from brainseg.remap import load_label_map, schema_path
+    return lambda: load_label_map(schema_path("freesurfer-full"))
+
+
+def _remap(paths, out_dir, voxel_size):
+    import nibabel as nib
+    from brainseg.remap import load_label_map, remap, schema_path
+    old, new = (load_label_map(schema_path(s)) for s in ["freesurfer", "freesurfer-reduced"])
+    return lambda: remap(nib.load(paths["labels"]), old, new)
+
+
+def _is_skull_stripped(paths, out_dir, voxel_size):
+    from brainseg.utils import is_skull_stripped
+
+    def run():
+        # The volume estimate is memoized per file, start from an empty cache
+        os.environ["BRAINSEG_CACHE_DIR"] = tempfile.mkdtemp(dir=out_dir)
+        return is_skull_stripped(paths["t1_head"])
+    return run
+
+
+def _apply_brain_mask(paths, out_dir, voxel_size):
+    from brainseg.utils import apply_brain_mask
+    return lambda: apply_brain_mask(paths["t1_head"], paths["brain_mask"],
+                                    out_dir / "t1_masked.nii.gz")
+
+
+def _extract_csf_mask(paths, out_dir, voxel_size):
+    from brainseg.clients import extract_csf_mask
+    return lambda: extract_csf_mask(paths["t2_stripped"], out_dir / "csf_mask.nii.gz")
+
+
+def _extract_csf_mask_reference(paths, out_dir, voxel_size):
+    # The skimage implementation that the fast path must match (see tests/test_csf_mask.py)
+    import skimage  # noqa: F401
+    from brainseg.clients import extract_csf_mask
+    return lambda: extract_csf_mask(paths["t2_stripped"], out_dir / "csf_mask.nii.gz", fast=False)
+
+
+def _merge_csf_and_anatomy(paths, out_dir, voxel_size):
+    from brainseg.clients import merge_csf_and_anatomy
+    return lambda: merge_csf_and_anatomy(paths["labels"], paths["csf_mask"],
+                                         out_dir / "merged.nii.gz")
+
+
+def _resample_image(paths, out_dir, voxel_size):
+    from brainseg.clients.resample import resample_image
+    # Downsampling by 2, e.g. a 0.5 mm scan conformed to 1 mm
+    return lambda: resample_image(paths["t1_stripped"], out_dir / "resampled.nii.gz",
+                                  2 * voxel_size)
+
+
+def _gouhfi_parcellation_merge(paths, out_dir, voxel_size):
+    import nbmorph  # noqa: F401 (optional dependency of the parcellation merge)
+    from brainseg.tools.gouhfi import postprocess_gouhfi
+    return lambda: postprocess_gouhfi(paths["gouhfi_seg"], out_dir / "gouhfi.nii.gz",
+                                      parc_path=paths["gouhfi_parc"])
+
+
+# Kernels by name: a setup function returning the call to time. Kernels that
+# don't depend on the phantom only run once, at the first resolution.
+KERNELS = {
+    "load_label_map": (_load_label_map, False),
+    "remap": (_remap, True),
+    "is_skull_stripped": (_is_skull_stripped, True),
+    "apply_brain_mask": (_apply_brain_mask, True),
+    "extract_csf_mask": (_extract_csf_mask, True),
+    "extract_csf_mask_reference": (_extract_csf_mask_reference, True),
+    "merge_csf_and_anatomy": (_merge_csf_and_anatomy, True),
+    "resample_image": (_resample_image, True),
+    "gouhfi_parcellation_merge": (_gouhfi_parcellation_merge, True),
+}
+
+
+def _status_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of this process to its current RSS (Linux) and returns
+    the current RSS in MB, or None if the peak can't be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _status_mb("VmRSS")
+    except OSError:
+        return None
+
+
+def _measure(kernel, paths, out_dir, voxel_size, repeat, verbose):
+    """Runs a kernel `repeat` times in this (fresh) process and returns its costs."""
+    setup, _ = KERNELS[kernel]
+    out_dir = Path(out_dir)
+    try:
+        run = setup(paths, out_dir, voxel_size)
+    except ImportError as e:
+        return {"skipped": f"missing dependency {e.name}"}
+
+    # The peak memory of the kernel is measured on top of the memory after
+    # imports and setup. Without a resettable peak, ru_maxrss (in kilobytes on
+    # Linux) is used, which hides kernels that stay below the import peak.
+    rss_before = _reset_peak_rss()
+    maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    if rss_before is not None:
+        peak_mb = _status_mb("VmHWM") - rss_before
+    else:
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss_before) / 1024
+    return {"seconds": min(times), "peak_mb": peak_mb}
+
+
+def measure_cli_import():
+    """Import time of the CLI entry point in a fresh interpreter and heavy modules it loads."""
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import brainseg.clients.runner\n"
+        "seconds = time.perf_counter() - start\n"
+        f"print(json.dumps([seconds, [m for m in {CLI_HEAVY_MODULES!r} if m in sys.modules]]))\n"
+    )
+    runs = [json.loads(subprocess.run([sys.executable, "-c", code], check=True,
+                                      capture_output=True, text=True).stdout)
+            for _ in range(5)]
+    return min(seconds for seconds, _ in runs), runs[0][1]
+
+
+def run_benchmarks(resolutions, kernels, repeat=3, data_dir=None, verbose=False):
+    """
+    Generates the phantoms and measures every kernel at every resolution, each
+    in a fresh process. Returns {"<voxel size>mm/<kernel>": {"seconds", "peak_mb"}}.
+    """
+    from brainseg.phantoms import make_phantom
+
+    results = {}
+    seconds, heavy = measure_cli_import()
+    results["cli_import"] = {"seconds": seconds, "heavy_modules": heavy}
+    print(f"{'cli_import':<36} {seconds:9.3f} s")
+
+    with tempfile.TemporaryDirectory(prefix="brainseg_bench_") as tmp_dir:
+        data_dir = Path(data_dir or tmp_dir)
+        cache_dir = Path(tmp_dir) / "cache"
+        os.environ["BRAINSEG_CACHE_DIR"] = str(cache_dir)
+        for i, voxel_size in enumerate(resolutions):
+            phantom_dir = data_dir / f"phantom_{voxel_size}mm"
+            print(f"Generating {voxel_size} mm phantom in {phantom_dir}...")
+            paths = make_phantom(phantom_dir, voxel_size)
+            for kernel in kernels:
+                if not KERNELS[kernel][1] and i > 0:
+                    continue
+                name = f"{voxel_size}mm/{kernel}" if KERNELS[kernel][1] else kernel
+                out_dir = Path(tempfile.mkdtemp(dir=tmp_dir))
+                # A fresh process per kernel, so that its peak memory is its own
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_measure, kernel, paths, out_dir, voxel_size,
+                                             repeat, verbose).result()
+                results[name] = result
+                if "skipped" in result:
+                    print(f"{name:<36} skipped ({result['skipped']})")
+                else:
+                    print(f"{name:<36} {result['seconds']:9.3f} s {result['peak_mb']:9.1f} MB")
+    return results
+
+
+def compare(results, baselines, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """Returns the regressions of `results` against `baselines` as messages."""
+    regressions = []
+    cli = results.get("cli_import")
+    if cli is not None:
+        if cli["heavy_modules"]:
+            regressions.append(f"cli_import: imports {', '.join(cli['heavy_modules'])} at startup")
+        if cli["seconds"] > CLI_IMPORT_BUDGET_SECONDS:
+            regressions.append(f"cli_import: {cli['seconds']:.3f} s exceeds the budget of "
+                               f"{CLI_IMPORT_BUDGET_SECONDS} s")
+
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None or "seconds" not in result:
+            continue
+        limit = baseline["seconds"] * time_tolerance + TIME_SLACK_SECONDS
+        if result["seconds"] > limit:
+            regressions.append(f"{name}: {result['seconds']:.3f} s "
+                               f"(baseline {baseline['seconds']:.3f} s)")
+        if "peak_mb" in baseline:
+            limit = baseline["peak_mb"] * memory_tolerance + MEMORY_SLACK_MB
+            if result["peak_mb"] > limit:
+                regressions.append(f"{name}: {result['peak_mb']:.1f} MB "
+                                   f"(baseline {baseline['peak_mb']:.1f} MB)")
+    return regressions
+
+
+def machine():
+    return {"platform": platform.platform(), "python": platform.python_version(),
+            "cpus": os.cpu_count()}
+
+
+def load_baselines(path, cpus=None):
+    """
+    Baselines recorded with `cpus` CPUs (default: as many as this machine has)
+    and the machine that recorded them, or ({}, None) if there are none.
+    """
+    stored = json.loads(path.read_text()) if path.exists() else {}
+    entry = stored.get("cpus", {}).get(str(cpus or os.cpu_count()), {})
+    return entry.get("baselines", {}), entry.get("machine")
+
+
+def update_baselines(path, results):
+    """Stores `results` as the baselines for the CPU count of this machine."""
+    stored = json.loads(path.read_text()) if path.exists() else {}
+    entry = stored.setdefault("cpus", {}).setdefault(str(os.cpu_count()), {})
+    entry.setdefault("baselines", {}).update(
+        {name: {k: round(v, 4) for k, v in result.items() if k in ["seconds", "peak_mb"]}
+         for name, result in results.items() if "seconds" in result})
+    entry["machine"] = machine()
+    path.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the host-side kernels of brainseg "
+                                     "on synthetic phantoms and compare against baselines.")
+    parser.add_argument("--resolutions", type=float, nargs="+", default=DEFAULT_RESOLUTIONS,
+                        help="Voxel sizes of the phantoms in mm (default: 1 0.5; "
+                        "0.3 needs several GB of memory)")
+    parser.add_argument("--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS),
+                        help="Kernels to benchmark (default: all)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per kernel, the fastest one is reported (default: 3)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH,
+                        help=f"Baseline file (default: {BASELINE_PATH.name} next to this script)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the results as the new baselines instead of comparing")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE,
+                        help=f"Allowed slowdown factor (default: {TIME_TOLERANCE})")
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE,
+                        help=f"Allowed peak memory factor (default: {MEMORY_TOLERANCE})")
+    parser.add_argument("--data-dir", type=Path,
+                        help="Keep the phantoms in this directory (default: a temporary one)")
+    parser.add_argument("--output", type=Path, help="Also write the results as JSON to this path")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show the output of the kernels")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.resolutions, args.kernels, repeat=args.repeat,
+                             data_dir=args.data_dir, verbose=args.verbose)
+    if args.output:
+        args.output.write_text(json.dumps({"machine": machine(), "results": results}, indent=2))
+
+    if args.update_baseline:
+        update_baselines(args.baseline, results)
+        print(f"Updated the baselines for {os.cpu_count()} CPUs in {args.baseline}")
+        return
+
+    baselines, recorded_on = load_baselines(args.baseline)
+    if not baselines:
+        # Only the import checks of the CLI apply
+        print(f"No baselines for {os.cpu_count()} CPUs in {args.baseline}, skipping the kernel "
+              "comparison. Run with --update-baseline to record them.")
+    elif recorded_on != machine():
+        print(f"Note: baselines were recorded on {recorded_on}, timings may not compare.")
+    regressions = compare(results, baselines, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print("Performance regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No performance regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+End-to-end throughput of the batch orchestration (single container
+invocation, parallel subjects, warm instances) on the stand-in container
+runtime (see brainseg.standin), so no containers, GPUs or network are needed.
+The subjects are copies of a synthetic phantom, and the stand-in emulates the
+tool runtime with a fixed latency per container start and per subject.
+
+    python benchmarks/run_throughput.py --tool gouhfi --subjects 8 --latency 5 --subject-latency 2
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MODES = {
+    "batch": [],
+    "parallel": ["--parallel"],
+    "parallel-warm": ["--parallel", "--warm"],
+}
+# Tools that run a whole batch in a single container invocation
+BATCH_TOOLS = ["synthseg", "gouhfi"]
+
+
+def brainseg(args, env):
+    """Runs the brainseg CLI in a fresh process and returns its wall time."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "brainseg.clients.runner", *args],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batch throughput of brainseg "
+                                     "on the stand-in container runtime.")
+    parser.add_argument("--tool", default="gouhfi",
+                        choices=["synthseg", "gouhfi", "fastsurfer", "simnibs", "synthstrip"],
+                        help="Tool to emulate (default: gouhfi)")
+    parser.add_argument("--subjects", type=int, default=8, help="Number of subjects (default: 8)")
+    parser.add_argument("--voxel-size", type=float, default=1.0,
+                        help="Voxel size of the phantom subjects in mm (default: 1)")
+    parser.add_argument("--latency", type=float, default=5.0,
+                        help="Emulated seconds per container start (default: 5)")
+    parser.add_argument("--subject-latency", type=float, default=2.0,
+                        help="Emulated seconds per subject (default: 2)")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES),
+                        help="Batch modes to compare (default: all)")
+    parser.add_argument("--jobs", type=int, help="Concurrent subjects of the parallel modes")
+    parser.add_argument("--report", type=Path,
+                        help="Write the run reports of every mode to <dir>/<mode>")
+    args = parser.parse_args()
+
+    from brainseg.phantoms import make_phantom
+
+    env = dict(os.environ, BRAINSEG_RUNTIME="standin",
+               BRAINSEG_STANDIN_LATENCY=str(args.latency),
+               BRAINSEG_STANDIN_SUBJECT_LATENCY=str(args.subject_latency))
+
+    with tempfile.TemporaryDirectory(prefix="brainseg_throughput_") as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        print(f"Generating {args.subjects} subjects ({args.voxel_size} mm phantoms)...")
+        paths = make_phantom(tmp_dir / "phantom", args.voxel_size)
+        input_dir = tmp_dir / "inputs"
+        input_dir.mkdir()
+        for i in range(args.subjects):
+            shutil.copyfile(paths["t1_head"], input_dir / f"sub-{i:03d}_T1w.nii.gz")
+
+        # The stand-in image is built once, outside the timed runs
+        image_env = dict(env, BRAINSEG_CACHE_DIR=str(tmp_dir / "images"),
+                         BRAINSEG_STANDIN_LATENCY="0")
+        brainseg(["pull", args.tool], image_env)
+        container = next((tmp_dir / "images" / "standin_containers").iterdir())
+
+        print(f"{'mode':<16} {'seconds':>9} {'subjects/min':>13}")
+        for mode in args.modes:
+            if mode == "batch" and args.tool not in BATCH_TOOLS:
+                print(f"{mode:<16} {'-':>9} {'-':>13}  (no batch mode for {args.tool})")
+                continue
+            cmd = ["batch", "-t", args.tool, "-i", str(input_dir), "-o", str(tmp_dir / mode),
+                   "--container", str(container), *MODES[mode]]
+            if args.jobs and mode != "batch":
+                cmd += ["--jobs", str(args.jobs)]
+            if args.report:
+                cmd += ["--report", str(args.report / mode)]
+            # A fresh cache per mode, so that no mode reuses memoized checks of another
+            seconds = brainseg(cmd, dict(env, BRAINSEG_CACHE_DIR=str(tmp_dir / f"cache_{mode}")))
+            print(f"{mode:<16} {seconds:9.1f} {args.subjects / seconds * 60:13.1f}")
+
+
+if __name__ == "__main__":
+    main()
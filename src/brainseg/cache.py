@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+# Entries are stored as <cache_dir>/results/<key>/{<i>_<output name>..., meta.json},
+# with the names of the stored outputs in meta.json. Memoized digests are stored
+# in <cache_dir>/digests/<kind>/<stat key> and expire after DIGEST_MAX_AGE_DAYS unused.
+DEFAULT_MAX_SIZE_GB = 50
+DIGEST_MAX_AGE_DAYS = 30
+# Version of the cache entries, to be increased whenever their layout changes
+CACHE_FORMAT = 2
+
+
+def cache_dir():
+    """Root of the persistent cache ($BRAINSEG_CACHE_DIR or ~/.brainseg_cache)."""
+    env_cache_dir = os.environ.get("BRAINSEG_CACHE_DIR")
+    if env_cache_dir:
+        return Path(env_cache_dir)
+    return Path.home() / ".brainseg_cache"
+
+
+def max_cache_size():
+    """Size limit of the result cache in bytes ($BRAINSEG_CACHE_MAX_GB, default 50)."""
+    return float(os.environ.get("BRAINSEG_CACHE_MAX_GB", DEFAULT_MAX_SIZE_GB)) * 1024**3
+
+
+def _atomic_write_text(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def memoized(kind, path, compute):
+    """
+    Returns compute(path) (a string, e.g. a digest), memoized on disk and keyed
+    by the path, size and modification time of the file, so unchanged inputs
+    are only read once. The modification time of a memo is its last use, see
+    prune_digests().
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    stat_key = hashlib.sha1(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+    memo_path = cache_dir() / "digests" / kind / stat_key
+    try:
+        digest = memo_path.read_text().strip()
+        os.utime(memo_path)
+        return digest
+    except FileNotFoundError:
+        pass
+    digest = compute(path)
+    _atomic_write_text(memo_path, digest)
+    return digest
+
+
+def file_digest(path):
+    """sha256 of the raw file contents (used for container images)."""
+    def compute(path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024**2), b""):
+                h.update(block)
+        return h.hexdigest()
+    return memoized("file", path, compute)
+
+
+def image_digest(path):
+    """
+    sha256 of the voxel data, shape, dtype and affine of a NIfTI image.
+    Unlike a file hash, it doesn't change if the same image is saved again
+    with a different compression. The data is hashed slab by slab.
+    """
+    def compute(path):
+        import nibabel as nib
+        import numpy as np
+
+        img = nib.load(path)
+        h = hashlib.sha256()
+        h.update(repr((img.shape, str(img.get_data_dtype()))).encode())
+        h.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+        n_slices = img.shape[2] if len(img.shape) > 2 else 1
+        slab = 16
+        for z in range(0, n_slices, slab):
+            data = img.dataobj[:, :, z:z + slab] if len(img.shape) > 2 else img.dataobj
+            data = np.asanyarray(data)
+            h.update(np.ascontiguousarray(data).tobytes())
+        return h.hexdigest()
+    return memoized("image", path, compute)
+
+
+def result_key(tool, input_paths, sif_paths, flags=None):
+    """Cache key of a tool run: input data, tool, container digests and flags."""
+    try:
+        from importlib.metadata import version
+        brainseg_version = version("brainseg-containers")
+    except Exception:
+        brainseg_version = "unknown"
+
+    key_data = {
+        "tool": tool,
+        "inputs": [image_digest(p) for p in input_paths],
+        "containers": [file_digest(p) for p in sif_paths],
+        "flags": flags or {},
+        "brainseg": brainseg_version,
+        "format": CACHE_FORMAT,
+    }
+    if os.environ.get("BRAINSEG_RUNTIME") == "standin":
+        # Results of the stand-in runtime never match runs of the real tools
+        key_data["runtime"] = "standin"
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """Hardlinks src to dst if BRAINSEG_CACHE_LINK=1 (and possible), copies otherwise."""
+    dst = Path(dst)
+    if dst.exists():
+        dst.unlink()
+    if os.environ.get("BRAINSEG_CACHE_LINK") == "1":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def _entry_dir(key):
+    return cache_dir() / "results" / key
+
+
+def lookup(key, output_paths):
+    """Restores the cached outputs of `key` to output_paths. Returns True on a hit."""
+    entry = _entry_dir(key)
+    meta_path = entry / "meta.json"
+    if not meta_path.exists():
+        return False
+    meta = json.loads(meta_path.read_text())
+    stored = [entry / name for name in meta.get("outputs", [])]
+    if len(stored) != len(output_paths) or not all(p.exists() for p in stored):
+        return False
+    for stored_path, output_path in zip(stored, output_paths):
+        _link_or_copy(stored_path, output_path)
+    meta["last_used"] = time.time()
+    meta["hits"] = meta.get("hits", 0) + 1
+    _atomic_write_text(meta_path, json.dumps(meta, indent=2))
+    return True
+
+
+def store(key, output_paths, description=""):
+    """Adds output_paths to the cache under `key` and evicts old entries if needed."""
+    entry = _entry_dir(key)
+    if entry.exists():
+        return
+    tmp_entry = entry.with_name(f".{key}.{os.getpid()}.tmp")
+    tmp_entry.mkdir(parents=True, exist_ok=True)
+    names = [f"{i}_{Path(p).name}" for i, p in enumerate(output_paths)]
+    for output_path, name in zip(output_paths, names):
+        _link_or_copy(output_path, tmp_entry / name)
+    meta = {
+        "description": description,
+        "created": time.time(),
+        "last_used": time.time(),
+        "hits": 0,
+        "outputs": names,
+        "size": sum((tmp_entry / name).stat().st_size for name in names),
+    }
+    (tmp_entry / "meta.json").write_text(json.dumps(meta, indent=2))
+    try:
+        os.replace(tmp_entry, entry)
+    except OSError:
+        # Another process stored the same result concurrently
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    prune(max_cache_size())
+
+
+def list_entries():
+    """Returns all cache entries as dicts, least recently used first."""
+    results_dir = cache_dir() / "results"
+    if not results_dir.exists():
+        return []
+    entries = []
+    for entry in results_dir.iterdir():
+        meta_path = entry / "meta.json"
+        if entry.name.startswith(".") or not meta_path.exists():
+            continue
+        meta = json.loads(meta_path.read_text())
+        meta["key"] = entry.name
+        entries.append(meta)
+    return sorted(entries, key=lambda m: m["last_used"])
+
+
+def _digest_files():
+    digests_dir = cache_dir() / "digests"
+    if not digests_dir.exists():
+        return []
+    return [p for p in digests_dir.glob("*/*") if p.is_file()]
+
+
+def prune_digests(max_age_days=DIGEST_MAX_AGE_DAYS):
+    """Removes the memoized digests that weren't used for max_age_days."""
+    cutoff = time.time() - max_age_days * 24 * 3600
+    removed = 0
+    for memo_path in _digest_files():
+        try:
+            if memo_path.stat().st_mtime < cutoff:
+                memo_path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            # Removed by a concurrent prune
+            pass
+    return removed
+
+
+def prune(max_size):
+    """
+    Evicts least recently used entries until the cache is at most max_size
+    bytes, and removes expired digests (see prune_digests).
+    """
+    prune_digests()
+    entries = list_entries()
+    total = sum(e["size"] for e in entries)
+    removed = 0
+    for e in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(_entry_dir(e["key"]), ignore_errors=True)
+        total -= e["size"]
+        removed += 1
+    return removed
+
+
+def cached_run(tool, input_paths, output_paths, sif_paths, flags, run):
+    """
+    Restores the outputs of a previous identical run from the cache, or calls
+    run() and stores its outputs. `output_paths` are all files the tool writes,
+    the main output first. A run is identical if the input voxel data, the
+    tool, the container images and the flags are the same.
+    """
+    key = result_key(tool, input_paths, sif_paths, flags)
+    if lookup(key, output_paths):
+        print(f"Cache hit: restored {tool} result for {Path(input_paths[0]).name} "
+              f"to {output_paths[0]}")
+        return
+    # Never write through a hardlink into an existing cache entry
+    for output_path in output_paths:
+        Path(output_path).unlink(missing_ok=True)
+    run()
+    store(key, output_paths, description=f"{tool} {Path(input_paths[0]).name}")
+
+
+def manage_cache(action, max_size_gb=None):
+    """Implements the 'brainseg cache' subcommand: info, list, prune or clear."""
+    entries = list_entries()
+    total = sum(e["size"] for e in entries)
+
+    if action == "info":
+        digests = _digest_files()
+        digest_size = sum(p.stat().st_size for p in digests)
+        print(f"Cache directory: {cache_dir()}")
+        print(f"Entries: {len(entries)}")
+        print(f"Size: {total / 1024**3:.2f} GB (limit {max_cache_size() / 1024**3:.2f} GB)")
+        print(f"Memoized digests: {len(digests)} ({digest_size / 1024**2:.1f} MB, "
+              f"removed after {DIGEST_MAX_AGE_DAYS} days unused)")
+    elif action == "list":
+        for e in reversed(entries):
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["last_used"]))
+            print(f"{e['key'][:12]}  {e['size'] / 1024**2:8.1f} MB  {last_used}  "
+                  f"hits={e['hits']:<3} {e['description']}")
+    elif action == "prune":
+        max_size = max_size_gb * 1024**3 if max_size_gb is not None else max_cache_size()
+        n_digests = len(_digest_files())
+        removed = prune(max_size)
+        print(f"Removed {removed} entries and {n_digests - len(_digest_files())} expired digests.")
+    elif action == "clear":
+        shutil.rmtree(cache_dir() / "results", ignore_errors=True)
+        shutil.rmtree(cache_dir() / "transforms", ignore_errors=True)
+        shutil.rmtree(cache_dir() / "digests", ignore_errors=True)
+        print(f"Removed {len(entries)} entries.")
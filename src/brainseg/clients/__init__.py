@@ -1,3 +1,19 @@
-from .coregister import coregister_images
-from .merge_csf_and_anatomy import merge_csf_and_anatomy
-from .T2_based_csf_mask import extract_csf_mask  
\ No newline at end of file
+import importlib
+
+# Imported on first access, so that the CLI entry points in this package
+# only load the dependencies of the command they run
+_FUNCTIONS = {
+    "coregister_images": ".coregister",
+    "merge_csf_and_anatomy": ".merge_csf_and_anatomy",
+    "extract_csf_mask": ".T2_based_csf_mask",
+}
+__all__ = list(_FUNCTIONS)
+
+
+def __getattr__(name):
+    if name not in _FUNCTIONS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # Importing the submodule binds its name in this package, which would
+    # shadow merge_csf_and_anatomy (named like its module), so bind the function
+    globals()[name] = getattr(importlib.import_module(_FUNCTIONS[name], __name__), name)
+    return globals()[name]
@@ -1,39 +1,245 @@
 import argparse
+import hashlib
+import json
+import os
+import shutil
 import sys
+import threading
+from pathlib import Path
+from brainseg.report import instrumented
 
-def coregister_images(img1_path, img2_path, output_path=None):
+# Rigid registration presets. "default" runs ants.registration with its own
+# defaults at full resolution. "fast" registers images resampled to
+# `resample_mm` with a short pyramid and sparse metric sampling; the transform
+# is then applied to the full resolution moving image.
+REGISTRATION_PRESETS = {
+    "default": {},
+    "fast": {
+        "resample_mm": 1.5,
+        "shrink_factors": (4, 2, 1),
+        "smoothing_sigmas": (2, 1, 0),
+        "iterations": (200, 100, 50),
+        "sampling_rate": 0.1,
+    },
+}
+PARAMETERS = {"shrink_factors", "smoothing_sigmas", "iterations", "sampling_rate", "resample_mm"}
+_threads_lock = threading.Lock()
+
+
+def _downsample(ants, img, resample_mm):
+    # Only coarsen, never upsample axes that are already coarser
+    spacing = tuple(max(s, resample_mm) for s in img.spacing)
+    if spacing == tuple(img.spacing):
+        return img
+    return ants.resample_image(img, spacing, use_voxels=False, interp_type=0)
+
+
+def _set_threads(threads):
+    """
+    Sets the number of ITK threads of this process. ITK reads it once, when
+    ants runs its first multithreaded filter, so this is a per-process
+    setting, not a per-call one: it only takes effect before ants is imported,
+    later calls keep the thread count of the process.
+    """
+    if threads is None:
+        return
+    var = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+    # Registrations may run in threads of the pipeline, see brainseg.pipeline.run_dag
+    with _threads_lock:
+        if "ants" not in sys.modules:
+            os.environ[var] = str(threads)
+        elif os.environ.get(var) != str(threads):
+            print(f"Note: ITK keeps {os.environ.get(var, 'all')} threads in this process, "
+                  f"the requested {threads} threads apply to new processes only.")
+
+
+def _import_ants():
     try:
         import ants
     except ImportError:
         sys.exit("Registration requires ants. Please install with e.g. 'pip install antspyx'")
+    return ants
+
+
+def registration_params(preset="default", **overrides):
+    """
+    Parameters of a rigid registration: the preset from REGISTRATION_PRESETS,
+    updated with the given overrides (shrink_factors, smoothing_sigmas and
+    iterations per pyramid level, sampling_rate, resample_mm).
+    """
+    if preset not in REGISTRATION_PRESETS:
+        sys.exit(f"Error: Unknown registration preset '{preset}'. "
+                 f"Choose from {', '.join(REGISTRATION_PRESETS)}.")
+    unknown = set(overrides) - PARAMETERS
+    if unknown:
+        sys.exit(f"Error: Unknown registration parameters: {', '.join(sorted(unknown))}")
+    params = dict(REGISTRATION_PRESETS[preset])
+    params.update({k: v for k, v in overrides.items() if v is not None})
+
+    levels = [params[k] for k in ["shrink_factors", "smoothing_sigmas", "iterations"]
+              if k in params]
+    if levels and (len(levels) != 3 or len({len(level) for level in levels}) != 1):
+        sys.exit("Error: shrink factors, smoothing sigmas and iterations need one value per level.")
+    return params
+
+
+@instrumented
+def register_images(img1_path, img2_path, preset="default", threads=None, cache=True, **overrides):
+    """
+    Computes the rigid transform from img2 (moving) to img1 (fixed) and returns
+    the path of the transform file (ANTs .mat). With `cache`, the transform is
+    stored in <cache dir>/transforms, keyed by the voxel data of both images
+    and the registration parameters, and a re-run returns it without
+    optimizing again. See coregister_images for the parameters.
+    """
+    from brainseg.cache import cache_dir, image_digest
+
+    params = registration_params(preset, **overrides)
+    _set_threads(threads)
+    ants = _import_ants()
+
+    if cache:
+        key = hashlib.sha256(json.dumps({
+            "fixed": image_digest(img1_path),
+            "moving": image_digest(img2_path),
+            "type": "Rigid",
+            "params": params,
+            "ants": getattr(ants, "__version__", "unknown"),
+        }, sort_keys=True).encode()).hexdigest()
+        transform_path = cache_dir() / "transforms" / f"{key}.mat"
+        if transform_path.exists():
+            print(f"Reusing cached registration transform {transform_path.name}")
+            return transform_path
 
     print(f"Loading Fixed Image (img1): {img1_path}")
     fixed_img = ants.image_read(str(img1_path))
-    
+
     print(f"Loading Moving Image (img2): {img2_path}")
     moving_img = ants.image_read(str(img2_path))
-    
-    print("Running Rigid Registration (this may take a minute)...")
+
+    registration_kwargs = {}
+    if "shrink_factors" in params:
+        registration_kwargs["aff_shrink_factors"] = tuple(params["shrink_factors"])
+        registration_kwargs["aff_smoothing_sigmas"] = tuple(params["smoothing_sigmas"])
+        registration_kwargs["aff_iterations"] = tuple(params["iterations"])
+    if "sampling_rate" in params:
+        registration_kwargs["aff_random_sampling_rate"] = params["sampling_rate"]
+
+    if "resample_mm" in params:
+        # The rigid transform lives in physical space, so it can be estimated
+        # on downsampled images and applied at full resolution
+        fixed_img = _downsample(ants, fixed_img, params["resample_mm"])
+        moving_img = _downsample(ants, moving_img, params["resample_mm"])
+        print(f"Registering at {params['resample_mm']} mm resolution...")
+
+    print(f"Running Rigid Registration (preset '{preset}')...")
     # 'Rigid' uses mutual information, perfect for cross-modality registration
     registration = ants.registration(
-        fixed=fixed_img, 
-        moving=moving_img, 
-        type_of_transform='Rigid'
+        fixed=fixed_img,
+        moving=moving_img,
+        type_of_transform='Rigid',
+        **registration_kwargs,
+    )
+    transform = Path(registration['fwdtransforms'][0])
+    if not cache:
+        return transform
+
+    transform_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = transform_path.with_name(f".{key}.{os.getpid()}.mat")
+    shutil.copyfile(transform, tmp_path)
+    os.replace(tmp_path, transform_path)
+    return transform_path
+
+
+@instrumented
+def apply_transform(img1_path, img2_path, transform_path, output_path=None,
+                    interpolator="linear", threads=None):
+    """
+    Resamples img2 to the grid of img1 with a transform from register_images,
+    e.g. to bring masks or further contrasts of the same session into the T1
+    space at resampling cost. Use interpolator="genericLabel" for label images.
+    """
+    _set_threads(threads)
+    ants = _import_ants()
+    registered_img2 = ants.apply_transforms(
+        fixed=ants.image_read(str(img1_path)),
+        moving=ants.image_read(str(img2_path)),
+        transformlist=[str(transform_path)],
+        interpolator=interpolator,
     )
-    
-    # The output is automatically resampled to match img1's resolution and grid
-    registered_img2 = registration['warpedmovout']
     if output_path is not None:
         print(f"Saving co-registered img2 to: {output_path}")
         ants.image_write(registered_img2, str(output_path))
+    return registered_img2
+
+
+def coregister_images(img1_path, img2_path, output_path=None, preset="default", threads=None,
+                      cache=True, **overrides):
+    """
+    Rigidly registers img2 (moving) to img1 (fixed) and returns img2 resampled
+    to the grid of img1. `preset` selects the parameters from
+    REGISTRATION_PRESETS, keyword arguments override single parameters:
+    the shrink_factors, smoothing_sigmas (in voxels) and iterations of each
+    pyramid level, the fraction of voxels sampled by the metric
+    (sampling_rate) and the resolution in mm the images are resampled to for
+    the registration (resample_mm). `threads` sets the number of ITK threads
+    of the process (default: all cores); it only takes effect if ants wasn't
+    used in the process yet. The transform is cached, see register_images.
+    """
+    transform_path = register_images(img1_path, img2_path, preset=preset, threads=threads,
+                                     cache=cache, **overrides)
+    registered_img2 = apply_transform(img1_path, img2_path, transform_path, output_path,
+                                      threads=threads)
     print("Done!")
     return registered_img2
 
-if __name__ == "__main__":
+
+def main():
     parser = argparse.ArgumentParser(description="Co-register img2 to img1 using ANTsPy.")
     parser.add_argument("--img1", required=True, help="Path to the fixed image (target space)")
     parser.add_argument("--img2", required=True, help="Path to the moving image")
     parser.add_argument("--out", required=True, help="Path to save the registered img2")
-    
+    parser.add_argument("--preset", choices=list(REGISTRATION_PRESETS), default="default",
+                        help="Registration preset (default: ANTs defaults at full resolution)")
+    parser.add_argument("--threads", type=int, help="Number of ITK threads (default: all cores)")
+    parser.add_argument("--shrink-factors", type=int, nargs="+",
+                        help="Shrink factor per level, e.g. 4 2 1")
+    parser.add_argument("--smoothing-sigmas", type=float, nargs="+",
+                        help="Smoothing sigma per level, e.g. 2 1 0")
+    parser.add_argument("--iterations", type=int, nargs="+",
+                        help="Iterations per level, e.g. 200 100 50")
+    parser.add_argument("--sampling-rate", type=float,
+                        help="Fraction of voxels sampled by the metric")
+    parser.add_argument("--resample-mm", type=float,
+                        help="Register images resampled to this resolution (mm)")
+    parser.add_argument("--save-transform",
+                        help="Also save the rigid transform (.mat) to this path")
+    parser.add_argument("--transform", help="Apply this transform (.mat) instead of registering, "
+                        "e.g. to bring a mask or another contrast into img1 space")
+    parser.add_argument("--interpolator", default="linear",
+                        help="Interpolation of img2 (use genericLabel for label images)")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the transform cache")
+
     args = parser.parse_args()
-    coregister_images(args.img1, args.img2, args.out)
\ No newline at end of file
+    transform = args.transform
+    if transform is None:
+        transform = register_images(
+            args.img1, args.img2,
+            preset=args.preset,
+            threads=args.threads,
+            cache=not args.no_cache,
+            shrink_factors=args.shrink_factors,
+            smoothing_sigmas=args.smoothing_sigmas,
+            iterations=args.iterations,
+            sampling_rate=args.sampling_rate,
+            resample_mm=args.resample_mm,
+        )
+    if args.save_transform:
+        shutil.copyfile(transform, args.save_transform)
+        print(f"Saved transform to: {args.save_transform}")
+    apply_transform(args.img1, args.img2, transform, args.out,
+                    interpolator=args.interpolator, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
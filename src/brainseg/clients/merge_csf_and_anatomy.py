@@ -1,54 +1,110 @@
 import nibabel as nib
 import numpy as np
 import argparse
-import nibabel.processing
+import fastremap
+from brainseg.remap import as_labels, label_data
+from brainseg.utils import as_image, describe_image
+from brainseg.nifti_io import save_image, save_slabs
+from brainseg.slabs import iter_slabs, use_slabs
+from brainseg.report import instrumented
+
+VENTRICLES = [
+    4,  # Left lateral ventricle
+    5,  # Left inferior lateral ventricle
+    14,  # Third ventricle
+    15,  # Fourth ventricle
+    43,  # Right lateral ventricle
+    44,  # Right inferior lateral ventricle
+    63,
+    31, # Add also choroid plexus labels to avoid overwriting them with CSF completely
+]
+
+
+def merge_lut(max_label, csf_label=24):
+    """
+    Lookup table of the merge for labels up to max_label: lut[0, l] is the
+    new label of l outside the CSF mask (the old CSF label is erased),
+    lut[1, l] the new label inside it (CSF, unless l is a protected label).
+    """
+    n_labels = max(max_label, csf_label) + 1
+    lut = np.empty((2, n_labels), dtype=np.min_scalar_type(n_labels - 1))
+    lut[0] = np.arange(n_labels)
+    # Erase the old CSF label (Label 24)
+    lut[0, csf_label] = 0
+    #  Override segmentation where CSF mask is nonzero and not already labeled as ventricles
+    lut[1] = csf_label
+    protected = [label for label in VENTRICLES if label < n_labels]
+    lut[1, protected] = protected
+    return lut
+
 
+def merge_labels(seg_data, csf_data, csf_label=24):
+    """
+    Replaces the CSF label of seg_data by the CSF mask csf_data in a single
+    lookup pass (see merge_lut). Returns a new array in the smallest dtype
+    that holds the labels.
+    """
+    seg_data = as_labels(seg_data)
+    max_label = fastremap.minmax(seg_data)[1]
+    lut = merge_lut(int(max_label or 0), csf_label)
+    return lut[(csf_data > 0).view(np.uint8), seg_data]
 
+
+@instrumented
 def merge_csf_and_anatomy(
-    seg_path, csf_mask_path, out_path, csf_label=24, fill_by_dilation=False
+    seg_path, csf_mask_path, out_path=None, csf_label=24, fill_by_dilation=False
 ):
+    """
+    Replaces the CSF of a segmentation by a CSF mask, keeping the ventricles.
+    Segmentation and mask can be given as paths or nibabel images. Returns the
+    merged image and saves it if out_path is given. Very large volumes on
+    disk are merged slab by slab, see brainseg.slabs.
+    """
     # from nbmorph import (
     #     dilate_labels_spherical,
     #     close_labels_spherical,
     #     open_labels_spherical,
     # )
 
-    print(f"Loading GOUHFI parcellation: {seg_path}")
-    seg = nib.load(seg_path)
-    seg_data = seg.get_fdata().astype(np.int32)
+    print(f"Loading GOUHFI parcellation: {describe_image(seg_path)}")
+    seg = as_image(seg_path)
+
+    print(f"Loading T2 CSF Mask: {describe_image(csf_mask_path)}")
+    csf_img = as_image(csf_mask_path)
+
+    if (
+        out_path is not None
+        and seg.shape == csf_img.shape
+        and np.allclose(seg.affine, csf_img.affine)
+        and use_slabs(seg, csf_img)
+    ):
+        # The output dtype has to be known before the first slab is written
+        max_label = max(
+            int(fastremap.minmax(as_labels(seg_data))[1] or 0)
+            for _, _, (seg_data,) in iter_slabs(seg)
+        )
+        dtype = merge_lut(max_label, csf_label).dtype
+        slabs = (
+            merge_labels(seg_data, csf_data, csf_label)
+            for _, _, (seg_data, csf_data) in iter_slabs(seg, csf_img)
+        )
+        print(f"Saving merged output slab by slab to: {out_path}")
+        save_slabs(slabs, out_path, seg.shape, dtype, seg.affine, header=seg.header)
+        return nib.load(out_path)
 
-    print(f"Loading T2 CSF Mask: {csf_mask_path}")
-    csf_img = nib.load(csf_mask_path)
+    seg_data = label_data(seg)
     if seg.shape != csf_img.shape or not np.allclose(seg.affine, csf_img.affine):
         print(
             "Mismatched dimensions/affine detected. Resampling CSF mask to segmentation space..."
         )
-        # order=0 ensures nearest-neighbor interpolation
-        csf_img = nib.processing.resample_from_to(csf_img, seg, order=0)
-
-    csf_data = csf_img.get_fdata() > 0
-    # Create a copy for our final output
-    combined_data = np.copy(seg_data)
+        # Imported here, nibabel.processing loads scipy.ndimage
+        import nibabel.processing
 
-    # Erase the old CSF label (Label 24)
-    combined_data[combined_data == csf_label] = 0
-
-    # Define the "Brain Anatomy" mask
-    brain_anatomy_mask = combined_data > 0
-
-    ventricles = [
-        4,  # Left lateral ventricle
-        5,  # Left inferior lateral ventricle
-        14,  # Third ventricle
-        15,  # Fourth ventricle
-        43,  # Right lateral ventricle
-        44,  # Right inferior lateral ventricle
-        63,
-        31, # Add also choroid plexus labels to avoid overwriting them with CSF completely
-    ]
+        # order=0 ensures nearest-neighbor interpolation
+        csf_img = nibabel.processing.resample_from_to(csf_img, seg, order=0)
 
-    #  Override segmentation where CSF mask is nonzero and not already labeled as ventricles
-    combined_data[(csf_data == True) & ~np.isin(combined_data, ventricles)] = csf_label
+    csf_data = np.asanyarray(csf_img.dataobj)
+    combined_data = merge_labels(seg_data, csf_data, csf_label)
 
     #total_volume_mask = combined_data > 0
     #filled_volume_mask = open_labels_spherical(total_volume_mask, radius=1)
@@ -72,9 +128,12 @@ def merge_csf_and_anatomy(
     #     internal_holes = (filled_volume_mask == True) & (total_volume_mask == False)
     #     num_holes_filled = np.sum(internal_holes)
 
-    print(f"Saving merged output to: {out_path}")
     new_img = nib.Nifti1Image(combined_data, seg.affine, seg.header)
-    nib.save(new_img, out_path)
+    new_img.set_data_dtype(combined_data.dtype)
+    if out_path is not None:
+        print(f"Saving merged output to: {out_path}")
+        save_image(new_img, out_path)
+    return new_img
 
 
 def main():
@@ -10,8 +10,14 @@ def main():
     # Required arguments
     parser.add_argument("-i", "--input", required=True, help="Path to the input .nii.gz file")
     parser.add_argument("-o", "--output", required=True, help="Path to save the remapped .nii.gz file")
-    parser.add_argument("--old-txt", required=True, help="Text file containing old label mapping")
-    parser.add_argument("--new-txt", required=True, help="Text file containing new label mapping")
+    parser.add_argument("--old-txt", required=True,
+                        help="Text file containing old label mapping "
+                        "(or a built-in schema name, e.g. gouhfi)")
+    parser.add_argument("--new-txt", required=True,
+                        help="Text file containing new label mapping "
+                        "(or a built-in schema name, e.g. freesurfer)")
+    parser.add_argument("--via", nargs="+", default=[],
+                        help="Intermediate schemas to translate through, applied in one pass")
     
     # Optional flag
     parser.add_argument("--inplace", action="store_true", help="Perform remap in-place to save memory")
@@ -20,7 +26,8 @@ def main():
 
     print(f"--- Processing: {os.path.basename(args.input)} ---")
 
-    remap_file(args.input, args.old_txt, args.new_txt, args.output)
+    remap_file(args.input, args.old_txt, args.new_txt, args.output, inplace=args.inplace,
+               via=args.via)
     print(f"Success! Saved to: {args.output}")
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import argparse
 import nibabel as nib
 import nibabel.processing
+from brainseg.nifti_io import save_image
 
 def resample_image(input_path, output_path, voxel_size):
     print(f"Loading: {input_path}")
@@ -14,7 +15,7 @@ def resample_image(input_path, output_path, voxel_size):
     )
     
     print(f"Saving to: {output_path}")
-    nib.save(conformed_img, output_path)
+    save_image(conformed_img, output_path)
     print("Done!")
 
 def main():
@@ -1,11 +1,32 @@
 from pathlib import Path
 import argparse
-import brainseg.tools
+import importlib
+import os
+import sys
+from brainseg.clients.coregister import REGISTRATION_PRESETS
 
+# Segmentation subcommands: the function running the tool and the containers
+# it needs. The functions (and with them numpy, nibabel and the pipeline
+# modules) are only imported once a subcommand runs, so that `--help`,
+# argument errors and the cache/pull commands start quickly.
+TOOL_COMMANDS = {
+    "synthseg": ("brainseg.tools.synthseg:run_synthseg", ["synthseg"]),
+    "gouhfi": ("brainseg.tools.gouhfi:run_gouhfi", ["gouhfi"]),
+    "fastsurfer": ("brainseg.tools.fastsurfer:run_fastsurfer", ["fastsurfer"]),
+    "simnibs": ("brainseg.tools.simnibs:run_simnibs", ["simnibs"]),
+    "synthstrip": ("brainseg.tools.synthstrip:run_synthstrip", ["synthstrip"]),
+    "hybrid_gouhfi_T2": ("brainseg.tools.gouhfi:run_hybrid_gouhfi_T2", ["gouhfi", "synthstrip"]),
+}
+CONTAINERS = list(dict.fromkeys(c for _, containers in TOOL_COMMANDS.values() for c in containers))
 
-def main():
-    from brainseg.utils import find_container
 
+def load_command(tool):
+    """Imports and returns the function running a segmentation subcommand."""
+    module, function = TOOL_COMMANDS[tool][0].split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def main():
     parser = argparse.ArgumentParser(description="BrainSeg: Brain Segmentation Wrapper")
     subparsers = parser.add_subparsers(
         dest="tool", required=True, help="Segmentation tool to run"
@@ -26,28 +47,100 @@ def main():
     common_parser.add_argument(
         "--container", type=Path, help="Path to the container file"
     )
+    common_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always run the tool, don't reuse or store results in the result cache",
+    )
+    common_parser.add_argument(
+        "--report",
+        type=Path,
+        help="Write a run report with the time, CPU time, peak memory and I/O of "
+        "every step to this file (.json or .csv)",
+    )
 
     parc_parser = argparse.ArgumentParser(add_help=False)
     parc_parser.add_argument(
         "--parc", action="store_true", help="Perform cortical parcellation"
     )
 
+    folds_parser = argparse.ArgumentParser(add_help=False)
+    folds_parser.add_argument(
+        "--folds",
+        type=int,
+        nargs="+",
+        choices=range(0, 5),
+        metavar="{0-4}",
+        help="GOUHFI folds to ensemble, e.g. --folds 0 1 (default: all five)",
+    )
+    folds_parser.add_argument(
+        "--np",
+        dest="processes",
+        type=int,
+        default=1,
+        help="Number of parallel GOUHFI processes (default: 1)",
+    )
+
+    io_parser = argparse.ArgumentParser(add_help=False)
+    io_parser.add_argument(
+        "--gzip-level",
+        type=int,
+        choices=range(0, 10),
+        metavar="{0-9}",
+        help="gzip compression level of .nii.gz outputs written by brainseg "
+        "(default: $BRAINSEG_GZIP_LEVEL or 1)",
+    )
+
+    warm_parser = argparse.ArgumentParser(add_help=False)
+    warm_parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="Run all container calls in long-lived container instances, "
+        "reused across calls (one per container image)",
+    )
+    warm_parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600,
+        help="Stop warm container instances after this many idle seconds (default: 600)",
+    )
+    warm_parser.add_argument(
+        "--runtime",
+        help="Container runtime: apptainer, singularity, 'standin' for the local stand-in "
+        "that emulates the tools without containers, or the path of a compatible executable "
+        "(default: $BRAINSEG_RUNTIME or the installed one of apptainer and singularity)",
+    )
+
     # --- Tool Subcommands ---
     subparsers.add_parser(
-        "synthseg", parents=[common_parser, parc_parser], help="Run SynthSeg"
+        "synthseg",
+        parents=[common_parser, parc_parser, warm_parser, io_parser],
+        help="Run SynthSeg",
+    )
+    subparsers.add_parser(
+        "gouhfi",
+        parents=[common_parser, parc_parser, folds_parser, warm_parser, io_parser],
+        help="Run GOUHFI",
+    )
+    subparsers.add_parser(
+        "fastsurfer",
+        parents=[common_parser, parc_parser, warm_parser, io_parser],
+        help="Run FastSurfer",
     )
     subparsers.add_parser(
-        "gouhfi", parents=[common_parser, parc_parser], help="Run GOUHFI"
+        "simnibs",
+        parents=[common_parser, warm_parser, io_parser],
+        help="Run SimNIBS",
     )
     subparsers.add_parser(
-        "fastsurfer", parents=[common_parser, parc_parser], help="Run FastSurfer"
+        "synthstrip",
+        parents=[common_parser, warm_parser, io_parser],
+        help="Run SynthStrip",
     )
-    subparsers.add_parser("simnibs", parents=[common_parser], help="Run SimNIBS")
-    subparsers.add_parser("synthstrip", parents=[common_parser], help="Run SynthStrip")
 
     hybrid_parser = subparsers.add_parser(
         "hybrid_gouhfi_T2",
-        parents=[common_parser, parc_parser],
+        parents=[common_parser, parc_parser, folds_parser, warm_parser, io_parser],
         help="Run Hybrid GOUHFI T1+T2",
     )
     hybrid_parser.add_argument(
@@ -59,10 +152,233 @@ def main():
     hybrid_parser.add_argument(
         "--save_tmp_files",
         action="store_true",
-        help="Save intermediate files from the pipeline",
+        help="Keep intermediate files in <output dir>/segmentation_tmp_files "
+        "(same as --workdir with that directory)",
+    )
+    hybrid_parser.add_argument(
+        "--registration",
+        choices=list(REGISTRATION_PRESETS),
+        default="default",
+        help="Preset of the T2 -> T1 registration: 'fast' registers downsampled images "
+        "(default: ANTs defaults at full resolution)",
+    )
+    hybrid_parser.add_argument(
+        "--workdir",
+        type=Path,
+        help="Keep intermediate files in this directory and resume from the first "
+        "stale or missing step when re-running",
+    )
+
+    batch_parser = subparsers.add_parser(
+        "batch",
+        parents=[parc_parser, folds_parser, warm_parser, io_parser],
+        help="Run a tool on many subjects in a single container invocation",
+    )
+    batch_parser.add_argument(
+        "-t",
+        "--tool",
+        dest="batch_tool",
+        required=True,
+        choices=list(TOOL_COMMANDS),
+        help="Segmentation tool to run on the batch",
+    )
+    batch_parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="Input directory, glob pattern (quoted) or manifest file with one image per line "
+        "('T1 T2' per line for hybrid_gouhfi_T2)",
+    )
+    batch_parser.add_argument(
+        "-o", "--output", required=True, type=Path, help="Output directory"
+    )
+    batch_parser.add_argument(
+        "--container", type=Path, help="Path to the container file"
+    )
+    batch_parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Run one container per subject, with several subjects running concurrently",
+    )
+    batch_parser.add_argument(
+        "--cores", type=int, help="Total number of cores to use with --parallel (default: all)"
+    )
+    batch_parser.add_argument(
+        "--mem", type=float, help="Total memory budget in GB for --parallel (default: all)"
+    )
+    batch_parser.add_argument(
+        "--jobs", type=int, help="Maximum number of concurrent subjects with --parallel"
+    )
+    batch_parser.add_argument(
+        "--report",
+        type=Path,
+        help="Write the run report of every subject and their merged run_report.csv "
+        "to this directory",
+    )
+    batch_parser.add_argument(
+        "--registration",
+        choices=list(REGISTRATION_PRESETS),
+        default="default",
+        help="Preset of the T2 -> T1 registration of hybrid_gouhfi_T2",
+    )
+
+    benchmark_parser = subparsers.add_parser(
+        "gouhfi_benchmark",
+        parents=[folds_parser, warm_parser],
+        help="Time the GOUHFI folds and compare a reduced-fold with the full ensemble",
+    )
+    benchmark_parser.add_argument(
+        "-i", "--input", required=True, type=Path, help="Input NIfTI file"
+    )
+    benchmark_parser.add_argument(
+        "-o", "--output", required=True, type=Path,
+        help="Output directory for the segmentations and fold_benchmark.json",
+    )
+    benchmark_parser.add_argument(
+        "--reference-folds",
+        type=int,
+        nargs="+",
+        choices=range(0, 5),
+        metavar="{0-4}",
+        help="Folds of the reference ensemble (default: all five)",
+    )
+    benchmark_parser.add_argument(
+        "--container", type=Path, help="Path to the container file"
+    )
+
+    pull_parser = subparsers.add_parser(
+        "pull", help="Build or validate the container images before running jobs"
+    )
+    pull_parser.add_argument(
+        "tools",
+        nargs="*",
+        metavar="TOOL",
+        help=f"Tools whose containers to pull, from {', '.join(CONTAINERS)} (default: all)",
+    )
+    pull_parser.add_argument(
+        "--jobs", type=int, help="Maximum number of concurrent builds (default: all)"
+    )
+    pull_parser.add_argument(
+        "--runtime", help="Container runtime used for the builds (default: $BRAINSEG_RUNTIME)"
+    )
+
+    report_parser = subparsers.add_parser(
+        "report", help="Merge run reports (e.g. of several batches) and summarize them per step"
+    )
+    report_parser.add_argument("reports", nargs="+", type=Path, help="Run reports (.json or .csv)")
+    report_parser.add_argument("-o", "--output", type=Path, help="Merged report (.csv)")
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="Inspect and prune the result cache"
+    )
+    cache_parser.add_argument(
+        "action", choices=["info", "list", "prune", "clear"], help="Cache operation"
+    )
+    cache_parser.add_argument(
+        "--max-size",
+        type=float,
+        help="Size in GB to prune the cache to (default: $BRAINSEG_CACHE_MAX_GB or 50)",
     )
 
     args = parser.parse_args()
+    if args.tool == "pull" and set(args.tools) - set(CONTAINERS):
+        # No argparse choices, they reject the empty list of nargs="*" on older Pythons
+        parser.error(f"Unknown tools: {', '.join(sorted(set(args.tools) - set(CONTAINERS)))}")
+
+    if getattr(args, "gzip_level", None) is not None:
+        # Through the environment, so that worker processes inherit it
+        os.environ["BRAINSEG_GZIP_LEVEL"] = str(args.gzip_level)
+
+    if getattr(args, "runtime", None) is not None:
+        os.environ["BRAINSEG_RUNTIME"] = args.runtime
+
+    if args.tool == "cache":
+        from brainseg.cache import manage_cache
+
+        manage_cache(args.action, max_size_gb=args.max_size)
+        return
+
+    if args.tool == "report":
+        from brainseg.report import merge_reports
+
+        merge_reports(args.reports, args.output)
+        return
+
+    from brainseg.utils import find_container, find_containers
+    from brainseg.instances import enable_warm_instances
+
+    if args.tool == "pull":
+        from brainseg.utils import pull_containers
+
+        if pull_containers(args.tools, max_workers=args.jobs):
+            sys.exit(1)
+        return
+
+    if args.tool == "gouhfi_benchmark":
+        from brainseg.tools.gouhfi import benchmark_gouhfi_folds
+
+        if args.folds is None:
+            sys.exit("Error: gouhfi_benchmark needs the reduced fold set, e.g. --folds 0 1")
+        if args.warm:
+            enable_warm_instances(roots=[args.input.resolve().parent, args.output.resolve()],
+                                  idle_timeout=args.idle_timeout)
+        benchmark_gouhfi_folds(
+            args.input.resolve(),
+            args.output.resolve(),
+            args.container if args.container else find_container("gouhfi"),
+            args.folds,
+            reference_folds=args.reference_folds,
+            processes=args.processes,
+        )
+        return
+
+    if args.tool == "batch":
+        from brainseg.tools.batch import collect_input_pairs, collect_inputs, run_batch_parallel
+
+        if args.batch_tool == "hybrid_gouhfi_T2":
+            inputs = collect_input_pairs(args.input)
+            sif_paths = find_containers(TOOL_COMMANDS[args.batch_tool][1])
+        else:
+            inputs = collect_inputs(args.input)
+            sif_paths = [args.container if args.container else find_container(args.batch_tool)]
+
+        if args.warm:
+            input_dirs = {Path(p).parent for subject in inputs for p in
+                          (subject if isinstance(subject, tuple) else (subject,))}
+            enable_warm_instances(roots=[*input_dirs, args.output.resolve()],
+                                  idle_timeout=args.idle_timeout)
+
+        if args.parallel:
+            results = run_batch_parallel(
+                args.batch_tool,
+                inputs,
+                args.output.resolve(),
+                sif_paths,
+                do_parcellation=args.parc,
+                cores=args.cores,
+                mem_gb=args.mem,
+                max_jobs=args.jobs,
+                registration=args.registration,
+                folds=args.folds,
+                processes=args.processes,
+                report_dir=args.report,
+            )
+            if any(r["status"] != "ok" for r in results):
+                sys.exit(1)
+        else:
+            from brainseg.tools.batch import run_batch
+
+            run_batch(
+                args.batch_tool,
+                inputs,
+                args.output.resolve(),
+                sif_paths[0],
+                do_parcellation=args.parc,
+                folds=args.folds,
+                processes=args.processes,
+                report_dir=args.report,
+            )
+        return
 
     # Make sure output directory exists, if not create it
     try:
@@ -75,60 +391,84 @@ def main():
         print(f"OS error occurred while creating directory {args.output.resolve().parent}: {e}")
         raise
 
-    if args.container:
-        sif_path = args.container
-    elif "hybrid" not in args.tool:
-        sif_path = find_container(args.tool)
-
     # Safely extract parcellation flag if it exists for the invoked subcommand
     do_parc = getattr(args, "parc", False)
     save_tmp_files = getattr(args, "save_tmp_files", False)
+    workdir = getattr(args, "workdir", None)
 
-    # Dispatch
-    if args.tool == "synthseg":
-        brainseg.tools.run_synthseg(
-            args.input.resolve(),
-            args.output.resolve(),
-            sif_path,
-            do_parcellation=do_parc,
-        )
-    elif args.tool == "gouhfi":
-        brainseg.tools.run_gouhfi(
-            args.input.resolve(),
-            args.output.resolve(),
-            sif_path,
-            do_parcellation=do_parc,
-        )
-    elif args.tool == "fastsurfer":
-        brainseg.tools.run_fastsurfer(
-            args.input.resolve(),
-            args.output.resolve(),
-            sif_path,
-            do_parcellation=do_parc,
-        )
-    elif args.tool == "simnibs":
-        brainseg.tools.run_simnibs(
-            args.input.resolve(), args.output.resolve(), sif_path
-        )
-    elif args.tool == "synthstrip":
-        brainseg.tools.run_synthstrip(
-            args.input.resolve(), args.output.resolve(), sif_path
-        )
-    elif args.tool == "hybrid_gouhfi_T2":
+    if args.warm:
+        roots = [args.input.resolve().parent, args.output.resolve().parent]
+        if getattr(args, "t2", None) is not None:
+            roots.append(args.t2.resolve().parent)
+        enable_warm_instances(roots=roots, idle_timeout=args.idle_timeout)
+
+    input_paths = [args.input.resolve()]
+    if args.tool == "hybrid_gouhfi_T2":
         # We need both containers for the hybrid pipeline
-        gouhfi_sif = find_container("gouhfi")
-        synthstrip_sif = find_container("synthstrip")
+        input_paths.append(args.t2.resolve())
+        sif_paths = find_containers(TOOL_COMMANDS[args.tool][1])
+    elif args.container:
+        sif_paths = [args.container]
+    else:
+        sif_paths = [find_container(args.tool)]
 
-        brainseg.tools.run_hybrid_gouhfi_T2(
-            args.input.resolve(),
-            args.t2.resolve(),
-            args.output.resolve(),
-            gouhfi_sif,
-            synthstrip_sif,
-            do_parcellation=do_parc,
-            save_tmp_files=save_tmp_files,
-        )
+    # Same order of arguments for all tools: inputs, output, containers
+    kwargs = {}
+    if args.tool in ["synthseg", "gouhfi", "fastsurfer", "hybrid_gouhfi_T2"]:
+        kwargs["do_parcellation"] = do_parc
+    if args.tool in ["gouhfi", "hybrid_gouhfi_T2"]:
+        from brainseg.tools.gouhfi import fold_string
+
+        kwargs["folds"] = fold_string(args.folds)
+        kwargs["processes"] = args.processes
+    if args.tool == "hybrid_gouhfi_T2":
+        kwargs["save_tmp_files"] = save_tmp_files
+        kwargs["workdir"] = workdir
+        kwargs["registration"] = args.registration
+
+    # Dispatch
+    def run_tool():
+        load_command(args.tool)(*input_paths, args.output.resolve(), *sif_paths, **kwargs)
+
+    flags = {"parc": do_parc}
+    if args.tool == "hybrid_gouhfi_T2":
+        flags["registration"] = args.registration
+    if getattr(args, "folds", None) is not None:
+        # The number of processes does not change the result
+        flags["folds"] = kwargs["folds"]
+
+    from brainseg.report import collect_steps, start_report, step, write_report
+
+    if args.report:
+        start_report()
+    with step(args.tool, inputs=input_paths, outputs=[args.output.resolve()]):
+        # The intermediate files of the hybrid pipeline are not cached, with a work
+        # directory the pipeline resumes from its own checkpoints instead.
+        if args.no_cache or save_tmp_files or workdir is not None:
+            run_tool()
+        else:
+            from brainseg.cache import cached_run
+
+            # All files the tool writes, so that a cache hit restores them all
+            output_paths = [args.output.resolve()]
+            if args.tool == "synthstrip":
+                from brainseg.tools.synthstrip import mask_path
+
+                output_paths.append(mask_path(output_paths[0]))
+            cached_run(
+                args.tool,
+                input_paths,
+                output_paths,
+                sif_paths,
+                flags,
+                run_tool,
+            )
+
+    if args.report:
+        from brainseg.tools.batch import subject_id
 
+        write_report(args.report, collect_steps(), subject=subject_id(args.input), tool=args.tool)
+        print(f"Run report written to {args.report}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,186 @@
+import itertools
+import multiprocessing.util
+import os
+import re
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# Warm instances are owned by the process that started them. The registry maps
+# the container image to a list of running instances: {"name", "roots" (host
+# directories bound at identical paths), "runtime" (the command of the container
+# runtime), "pid", "busy" (running calls), "timer"}
+_config = {
+    "enabled": os.environ.get("BRAINSEG_WARM_INSTANCES") == "1",
+    "roots": [],
+    "idle_timeout": 600,
+}
+_instances = {}
+_lock = threading.RLock()
+_counter = itertools.count()
+# Processes that registered stop_all_instances to run at their exit
+_cleanup_pids = set()
+
+
+def enable_warm_instances(roots=(), idle_timeout=600):
+    """
+    Runs all following container calls of this process in long-lived
+    `apptainer instance`s (one per container image), instead of starting a
+    new container for each call. `roots` are host directories that are bound
+    into every instance, e.g. the input, output and work directories of a batch.
+    Instances are stopped after `idle_timeout` seconds without a call, by
+    stop_all_instances() or when the process exits.
+    """
+    _config["enabled"] = True
+    _config["roots"] = [Path(r).resolve() for r in roots]
+    _config["idle_timeout"] = idle_timeout
+
+
+@contextmanager
+def warm_instances(roots=(), idle_timeout=600):
+    """Context manager enabling warm instances, all instances are stopped on exit."""
+    previous = dict(_config)
+    enable_warm_instances(roots=roots, idle_timeout=idle_timeout)
+    try:
+        yield
+    finally:
+        stop_all_instances()
+        _config.update(previous)
+
+
+def _covers(roots, path):
+    return any(path == root or root in path.parents for root in roots)
+
+
+def _start_instance(runtime, sif_path, roots):
+    name = f"brainseg_{Path(sif_path).stem}_{os.getpid()}_{next(_counter)}"
+    bind_args = []
+    for root in roots:
+        bind_args += ["--bind", f"{root}:{root}"]
+    cmd = [*runtime, "instance", "start", "--cleanenv", *bind_args, str(sif_path), name]
+    if os.getpid() not in _cleanup_pids:
+        # Finalizers are bound to the process that created them, so forked
+        # workers (e.g. of a process pool) register their own
+        _cleanup_pids.add(os.getpid())
+        multiprocessing.util.Finalize(None, stop_all_instances, exitpriority=10)
+    print(f"--- Starting warm container instance {name} ---")
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return {"name": name, "roots": roots, "runtime": runtime, "pid": os.getpid(), "busy": 0,
+            "timer": None}
+
+
+def _stop_instance(runtime, instance):
+    if instance["timer"] is not None:
+        instance["timer"].cancel()
+    subprocess.run(
+        [*runtime, "instance", "stop", instance["name"]],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def _reset_idle_timer(runtime, sif_path, instance):
+    def stop_idle():
+        with _lock:
+            if instance["busy"] == 0 and instance in _instances.get(sif_path, []):
+                _instances[sif_path].remove(instance)
+                print(f"Stopping idle container instance {instance['name']}")
+                _stop_instance(runtime, instance)
+
+    if instance["timer"] is not None:
+        instance["timer"].cancel()
+    instance["timer"] = threading.Timer(_config["idle_timeout"], stop_idle)
+    instance["timer"].daemon = True
+    instance["timer"].start()
+
+
+def _rewrite_paths(arg, replacements):
+    """
+    Replaces the container paths in `arg` (a path or a script) by their host
+    paths. Only whole paths and the paths below them are replaced, so that a
+    bind of /data does not rewrite /data_job or /mnt/data.
+    """
+    if not replacements:
+        return arg
+    # Longest container paths first, so that /data_in/raw wins over /data_in
+    containers = sorted(replacements, key=len, reverse=True)
+    pattern = re.compile(
+        r"(?<![\w./-])(" + "|".join(re.escape(c) for c in containers) + r")(?=/|[^\w.-]|$)"
+    )
+    return pattern.sub(lambda m: replacements[m[1]], arg)
+
+
+def instance_command(runtime, sif_path, binds, args, action="exec", env_args=()):
+    """
+    Returns the command running `args` in a warm instance of `sif_path`, starting
+    the instance if needed, or None if warm instances are disabled or the call
+    can't run in an instance. Instances bind host directories at identical paths,
+    so the container paths of `binds` in `args` are replaced by the host paths.
+    Calls that bind a file under a different name can't be expressed this way
+    and run in a fresh container.
+    """
+    if not _config["enabled"]:
+        return None
+
+    host_dirs = []
+    replacements = {}
+    for bind in binds:
+        host, container = Path(bind[0]).resolve(), os.path.normpath(str(bind[1]))
+        if host.is_file():
+            if host.name != Path(container).name:
+                return None
+            host_dirs.append(host.parent)
+        else:
+            host_dirs.append(host)
+        replacements[container] = str(host)
+
+    sif_path = str(Path(sif_path).resolve())
+    with _lock:
+        running = [i for i in _instances.get(sif_path, []) if i["pid"] == os.getpid()]
+        _instances[sif_path] = running
+        instance = next(
+            (i for i in running if all(_covers(i["roots"], d) for d in host_dirs)), None
+        )
+        if instance is None:
+            roots = sorted(set(_config["roots"]) | set(host_dirs))
+            instance = _start_instance(runtime, sif_path, roots)
+            running.append(instance)
+        # The idle timer restarts once the call is done, see release_instance()
+        instance["busy"] += 1
+        if instance["timer"] is not None:
+            instance["timer"].cancel()
+
+    rewritten = [_rewrite_paths(arg, replacements) for arg in args]
+
+    return [*runtime, action, "--cleanenv", *env_args, f"instance://{instance['name']}", *rewritten]
+
+
+def release_instance(cmd):
+    """Marks the call `cmd` in a warm instance as done and restarts the idle timer."""
+    names = [arg[len("instance://"):] for arg in cmd if str(arg).startswith("instance://")]
+    if not names:
+        return
+    with _lock:
+        for sif_path, running in _instances.items():
+            for instance in running:
+                if instance["name"] == names[0]:
+                    instance["busy"] -= 1
+                    if instance["busy"] == 0:
+                        _reset_idle_timer(instance["runtime"], sif_path, instance)
+
+
+def stop_all_instances():
+    """Stops all warm instances started by this process."""
+    from brainseg.utils import get_container_runtime
+
+    with _lock:
+        instances = [
+            i for running in _instances.values() for i in running if i["pid"] == os.getpid()
+        ]
+        _instances.clear()
+    if not instances:
+        return
+    runtime = get_container_runtime()
+    for instance in instances:
+        print(f"Stopping container instance {instance['name']}")
+        _stop_instance(runtime, instance)
@@ -0,0 +1,150 @@
+import io
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import Opener
+
+# Compression settings, configurable through the environment:
+# BRAINSEG_GZIP_LEVEL      gzip level of final outputs (default: nibabel's default, 1)
+# BRAINSEG_IO_THREADS      threads used for gzip compression (default: up to 8 cores)
+# BRAINSEG_TMP_FORMAT      "nii" (uncompressed, default) or "nii.gz" for intermediates
+# BRAINSEG_TMP_GZIP_LEVEL  gzip level of compressed intermediates (default 1)
+CHUNK_SIZE = 4 * 1024**2
+DICT_SIZE = 32 * 1024
+
+
+def gzip_level(temporary=False):
+    if temporary:
+        return int(os.environ.get("BRAINSEG_TMP_GZIP_LEVEL", 1))
+    return int(os.environ.get("BRAINSEG_GZIP_LEVEL", Opener.default_compresslevel))
+
+
+def io_threads():
+    return int(os.environ.get("BRAINSEG_IO_THREADS", min(8, os.cpu_count() or 1)))
+
+
+def temp_suffix():
+    """File suffix for intermediate files that are only read by brainseg or containers."""
+    if os.environ.get("BRAINSEG_TMP_FORMAT", "nii") == "nii.gz":
+        return ".nii.gz"
+    return ".nii"
+
+
+def split_nifti_name(path):
+    """Splits a NIfTI file name into its stem and suffix (.nii or .nii.gz)."""
+    name = Path(path).name
+    for suffix in (".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)], suffix
+    return Path(path).stem, Path(path).suffix
+
+
+def _compress_chunk(data, start, end, level):
+    # Every chunk is an independent raw deflate stream primed with the 32K
+    # preceding it; sync-flushed chunks concatenate to one valid deflate stream.
+    zdict = data[max(0, start - DICT_SIZE):start]
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _write_gzip_stream(f, blocks, level=1, threads=1):
+    """
+    Writes the byte blocks (e.g. slabs of an image) to the open file `f` as one
+    gzip member. Each block is compressed in parallel chunks, only one block
+    needs to be in memory at a time.
+    """
+    f.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+    crc, size, tail = 0, 0, b""
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for block in blocks:
+            block = memoryview(block).cast("B")
+            # Prefix the end of the previous block as dictionary for the first chunk
+            data = memoryview(tail + block) if tail else block
+            bounds = [
+                (start, min(start + CHUNK_SIZE, len(data)))
+                for start in range(len(tail), len(data), CHUNK_SIZE)
+            ]
+            crc_future = executor.submit(zlib.crc32, block, crc)
+            for chunk in executor.map(lambda b: _compress_chunk(data, b[0], b[1], level), bounds):
+                f.write(chunk)
+            crc = crc_future.result()
+            size += len(block)
+            tail = bytes(data[-DICT_SIZE:])
+    # Final empty block that terminates the deflate stream
+    f.write(zlib.compressobj(level, zlib.DEFLATED, -15).flush(zlib.Z_FINISH))
+    f.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+
+
+def write_gzip(data, path, level=1, threads=1):
+    """
+    Writes `data` as a single-member gzip file, compressing chunks in parallel
+    threads (zlib releases the GIL), similar to pigz. The result can be read
+    by any gzip reader.
+    """
+    with open(path, "wb") as f:
+        _write_gzip_stream(f, [data], level=level, threads=threads)
+
+
+def save_image(img, path, temporary=False):
+    """
+    Saves a NIfTI image. `.nii.gz` files are compressed with the multithreaded
+    gzip writer at the configured level (BRAINSEG_GZIP_LEVEL, or
+    BRAINSEG_TMP_GZIP_LEVEL for `temporary` files), `.nii` files are written
+    uncompressed.
+    """
+    path = Path(path)
+    if not path.name.endswith(".nii.gz") or not isinstance(img, nib.Nifti1Image):
+        nib.save(img, path)
+        return
+    write_gzip(img.to_bytes(), path, level=gzip_level(temporary), threads=io_threads())
+
+
+def temp_path(directory, stem):
+    """Path of an intermediate file in the configured temporary format."""
+    return Path(directory) / f"{stem}{temp_suffix()}"
+
+
+def _slab_header(header, affine, shape, dtype, scaling):
+    header = nib.Nifti1Header.from_header(header)
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_sform(affine)
+    header.set_qform(affine)
+    header.set_slope_inter(*scaling)
+    offset = 352 + sum(ext.get_sizeondisk() for ext in header.extensions)
+    header.set_data_offset(offset)
+    buffer = io.BytesIO()
+    header.write_to(buffer)
+    return buffer.getvalue().ljust(offset, b"\x00")
+
+
+def save_slabs(slabs, path, shape, dtype, affine, header=None, temporary=False, scaling=(1, 0)):
+    """
+    Saves a 3D NIfTI image from an iterable of z-slabs (arrays of shape
+    (x, y, n)), so that the full volume never has to be in memory. The slabs
+    are cast to `dtype` and written as stored values with the given
+    (slope, inter) `scaling`; `header` provides the remaining header fields.
+    """
+    dtype = np.dtype(dtype)
+
+    def blocks():
+        yield _slab_header(header, affine, shape, dtype, scaling)
+        for slab in slabs:
+            yield np.asarray(slab, dtype=dtype).tobytes(order="F")
+
+    path = Path(path)
+    with open(path, "wb") as f:
+        if path.name.endswith(".gz"):
+            _write_gzip_stream(f, blocks(), level=gzip_level(temporary), threads=io_threads())
+        else:
+            for block in blocks():
+                f.write(block)
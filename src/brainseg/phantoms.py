@@ -0,0 +1,178 @@
+"""
+Synthetic head phantoms: nested ellipsoids for scalp, skull, CSF, a folded
+cortex with parcels, white matter, ventricles and thalami. Used by the
+benchmarks (make_phantom writes label maps, T1/T2 images and masks at a given
+voxel size) and by the stand-in container runtime (see brainseg.standin),
+which derives the labels of its outputs from the grid of the input image.
+"""
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from brainseg.nifti_io import save_slabs
+from brainseg.remap import lookup, translation_table
+
+# Field of view of the phantoms in mm
+FOV_MM = (160, 192, 160)
+# Radii of the brain ellipsoid in mm; the head extends HEAD_MM beyond it
+BRAIN_RADII_MM = (66, 82, 62)
+HEAD_MM = 12
+SLAB_MM = 8
+PARCELS_PER_HEMISPHERE = 31
+
+# Tissue classes of the phantom
+BACKGROUND, SCALP, SKULL, CSF, CORTEX, WHITE_MATTER, VENTRICLE, THALAMUS = range(8)
+# FreeSurfer labels per tissue class in the left and right hemisphere
+FREESURFER_LEFT = np.array([0, 0, 0, 24, 3, 2, 4, 10], dtype=np.uint8)
+FREESURFER_RIGHT = np.array([0, 0, 0, 24, 42, 41, 43, 49], dtype=np.uint8)
+SIMNIBS_LABELS = np.array([0, 5, 4, 3, 2, 1, 3, 2], dtype=np.uint8)
+# Mean intensities per tissue class
+T1_INTENSITY = np.array([0, 90, 20, 30, 75, 110, 30, 85], dtype=np.float32)
+T2_INTENSITY = np.array([0, 60, 10, 200, 110, 80, 200, 95], dtype=np.float32)
+NOISE = 3.0
+
+PHANTOM_FILES = [
+    "labels", "gouhfi_seg", "gouhfi_parc", "t1_head", "t1_stripped", "t2_stripped",
+    "brain_mask", "csf_mask",
+]
+
+
+def _ellipsoid(x, y, z, center, radii):
+    return (((x - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2
+            + ((z - center[2]) / radii[2]) ** 2) <= 1
+
+
+def phantom_grid(voxel_size, fov_mm=FOV_MM):
+    """Shape and affine of a phantom with isotropic `voxel_size` (mm) covering `fov_mm`."""
+    shape = tuple(int(round(f / voxel_size)) for f in fov_mm)
+    affine = np.diag([voxel_size] * 3 + [1.0])
+    affine[:3, 3] = [-f / 2 for f in fov_mm]
+    return shape, affine
+
+
+def _slab_step(zooms):
+    return max(1, int(round(SLAB_MM / zooms[2])))
+
+
+def tissue_map(shape, zooms):
+    """
+    Returns the tissue classes (uint8, see above) and the cortical parcel of
+    every cortex voxel (GOUHFI cortex labels, 0 elsewhere) of a phantom on a
+    voxel grid of `shape` and voxel sizes `zooms` (mm), centered in the grid.
+    The left hemisphere is the lower half of the first axis.
+    """
+    x, y = np.meshgrid(*(np.arange(n, dtype=np.float32) * d - n * d / 2
+                         for n, d in zip(shape[:2], zooms[:2])), indexing="ij")
+    x, y = x[..., None], y[..., None]
+
+    tissue = np.zeros(shape, dtype=np.uint8)
+    parcels = np.zeros(shape, dtype=np.uint8)
+    slab = _slab_step(zooms)
+    mean_radius = np.mean(BRAIN_RADII_MM)
+    for z0 in range(0, shape[2], slab):
+        z = (np.arange(z0, min(z0 + slab, shape[2]), dtype=np.float32) * zooms[2]
+             - shape[2] * zooms[2] / 2)[None, None, :]
+        r = np.sqrt((x / BRAIN_RADII_MM[0]) ** 2 + (y / BRAIN_RADII_MM[1]) ** 2
+                    + (z / BRAIN_RADII_MM[2]) ** 2)
+        # Approximate depth below the brain surface in mm
+        depth = (1 - r) * mean_radius
+        # Gyri: the grey/white boundary is folded with a period of ~12 mm
+        folding = 2 * np.sin(x / 4) * np.sin(y / 4) * np.sin(z / 4)
+
+        t = np.full(depth.shape, BACKGROUND, dtype=np.uint8)
+        t[depth > -HEAD_MM] = SCALP
+        t[depth > -HEAD_MM / 2] = SKULL
+        t[depth > 0] = CSF
+        t[depth > 2] = CORTEX
+        t[depth > 5 + folding] = WHITE_MATTER
+        # Interhemispheric fissure
+        t[(np.abs(x) < 1) & (depth > 0) & (depth < 30)] = CSF
+        for side in (-1, 1):
+            t[_ellipsoid(x, y, z, (side * 9, 5, 8), (5, 18, 7))] = VENTRICLE
+            t[_ellipsoid(x, y, z, (side * 10, -10, 0), (8, 12, 7))] = THALAMUS
+        tissue[..., z0:z0 + slab] = t
+
+        # Cortical parcels: sectors of the azimuth and elevation per hemisphere
+        azimuth = (np.arctan2(y, np.abs(x) + 1e-3) / np.pi + 0.5)
+        elevation = np.clip(z / BRAIN_RADII_MM[2] * 0.5 + 0.5, 0, 1)
+        parcel = (azimuth * 6).astype(np.uint8) * 5 + np.minimum(elevation * 5, 4).astype(np.uint8)
+        parcel = np.minimum(parcel, PARCELS_PER_HEMISPHERE - 1) + 1
+        parcel = np.where(x > 0, parcel + PARCELS_PER_HEMISPHERE, parcel).astype(np.uint8)
+        parcels[..., z0:z0 + slab] = np.where(t == CORTEX, parcel, 0)
+    return tissue, parcels
+
+
+def freesurfer_labels(tissue, parcels=None):
+    """
+    FreeSurfer labels of a tissue map. With `parcels`, the cortex is labeled
+    with the DKT parcels (ctx-lh-*/ctx-rh-*) instead.
+    """
+    midline = tissue.shape[0] // 2
+    labels = FREESURFER_LEFT[tissue]
+    labels[midline:] = FREESURFER_RIGHT[tissue[midline:]]
+    if parcels is None:
+        return labels
+    parc_table = translation_table("gouhfi-cortex", "freesurfer")
+    labels = labels.astype(np.result_type(labels, parc_table))
+    cortex = parcels > 0
+    labels[cortex] = parc_table[parcels[cortex]]
+    return labels
+
+
+def gouhfi_labels(tissue):
+    """GOUHFI labels of a tissue map."""
+    return lookup(translation_table("freesurfer", "gouhfi"), freesurfer_labels(tissue))
+
+
+def simnibs_labels(tissue):
+    """SimNIBS (charm) tissue labels of a tissue map."""
+    return SIMNIBS_LABELS[tissue]
+
+
+def _slabs(tissue, zooms, func):
+    slab = _slab_step(zooms)
+    for z0 in range(0, tissue.shape[2], slab):
+        yield func(z0, tissue[..., z0:z0 + slab])
+
+
+def _intensity(table, seed, stripped):
+    def func(z0, t):
+        rng = np.random.default_rng([seed, z0])
+        data = table[t] + rng.normal(0, NOISE, t.shape).astype(np.float32)
+        data = np.clip(data, 0, None)
+        if stripped:
+            data[t < CSF] = 0
+        return np.rint(data)
+    return func
+
+
+def make_phantom(directory, voxel_size, fov_mm=FOV_MM, seed=0):
+    """
+    Writes a phantom at `voxel_size` mm to `directory` and returns the paths of
+    its images by name (see PHANTOM_FILES): FreeSurfer labels, the GOUHFI
+    segmentation and cortical parcellation, a T1 with skull, skull-stripped T1
+    and T2, the brain mask and the CSF mask (CSF and ventricles). The images
+    are written slab by slab.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    shape, affine = phantom_grid(voxel_size, fov_mm)
+    tissue, parcels = tissue_map(shape, (voxel_size,) * 3)
+    images = {
+        "labels": (lambda z0, t: freesurfer_labels(t), np.uint8),
+        "gouhfi_seg": (lambda z0, t: gouhfi_labels(t), np.uint8),
+        "gouhfi_parc": (lambda z0, t: parcels[..., z0:z0 + t.shape[2]], np.uint8),
+        "t1_head": (_intensity(T1_INTENSITY, seed, stripped=False), np.int16),
+        "t1_stripped": (_intensity(T1_INTENSITY, seed, stripped=True), np.int16),
+        "t2_stripped": (_intensity(T2_INTENSITY, seed + 1, stripped=True), np.int16),
+        "brain_mask": (lambda z0, t: t >= CSF, np.uint8),
+        "csf_mask": (lambda z0, t: (t == CSF) | (t == VENTRICLE), np.uint8),
+    }
+    paths = {}
+    for name, (func, dtype) in images.items():
+        paths[name] = directory / f"{name}.nii.gz"
+        header = nib.Nifti1Header()
+        header.set_xyzt_units("mm")
+        save_slabs(_slabs(tissue, (voxel_size,) * 3, func), paths[name], shape, dtype, affine,
+                   header=header)
+    return paths
+
@@ -0,0 +1,125 @@
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+_manifest_lock = threading.Lock()
+
+
+def run_dag(steps, max_workers=None):
+    """
+    Runs a pipeline expressed as a dependency graph. `steps` maps a step name
+    to a tuple (function, [names of the steps it depends on]). Every step starts
+    as soon as all its dependencies are done, so independent steps run
+    concurrently. The steps run in threads: they either wait on a container
+    or spend their time in numpy/ITK code that releases the GIL. Each step runs
+    in a copy of the caller's context, so that e.g. its run report steps nest
+    under the caller's (see brainseg.report).
+    If a step fails, no further steps are started and the error is re-raised
+    once the running steps have finished.
+    """
+    for name, (_, deps) in steps.items():
+        unknown = [d for d in deps if d not in steps]
+        if unknown:
+            raise ValueError(f"Step '{name}' depends on unknown steps: {unknown}")
+
+    done = set()
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(steps)) as executor:
+        while len(done) < len(steps):
+            if error is None:
+                for name, (func, deps) in steps.items():
+                    if name in done or name in running.values():
+                        continue
+                    if all(d in done for d in deps):
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, func)] = name
+            if not running:
+                if error is not None:
+                    raise error
+                raise ValueError("The pipeline contains a dependency cycle.")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc is not None and error is None:
+                    error = exc
+                done.add(name)
+
+            if error is not None and not running:
+                raise error
+
+
+def step_key(*parts):
+    """
+    Key of a pipeline step, derived from its parameters and the keys of the
+    steps (or digests of the input files) it depends on. Changing an input
+    therefore changes the keys of all steps downstream of it.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest(workdir):
+    """Reads the step manifest of a work directory."""
+    manifest_path = Path(workdir) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text())
+
+
+def _record_step(workdir, name, entry):
+    with _manifest_lock:
+        manifest = load_manifest(workdir)
+        manifest[name] = entry
+        tmp_path = Path(workdir) / f".{MANIFEST_NAME}.tmp"
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, Path(workdir) / MANIFEST_NAME)
+
+
+def _file_signature(path):
+    stat = Path(path).stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def checkpointed(workdir, name, key, outputs, func, inputs=(), digests=None):
+    """
+    Wraps a pipeline step so that it is skipped if the manifest in `workdir`
+    records it as completed with the same key, all its outputs still exist and
+    its input files are unchanged since (so a re-run of an upstream step also
+    re-runs everything downstream of it). `digests` of the external input
+    images are recorded in the manifest for reference.
+    """
+    def run():
+        entry = load_manifest(workdir).get(name)
+        if (
+            entry
+            and entry["key"] == key
+            and all(Path(o).exists() for o in outputs)
+            and all(
+                Path(i).exists() and entry["inputs"].get(str(i)) == _file_signature(i)
+                for i in inputs
+            )
+        ):
+            print(f"\n--- Skipping {name}: up to date in {workdir} ---")
+            return
+        func()
+        if entry:
+            # Remove the intermediates of the superseded run of this step
+            for old_output in set(entry["outputs"]) - {str(o) for o in outputs}:
+                if Path(workdir).resolve() in Path(old_output).resolve().parents:
+                    Path(old_output).unlink(missing_ok=True)
+        _record_step(workdir, name, {
+            "key": key,
+            "outputs": [str(o) for o in outputs],
+            "inputs": {str(i): _file_signature(i) for i in inputs},
+            "digests": digests or {},
+            "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return run
@@ -1,7 +1,31 @@
+import functools
+import hashlib
+import os
 import nibabel as nib
 import fastremap
 import numpy as np
 import sys
+from importlib import resources
+from pathlib import Path
+import brainseg.data
+from brainseg.cache import cache_dir
+from brainseg.utils import as_image
+from brainseg.nifti_io import save_image, save_slabs
+from brainseg.slabs import iter_slabs, use_slabs
+from brainseg.report import instrumented
+
+# Label schemas shipped with brainseg, usable by name instead of a txt file
+SCHEMAS = {
+    "freesurfer": "freesurfer-label-list-lut.txt",
+    "freesurfer-full": "freesurfer-label-list-full-lut.txt",
+    "freesurfer-reduced": "freesurfer-label-list-reduced-lut.txt",
+    "gouhfi": "gouhfi-label-list-lut.txt",
+    "gouhfi-cortex": "gouhfi-label-list-cortex-lut.txt",
+    "simnibs": "simnibs-label-list-lut.txt",
+}
+# Version of the cached translation tables, to be increased whenever
+# compile_table or the format of the stored tables changes
+TABLE_FORMAT = 1
 
 def load_label_map(file_path):
     """Parses the txt file to create a dictionary of {name: id}."""
@@ -23,26 +47,148 @@ def load_label_map(file_path):
         print(f"Error: Label file not found at {file_path}")
         sys.exit(1)
 
-def remap(img, old_labels, new_labels):
-    mapping = {}
-    data = img.get_fdata().astype(np.int32)
+def label_data(img):
+    """
+    Returns the label array of an image in its native integer dtype, without
+    the float64 copy of get_fdata(). Labels stored as floats are rounded to int32.
+    """
+    return as_labels(np.asanyarray(img.dataobj))
+
+def as_labels(data):
+    """Returns a label array as integers, rounding labels stored as floats."""
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int32)
+    elif not data.dtype.isnative:
+        # e.g. .mgz files, which are stored big-endian
+        data = data.astype(data.dtype.newbyteorder("="))
+    return data
+
+def label_dtype(labels):
+    """Smallest integer dtype that holds all label ids of a label map."""
+    ids = list(labels.values()) + [0]
+    return np.result_type(np.min_scalar_type(min(ids)), np.min_scalar_type(max(ids)))
 
+def compile_table(old_labels, new_labels):
+    """
+    Compiles the name-based mapping between two label maps into a dense lookup
+    array: table[old_id] is the new id. Labels without a counterpart in the
+    new schema (and ids that aren't part of the old schema) map to 0 (Background).
+    """
+    table = np.zeros(max(list(old_labels.values()) + [0]) + 1, dtype=label_dtype(new_labels))
     for name, old_id in old_labels.items():
-        if name in new_labels:
-            mapping[old_id] = new_labels[name]
-        else:
-            # Default missing labels to 0 (Background)
-            mapping[old_id] = 0
-
-    remapped_data = fastremap.remap(data, mapping)
-    
+        table[old_id] = new_labels.get(name, 0)
+    return table
+
+def schema_path(schema):
+    """Resolves a schema name from SCHEMAS or a path to a label txt file."""
+    if schema in SCHEMAS:
+        return resources.files(brainseg.data).joinpath(SCHEMAS[schema])
+    return Path(schema)
+
+@functools.lru_cache(maxsize=None)
+def _schema_labels(schema):
+    return load_label_map(schema_path(schema))
+
+@functools.lru_cache(maxsize=None)
+def translation_table(*schemas):
+    """
+    Returns the lookup array translating labels through a chain of schemas,
+    e.g. translation_table("gouhfi", "freesurfer", "freesurfer-reduced").
+    Each step maps by label name; the steps are composed into a single table,
+    so the translation is applied to the image in one pass. Tables are cached
+    in memory and in <cache_dir>/labels, keyed by TABLE_FORMAT and the names
+    and contents of the label files.
+    """
+    if len(schemas) < 2:
+        raise ValueError("A translation needs a source and a target schema.")
+
+    h = hashlib.sha256(f"translation_table:{TABLE_FORMAT}".encode())
+    for schema in schemas:
+        contents = schema_path(schema).read_bytes()
+        # Length-prefixed, so that no two chains of schemas hash the same input
+        h.update(f"\0{schema}\0{len(contents)}\0".encode())
+        h.update(contents)
+    table_path = cache_dir() / "labels" / f"{h.hexdigest()}.npy"
+    if table_path.exists():
+        table = np.load(table_path)
+        table.flags.writeable = False
+        return table
+
+    table = compile_table(_schema_labels(schemas[0]), _schema_labels(schemas[1]))
+    for old, new in zip(schemas[1:-1], schemas[2:]):
+        table = compile_table(_schema_labels(old), _schema_labels(new))[table]
+
+    table_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = table_path.with_name(f".{table_path.stem}.{os.getpid()}.npy")
+    np.save(tmp_path, table)
+    os.replace(tmp_path, table_path)
+    table.flags.writeable = False
+    return table
+
+def _fit_table(table, data):
+    """Extends the table with zeros so that it covers all labels in data."""
+    min_label, max_label = fastremap.minmax(data)
+    if min_label is not None and min_label < 0:
+        print(f"Error: Negative label {min_label} can't be remapped.")
+        sys.exit(1)
+    if max_label is not None and max_label >= len(table):
+        table = np.concatenate([table, np.zeros(int(max_label) + 1 - len(table), table.dtype)])
+    return table
+
+def lookup(table, labels):
+    """Applies a lookup table to a label array (labels beyond the table map to 0)."""
+    return _fit_table(table, labels)[labels]
+
+def apply_table(img, table, inplace=False):
+    """
+    Applies a lookup array from compile_table/translation_table to the labels of
+    an image (nibabel image or path) and returns the remapped image in the dtype
+    of the table. With `inplace`, the label array of `img` is overwritten with
+    the result if it already has that dtype (for images loaded from disk, this
+    saves a full copy of the volume).
+    """
+    img = as_image(img)
+    data = label_data(img)
+    table = _fit_table(table, data)
+
+    if inplace and data.dtype == table.dtype and data.ndim > 2:
+        # Slab-wise, so that the temporary index result stays small
+        for z in range(0, data.shape[-1], 16):
+            data[..., z:z + 16] = table[data[..., z:z + 16]]
+        remapped_data = data
+    else:
+        remapped_data = table[data]
+
     return nib.Nifti1Image(remapped_data, img.affine)
 
-def remap_file(infile, old_label_txt, new_label_txt, outfile):
+def translate(img, *schemas, inplace=False):
+    """Translates the labels of an image through a chain of schemas, see translation_table."""
+    return apply_table(img, translation_table(*(str(s) for s in schemas)), inplace=inplace)
+
+def remap(img, old_labels, new_labels, inplace=False):
+    """
+    Maps the labels of an image (nibabel image or path) from one schema to
+    another by label name and returns the remapped image, stored in the
+    smallest dtype that fits the new schema.
+    """
+    return apply_table(img, compile_table(old_labels, new_labels), inplace=inplace)
+
+@instrumented
+def remap_file(infile, old_label_txt, new_label_txt, outfile, inplace=False, via=()):
+    """
+    Remaps a label file between two schemas (names from SCHEMAS or label txt
+    files), optionally through the intermediate schemas `via`. Very large
+    volumes are remapped slab by slab, see brainseg.slabs.
+    """
     img = nib.load(infile)
-    
-    old_labels = load_label_map(old_label_txt)
-    new_labels = load_label_map(new_label_txt)
-    
-    new_img = remap(img, old_labels, new_labels)
-    nib.save(new_img, outfile)
\ No newline at end of file
+    table = translation_table(*(str(s) for s in (old_label_txt, *via, new_label_txt)))
+    if use_slabs(img):
+        def remapped_slabs():
+            for _, _, (data,) in iter_slabs(img):
+                labels = as_labels(data)
+                yield lookup(table, labels)
+
+        save_slabs(remapped_slabs(), outfile, img.shape, table.dtype, img.affine, header=img.header)
+        return
+    new_img = apply_table(img, table, inplace=inplace)
+    save_image(new_img, outfile)
@@ -0,0 +1,208 @@
+import contextvars
+import csv
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Steps recorded in this process since the last start_report(). Every step is a
+# dict with the fields below; container calls made while a step runs are added
+# to that step, see record_container(). The running steps are kept in a context
+# variable, so threads that run in a copy of the caller's context (see
+# brainseg.pipeline.run_dag) nest their steps under the caller's. Steps are only
+# kept while a report is being recorded, so that runs without a report don't
+# accumulate them.
+STEP_FIELDS = [
+    "step", "parent", "status", "wall_seconds", "cpu_seconds", "host_peak_rss_mb",
+    "container_calls", "container_seconds", "container_cpu_seconds", "container_peak_rss_mb",
+    "container_read_bytes", "container_write_bytes", "input_bytes", "output_bytes",
+]
+_steps = []
+_state = {"recording": False}
+_lock = threading.Lock()
+# The running steps, innermost last
+_running = contextvars.ContextVar("brainseg_report_steps", default=())
+
+
+def start_report():
+    """
+    Starts recording the steps of a run report, discarding the steps recorded
+    so far, e.g. at the start of a subject.
+    """
+    with _lock:
+        _steps.clear()
+        _state["recording"] = True
+
+
+def stop_report():
+    """Stops recording steps and discards the recorded ones."""
+    with _lock:
+        _steps.clear()
+        _state["recording"] = False
+
+
+def collect_steps():
+    """Returns the steps recorded since the last start_report()."""
+    with _lock:
+        return [dict(s) for s in _steps]
+
+
+def _file_bytes(paths):
+    return sum(Path(p).stat().st_size for p in paths if Path(p).is_file())
+
+
+def _rss_mb(maxrss_kb):
+    # ru_maxrss is in kilobytes on Linux
+    return maxrss_kb / 1024
+
+
+@contextmanager
+def step(name, inputs=(), outputs=()):
+    """
+    Records a step: wall time, CPU time of the host process (shared by steps
+    running concurrently), peak RSS of the host process so far, the time, CPU
+    time, peak RSS and block I/O of the container calls made in the step, and
+    the sizes of its input and output files.
+    """
+    stack = _running.get()
+    entry = {field: 0 for field in STEP_FIELDS}
+    entry.update(step=name, parent=stack[-1]["step"] if stack else "", status="ok")
+    entry["input_bytes"] = _file_bytes(inputs)
+    token = _running.set((*stack, entry))
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield entry
+    except BaseException:
+        entry["status"] = "failed"
+        raise
+    finally:
+        _running.reset(token)
+        entry["wall_seconds"] = time.perf_counter() - start
+        entry["cpu_seconds"] = time.process_time() - cpu_start
+        entry["host_peak_rss_mb"] = _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        entry["output_bytes"] = _file_bytes(outputs)
+        with _lock:
+            if stack:
+                # Container calls of a nested step also count for the enclosing
+                # one, which may have other nested steps running in other threads
+                parent = stack[-1]
+                for field in ["container_calls", "container_seconds", "container_cpu_seconds",
+                              "container_read_bytes", "container_write_bytes"]:
+                    parent[field] += entry[field]
+                parent["container_peak_rss_mb"] = max(parent["container_peak_rss_mb"],
+                                                      entry["container_peak_rss_mb"])
+            if _state["recording"]:
+                _steps.append(entry)
+
+
+def instrumented(func):
+    """Decorator recording every call of `func` as a step named after it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with step(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def recorded(name, func, inputs=(), outputs=()):
+    """Wraps `func` (without arguments) so that every call is recorded as step `name`."""
+    def run():
+        with step(name, inputs=inputs, outputs=outputs):
+            return func()
+    return run
+
+
+def record_container(description, seconds, rusage):
+    """
+    Adds a finished container call (its wall time and the resource usage of
+    the container process tree from os.wait4) to the running step. Calls made
+    outside of a step are recorded as a step of their own.
+    """
+    stack = _running.get()
+    with _lock:
+        if stack:
+            entry = stack[-1]
+        else:
+            entry = {field: 0 for field in STEP_FIELDS}
+            entry.update(step=description, parent="", status="ok", wall_seconds=seconds)
+            if _state["recording"]:
+                _steps.append(entry)
+        entry["container_calls"] += 1
+        entry["container_seconds"] += seconds
+        entry["container_cpu_seconds"] += rusage.ru_utime + rusage.ru_stime
+        entry["container_peak_rss_mb"] = max(entry["container_peak_rss_mb"],
+                                             _rss_mb(rusage.ru_maxrss))
+        # Block counts are in 512 byte units
+        entry["container_read_bytes"] += rusage.ru_inblock * 512
+        entry["container_write_bytes"] += rusage.ru_oublock * 512
+
+
+def write_report(path, steps, subject="", tool=""):
+    """
+    Writes the steps of a run as JSON (a dict with the subject, the tool and the
+    list of steps) or, for paths ending in .csv, as one CSV row per step.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = [{"subject": subject, "tool": tool, **s} for s in steps]
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if path.suffix == ".csv":
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["subject", "tool", *STEP_FIELDS])
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        tmp_path.write_text(json.dumps({"subject": subject, "tool": tool, "steps": steps},
+                                       indent=2))
+    os.replace(tmp_path, path)
+
+
+def read_report(path):
+    """Reads a JSON or CSV run report as a list of step rows with subject and tool."""
+    path = Path(path)
+    if path.suffix == ".csv":
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            for field in STEP_FIELDS:
+                if field not in ["step", "parent", "status"]:
+                    row[field] = float(row[field])
+        return rows
+    report = json.loads(path.read_text())
+    return [{"subject": report["subject"], "tool": report["tool"], **s} for s in report["steps"]]
+
+
+def merge_reports(paths, output_path=None):
+    """
+    Merges the run reports of a batch into one table (written to `output_path`
+    as CSV if given) and prints, per step, the number of runs, the mean and
+    maximum wall time and the peak memory of the host and the containers.
+    """
+    rows = [row for path in paths for row in read_report(path)]
+    if output_path is not None:
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["subject", "tool", *STEP_FIELDS])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    by_step = {}
+    for row in rows:
+        by_step.setdefault(row["step"], []).append(row)
+    print(f"{'step':<40} {'runs':>5} {'mean [s]':>9} {'max [s]':>9} "
+          f"{'host MB':>8} {'container MB':>12}")
+    # Steps with the longest total wall time first
+    totals = {name: sum(r["wall_seconds"] for r in step_rows)
+              for name, step_rows in by_step.items()}
+    for name, step_rows in sorted(by_step.items(), key=lambda s: -totals[s[0]]):
+        wall = [r["wall_seconds"] for r in step_rows]
+        print(f"{name[:40]:<40} {len(step_rows):>5} {sum(wall) / len(wall):9.1f} {max(wall):9.1f} "
+              f"{max(r['host_peak_rss_mb'] for r in step_rows):8.0f} "
+              f"{max(r['container_peak_rss_mb'] for r in step_rows):12.0f}")
+    return rows
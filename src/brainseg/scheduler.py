@@ -0,0 +1,153 @@
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+# Approximate resources a single run of each tool needs. `cpus` is also the
+# thread count handed to the tool, `mem_gb` its peak memory on a ~0.7mm T1.
+TOOL_COSTS = {
+    "synthseg": {"cpus": 8, "mem_gb": 8},
+    "fastsurfer": {"cpus": 8, "mem_gb": 10},
+    "gouhfi": {"cpus": 4, "mem_gb": 12},
+    "simnibs": {"cpus": 4, "mem_gb": 16},
+    "synthstrip": {"cpus": 2, "mem_gb": 4},
+    "hybrid_gouhfi_T2": {"cpus": 4, "mem_gb": 14},
+}
+# Thread pools of the numerical libraries (OpenMP, BLAS, ANTs/ITK) in the host
+# processes, sized when a library is first loaded
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+]
+
+
+def available_cores():
+    """Number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_gb():
+    """Total physical memory of the node in GB."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    except (ValueError, OSError, AttributeError):
+        return 16.0
+
+
+def plan_concurrency(tool, cores=None, mem_gb=None, max_jobs=None):
+    """
+    Sizes the process pool from the total core/memory budget and the cost
+    profile of `tool`. Returns (number of concurrent jobs, threads per job).
+    """
+    cores = cores or available_cores()
+    mem_gb = mem_gb or available_memory_gb()
+    cost = TOOL_COSTS.get(tool, {"cpus": 1, "mem_gb": 4})
+
+    threads = max(1, min(cost["cpus"], cores))
+    n_jobs = max(1, min(cores // threads, int(mem_gb // cost["mem_gb"])))
+    if max_jobs is not None:
+        n_jobs = max(1, min(n_jobs, max_jobs))
+    return n_jobs, threads
+
+
+@contextmanager
+def thread_limits(threads):
+    """
+    Limits the thread pools of the processes started in the block (e.g. the
+    workers of a process pool) through the environment, which is restored on exit.
+    """
+    previous = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(threads):
+    """
+    Limits the thread pools that a forked worker inherited already loaded
+    from the parent, which don't read the environment again.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+def _run_job(job, threads):
+    """
+    Runs a single job in a worker process. Errors, including the
+    sys.exit() of a failed container call, are caught and reported
+    back, so that one failing subject does not abort the whole batch.
+    If the job asks for a report, the steps of its run report are returned
+    with the result.
+    """
+    import brainseg.tools
+    from brainseg.report import collect_steps, start_report, step, stop_report
+
+    run_tool = getattr(brainseg.tools, f"run_{job['tool']}")
+    start = time.time()
+    # Workers are reused across jobs, and forked ones inherit the state of the parent
+    if job.get("report"):
+        start_report()
+    else:
+        stop_report()
+    try:
+        with step(job["tool"]):
+            run_tool(*job["args"], threads=threads, **job.get("kwargs", {}))
+        status, error = "ok", None
+    except SystemExit as e:
+        status, error = "failed", f"exited with code {e.code}"
+    except Exception:
+        status, error = "failed", traceback.format_exc()
+    return {
+        "name": job["name"],
+        "status": status,
+        "error": error,
+        "seconds": time.time() - start,
+        "steps": collect_steps(),
+    }
+
+
+def run_jobs(jobs, tool, cores=None, mem_gb=None, max_jobs=None):
+    """
+    Runs a list of jobs concurrently in a process pool. Each job is a dict with
+    the keys 'name', 'tool', 'args' (positional arguments of the run_<tool>
+    function) and optionally 'kwargs' and 'report' (return the steps of the
+    job's run report). Returns one result dict per job.
+    """
+    n_jobs, threads = plan_concurrency(tool, cores=cores, mem_gb=mem_gb, max_jobs=max_jobs)
+    print(f"Scheduling {len(jobs)} {tool} jobs: {n_jobs} concurrent, {threads} threads each")
+
+    results = []
+    # The host-side steps of the jobs (ANTs/ITK, numpy) use `threads` threads each
+    with thread_limits(threads), ProcessPoolExecutor(
+        max_workers=n_jobs, initializer=_init_worker, initargs=(threads,)
+    ) as executor:
+        futures = {executor.submit(_run_job, job, threads): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed by the OOM killer)
+                result = {"name": job["name"], "status": "failed", "error": repr(e),
+                          "seconds": None, "steps": []}
+            print(f"[{len(results) + 1}/{len(jobs)}] {result['name']}: {result['status']}")
+            results.append(result)
+
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"\n{len(results) - len(failed)} of {len(results)} jobs succeeded.")
+    for r in failed:
+        print(f"  {r['name']} failed: {r['error']}")
+    return results
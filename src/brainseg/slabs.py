@@ -0,0 +1,64 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from nibabel.arrayproxy import ArrayProxy
+
+# Out-of-core execution of voxel-wise operations, configurable through the environment:
+# BRAINSEG_SLAB_THRESHOLD_MB  volumes whose float64 size exceeds this are processed
+#                             slab-wise (default 2048, 0 processes all volumes slab-wise)
+# BRAINSEG_SLAB_MB            memory budget of a single slab (default 256)
+
+
+def use_slabs(*images):
+    """
+    Whether voxel-wise operations on `images` should run slab by slab: only
+    for 3D images read from disk whose float64 size exceeds the threshold.
+    """
+    threshold = float(os.environ.get("BRAINSEG_SLAB_THRESHOLD_MB", 2048)) * 1024**2
+    for img in images:
+        if len(img.shape) != 3 or not nib.is_proxy(img.dataobj) or img.get_filename() is None:
+            return False
+    return max(np.prod(img.shape) * 8 for img in images) > threshold
+
+
+def slab_size(img):
+    """Number of z-slices per slab, from the BRAINSEG_SLAB_MB budget (float64)."""
+    budget = float(os.environ.get("BRAINSEG_SLAB_MB", 256)) * 1024**2
+    slice_bytes = img.shape[0] * img.shape[1] * 8
+    return int(max(1, min(img.shape[2], budget // slice_bytes)))
+
+
+def _streaming_proxy(img, scaled=True):
+    # Compressed files are re-opened for every slice unless the handle is
+    # kept open, which would decompress the file from the start for each slab
+    proxy = img.dataobj
+    slope, inter = (proxy.slope, proxy.inter) if scaled else (1.0, 0.0)
+    return ArrayProxy(
+        img.get_filename(),
+        (proxy.shape, proxy.dtype, proxy.offset, slope, inter),
+        order=proxy.order,
+        keep_file_open=img.get_filename().endswith(".gz"),
+    )
+
+
+def iter_slabs(*images, size=None, scaled=True):
+    """
+    Yields (z0, z1, slabs) for the z-slabs of one or more images with the same
+    shape, where `slabs` holds the data of each image in its stored dtype (with
+    scaling applied, unless scaled=False). Uncompressed files are memory-mapped,
+    compressed files are decompressed incrementally, so only one slab per image
+    is held in memory.
+    """
+    proxies = [_streaming_proxy(img, scaled=scaled) for img in images]
+    size = size or slab_size(images[0])
+    for z0 in range(0, images[0].shape[2], size):
+        z1 = min(z0 + size, images[0].shape[2])
+        yield z0, z1, [np.asanyarray(proxy[:, :, z0:z1]) for proxy in proxies]
+
+
+def scaling(img):
+    """(slope, inter) of the stored data of an image, (1, 0) if it isn't scaled."""
+    slope = getattr(img.dataobj, "slope", 1.0)
+    inter = getattr(img.dataobj, "inter", 0.0)
+    return float(slope), float(inter)
@@ -0,0 +1,309 @@
+"""
+Local stand-in for the container runtime, selected with BRAINSEG_RUNTIME=standin
+(or `--runtime standin`). It takes apptainer's command line (exec, run, build,
+instance start/stop), and instead of running the tools it writes the files
+the tools would produce, with phantom labels on the grid of the input (see
+brainseg.phantoms), after a configurable latency:
+
+* BRAINSEG_STANDIN_LATENCY: seconds per container start (default 0); calls in
+  a warm instance pay it once, when the instance starts
+* BRAINSEG_STANDIN_SUBJECT_LATENCY: seconds per processed image (default 0)
+
+Like a container, the stand-in only sees bound paths: reading or writing a
+path that isn't bound, or writing to a read-only bind, fails the call. This
+allows benchmarking and testing batching, scheduling, caching and staging
+without GPUs, network access or container images.
+"""
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from brainseg.utils import SIF_MAGIC, SIF_MAGIC_OFFSET
+
+# Commands of the tool scripts that need no emulation
+NOOP_COMMANDS = {"echo", "mkdir", "trap", "export", "true"}
+
+
+def latency(name, default=0.0):
+    return float(os.environ.get(name, default))
+
+
+def state_dir():
+    """Directory of the running stand-in instances ($BRAINSEG_STANDIN_STATE_DIR)."""
+    default = Path(tempfile.gettempdir()) / f"brainseg_standin_{os.getuid()}"
+    return Path(os.environ.get("BRAINSEG_STANDIN_STATE_DIR", default))
+
+
+def parse_bind(spec):
+    """Parses an apptainer bind 'host[:container[:options]]' into (host, container, read_only)."""
+    parts = spec.split(":")
+    host = parts[0]
+    container = parts[1] if len(parts) > 1 else host
+    read_only = len(parts) > 2 and "ro" in parts[2].split(",")
+    return host, container, read_only
+
+
+def parse_options(args):
+    """Splits leading apptainer options (binds, environment) from the remaining arguments."""
+    binds, env = [], {}
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        if args[i] in ["--bind", "-B"]:
+            binds += [parse_bind(spec) for spec in args[i + 1].split(",")]
+            i += 2
+        elif args[i] == "--env":
+            key, value = args[i + 1].split("=", 1)
+            env[key] = value
+            i += 2
+        else:
+            # Flags without a value, e.g. --cleanenv
+            i += 1
+    return binds, env, args[i:]
+
+
+class Container:
+    """The view of the file system of a stand-in container: its binds and working directory."""
+
+    def __init__(self, binds):
+        # Longest container paths first, so that nested binds win
+        self.binds = sorted(binds, key=lambda b: len(b[1]), reverse=True)
+        self.cwd = "/"
+
+    def host_path(self, path, write=False):
+        """Host path of a path in the container, following symlinks to bound files."""
+        path = os.path.normpath(os.path.join(self.cwd, str(path)))
+        for host, container, read_only in self.binds:
+            if path == container or path.startswith(container.rstrip("/") + "/"):
+                if write and read_only:
+                    sys.exit(f"standin: {path}: Read-only file system")
+                host_path = Path(host) / os.path.relpath(path, container)
+                if not write and host_path.is_symlink():
+                    # Links (e.g. staged inputs) resolve inside the container
+                    return self.host_path(os.readlink(host_path))
+                return host_path
+        sys.exit(f"standin: {path}: No such file or directory (not bound into the container)")
+
+    def read(self, path):
+        host_path = self.host_path(path)
+        if not host_path.exists():
+            sys.exit(f"standin: {path}: No such file or directory")
+        return host_path
+
+    def write(self, path):
+        host_path = self.host_path(path, write=True)
+        host_path.parent.mkdir(parents=True, exist_ok=True)
+        return host_path
+
+
+def _labels_for(input_path, kind, parcellation=False):
+    """Phantom labels (and the affine) on the grid of the input image."""
+    import nibabel as nib
+    from brainseg import phantoms
+
+    img = nib.load(input_path)
+    shape, zooms = img.shape[:3], img.header.get_zooms()[:3]
+    tissue, parcels = phantoms.tissue_map(shape, zooms)
+    if kind == "freesurfer":
+        data = phantoms.freesurfer_labels(tissue, parcels if parcellation else None)
+    elif kind == "gouhfi":
+        data = phantoms.gouhfi_labels(tissue)
+    elif kind == "gouhfi-cortex":
+        data = parcels
+    elif kind == "simnibs":
+        data = phantoms.simnibs_labels(tissue)
+    else:
+        data = tissue
+    return data, img.affine
+
+
+def _save_labels(input_path, output_path, kind, parcellation=False):
+    import nibabel as nib
+    from brainseg.nifti_io import save_image
+
+    data, affine = _labels_for(input_path, kind, parcellation)
+    if output_path.name.endswith(".mgz"):
+        nib.save(nib.MGHImage(data.astype("int32"), affine), output_path)
+    else:
+        save_image(nib.Nifti1Image(data, affine), output_path)
+
+
+def _option(tokens, *names):
+    for name in names:
+        if name in tokens:
+            return tokens[tokens.index(name) + 1]
+    sys.exit(f"standin: missing option {names[0]} in '{' '.join(tokens)}'")
+
+
+def synthseg(container, tokens):
+    """SynthSeg_predict.py --i <image or txt list> --o <image or txt list> [--parc]"""
+    inputs, outputs = _option(tokens, "--i"), _option(tokens, "--o")
+    if inputs.endswith(".txt"):
+        inputs = container.read(inputs).read_text().split()
+        outputs = container.read(outputs).read_text().split()
+    else:
+        inputs, outputs = [inputs], [outputs]
+    for input_path, output_path in zip(inputs, outputs):
+        _save_labels(container.read(input_path), container.write(output_path), "freesurfer",
+                     parcellation="--parc" in tokens)
+    return len(inputs)
+
+
+def gouhfi(container, tokens, prepared):
+    """run_gouhfi -i <dir> -o <dir> [--skip_parc], on the outputs of the preparation steps"""
+    output_dir = _option(tokens, "-o")
+    cases = []
+    for input_dir in prepared:
+        host_dir = container.read(input_dir)
+        cases += [(p.name[:-len("_0000.nii.gz")], f"{input_dir}/{p.name}")
+                  for p in sorted(host_dir.iterdir()) if p.name.endswith("_0000.nii.gz")]
+    for case, input_path in cases:
+        input_path = container.read(input_path)
+        _save_labels(input_path, container.write(f"{output_dir}/outputs_seg_postpro/{case}.nii.gz"),
+                     "gouhfi")
+        if "--skip_parc" not in tokens:
+            _save_labels(input_path,
+                         container.write(f"{output_dir}/outputs_parc_postpro/{case}.nii.gz"),
+                         "gouhfi-cortex")
+    return len(cases)
+
+
+def fastsurfer(container, tokens):
+    """run_fastsurfer.sh --t1 <image> --sd <dir> --sid <subject>"""
+    subject_dir = f"{_option(tokens, '--sd')}/{_option(tokens, '--sid')}"
+    output_path = container.write(f"{subject_dir}/mri/aparc.DKTatlas+aseg.deep.mgz")
+    _save_labels(container.read(_option(tokens, "--t1")), output_path, "freesurfer",
+                 parcellation=True)
+    return 1
+
+
+def charm(container, tokens):
+    """charm <subject> <T1> ..., writes m2m_<subject> to the working directory"""
+    subject, input_path = [t for t in tokens[1:] if not t.startswith("-")][:2]
+    output_path = container.write(f"m2m_{subject}/label_prep/tissue_labeling_upsampled.nii.gz")
+    _save_labels(container.read(input_path), output_path, "simnibs")
+    return 1
+
+
+def synthstrip(container, tokens):
+    """SynthStrip entrypoint: -i <image> -o <stripped image> [-m <mask>]"""
+    import nibabel as nib
+    import numpy as np
+    from brainseg import phantoms
+    from brainseg.nifti_io import save_image
+
+    img = nib.load(container.read(_option(tokens, "-i")))
+    tissue, _ = phantoms.tissue_map(img.shape[:3], img.header.get_zooms()[:3])
+    brain = tissue >= phantoms.CSF
+    data = np.asanyarray(img.dataobj).copy()
+    data[~brain] = 0
+    save_image(nib.Nifti1Image(data, img.affine, img.header),
+               container.write(_option(tokens, "-o")))
+    if "-m" in tokens:
+        save_image(nib.Nifti1Image(brain.astype(np.uint8), img.affine),
+                   container.write(_option(tokens, "-m")))
+    return 1
+
+
+def run_script(container, script):
+    """Emulates the tool commands of a `bash -c` script, returns the number of processed images."""
+    subjects = 0
+    prepared = []
+    commands = [[]]
+    for token in shlex.split(script):
+        if token == "&&":
+            commands.append([])
+        else:
+            commands[-1].append(token)
+
+    for tokens in commands:
+        if not tokens or "=" in tokens[0]:
+            continue
+        name = Path(tokens[0]).name
+        if name == "python" and len(tokens) > 1:
+            name = Path(tokens[1]).name
+        if name == "cd":
+            container.host_path(tokens[1])
+            container.cwd = os.path.normpath(os.path.join(container.cwd, tokens[1]))
+        elif name in ["run_conforming", "run_preprocessing"]:
+            prepared.append(_option(tokens, "-i"))
+        elif name == "run_gouhfi":
+            subjects += gouhfi(container, tokens, prepared)
+        elif name == "SynthSeg_predict.py":
+            subjects += synthseg(container, tokens)
+        elif name == "run_fastsurfer.sh":
+            subjects += fastsurfer(container, tokens)
+        elif name == "charm":
+            subjects += charm(container, tokens)
+        elif name not in NOOP_COMMANDS:
+            sys.exit(f"standin: can't emulate '{name}'")
+    return subjects
+
+
+def build(args):
+    """build <image> <uri>: writes a placeholder image with a SIF header."""
+    image, uri = args[-2], args[-1]
+    time.sleep(latency("BRAINSEG_STANDIN_LATENCY"))
+    header = b"#!/usr/bin/env run-singularity\n".ljust(SIF_MAGIC_OFFSET, b"\n")
+    Path(image).write_bytes(header + SIF_MAGIC + f"\nbrainseg stand-in image of {uri}\n".encode())
+
+
+def instance(args):
+    """instance start [options] <image> <name> | instance stop <name>"""
+    state_dir().mkdir(parents=True, exist_ok=True)
+    if args[0] == "start":
+        binds, _, (image, name) = parse_options(args[1:])
+        Path(image).stat()
+        time.sleep(latency("BRAINSEG_STANDIN_LATENCY"))
+        (state_dir() / f"{name}.json").write_text(json.dumps({"image": image, "binds": binds}))
+    elif args[0] == "stop":
+        (state_dir() / f"{args[1]}.json").unlink(missing_ok=True)
+    else:
+        sys.exit(f"standin: unsupported instance command '{args[0]}'")
+
+
+def execute(action, args):
+    """exec|run [options] <image or instance://name> <args>"""
+    binds, _, rest = parse_options(args)
+    image, args = rest[0], rest[1:]
+    if image.startswith("instance://"):
+        state_path = state_dir() / f"{image[len('instance://'):]}.json"
+        if not state_path.exists():
+            sys.exit(f"standin: no instance {image}")
+        binds += [tuple(b) for b in json.loads(state_path.read_text())["binds"]]
+    else:
+        if not Path(image).exists():
+            sys.exit(f"standin: could not open image {image}: no such file")
+        time.sleep(latency("BRAINSEG_STANDIN_LATENCY"))
+
+    container = Container(binds)
+    if action == "exec" and args[:2] == ["bash", "-c"]:
+        subjects = run_script(container, args[2])
+    elif action == "run" and "-i" in args:
+        # The only image run through its entrypoint is SynthStrip's
+        subjects = synthstrip(container, args)
+    else:
+        sys.exit(f"standin: can't emulate '{' '.join(args)}'")
+    time.sleep(subjects * latency("BRAINSEG_STANDIN_SUBJECT_LATENCY"))
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        sys.exit("usage: brainseg_standin exec|run|build|instance ...")
+    action, args = args[0], args[1:]
+    if action in ["exec", "run"]:
+        execute(action, args)
+    elif action == "build":
+        build(args)
+    elif action == "instance":
+        instance(args)
+    else:
+        sys.exit(f"standin: unsupported command '{action}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,20 @@
-from .fastsurfer import run_fastsurfer
-from .gouhfi import run_gouhfi, run_hybrid_gouhfi_T2
-from .simnibs import run_simnibs
-from .synthseg import run_synthseg
-from .synthstrip import run_synthstrip
\ No newline at end of file
+import importlib
+
+# Runners by name, imported on first access, so that importing the package
+# (e.g. from the CLI) doesn't load numpy, nibabel and the pipeline modules
+_RUNNERS = {
+    "run_batch": ".batch",
+    "run_fastsurfer": ".fastsurfer",
+    "run_gouhfi": ".gouhfi",
+    "run_hybrid_gouhfi_T2": ".gouhfi",
+    "run_simnibs": ".simnibs",
+    "run_synthseg": ".synthseg",
+    "run_synthstrip": ".synthstrip",
+}
+__all__ = list(_RUNNERS)
+
+
+def __getattr__(name):
+    if name not in _RUNNERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_RUNNERS[name], __name__), name)
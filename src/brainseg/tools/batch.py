@@ -0,0 +1,183 @@
+import glob
+import sys
+from pathlib import Path
+
+NIFTI_SUFFIXES = (".nii.gz", ".nii")
+
+
+def subject_id(path):
+    """Returns the file name of a NIfTI image without its extension."""
+    name = Path(path).name
+    for suffix in NIFTI_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return Path(path).stem
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest file with one subject per line. Each line holds one or more
+    whitespace separated images (e.g. 'T1 T2' for the hybrid pipeline).
+    Empty lines and lines starting with '#' are ignored, relative paths
+    are resolved against the directory of the manifest.
+    """
+    manifest_path = Path(manifest_path)
+    rows = []
+    with open(manifest_path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            row = []
+            for entry in line.split():
+                path = Path(entry)
+                if not path.is_absolute():
+                    path = manifest_path.parent / path
+                row.append(path)
+            rows.append(row)
+    return rows
+
+
+def collect_inputs(source):
+    """
+    Collects the input images of a batch. `source` can be a directory
+    (all NIfTI files inside), a manifest file or a glob pattern.
+    """
+    source = str(source)
+    path = Path(source)
+    if path.is_dir():
+        inputs = [p for p in sorted(path.iterdir()) if p.name.endswith(NIFTI_SUFFIXES)]
+    elif path.is_file() and not path.name.endswith(NIFTI_SUFFIXES):
+        inputs = [row[0] for row in read_manifest(path)]
+    else:
+        inputs = [Path(p) for p in sorted(glob.glob(source))]
+
+    if not inputs:
+        sys.exit(f"Error: No input images found for '{source}'.")
+
+    missing = [str(p) for p in inputs if not p.exists()]
+    if missing:
+        sys.exit("Error: Input images not found: " + ", ".join(missing))
+
+    ids = [subject_id(p) for p in inputs]
+    duplicates = sorted({i for i in ids if ids.count(i) > 1})
+    if duplicates:
+        sys.exit("Error: Duplicate subject names in batch: " + ", ".join(duplicates))
+
+    return [p.resolve() for p in inputs]
+
+
+def collect_input_pairs(manifest_path):
+    """Reads (T1, T2) pairs from a two-column manifest file."""
+    rows = read_manifest(manifest_path)
+    if any(len(row) < 2 for row in rows):
+        sys.exit(f"Error: Manifest '{manifest_path}' needs a T1 and a T2 image on every line.")
+    t1_paths = collect_inputs(manifest_path)
+    t2_paths = [row[1] for row in rows]
+    missing = [str(p) for p in t2_paths if not p.exists()]
+    if missing:
+        sys.exit("Error: Input images not found: " + ", ".join(missing))
+    return list(zip(t1_paths, [p.resolve() for p in t2_paths]))
+
+
+def batch_output_paths(input_paths, output_dir, tool):
+    """Returns the output path for each input: <output_dir>/<subject>_<tool>.nii.gz"""
+    return [Path(output_dir) / f"{subject_id(p)}_{tool}.nii.gz" for p in input_paths]
+
+
+def run_batch(tool, input_paths, output_dir, sif_path, do_parcellation=False,
+              folds=None, processes=1, report_dir=None):
+    """
+    Runs `tool` on all inputs within a single container invocation, so that
+    the container startup and model loading is paid once per batch.
+    `folds` and `processes` configure GOUHFI, see run_gouhfi. With `report_dir`,
+    the run report of the batch is written to <report_dir>/batch.json and
+    <report_dir>/run_report.csv.
+    """
+    from brainseg.report import collect_steps, merge_reports, start_report, step, write_report
+    from brainseg.tools.gouhfi import run_gouhfi_batch
+    from brainseg.tools.synthseg import run_synthseg_batch
+
+    batch_runners = {
+        "synthseg": run_synthseg_batch,
+        "gouhfi": run_gouhfi_batch,
+    }
+    if tool not in batch_runners:
+        sys.exit(f"Error: Batch mode is not supported for '{tool}'.")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_paths = batch_output_paths(input_paths, output_dir, tool)
+
+    print(f"\nStarting {tool} batch on {len(input_paths)} subjects...")
+    kwargs = {}
+    if tool == "gouhfi":
+        kwargs["processes"] = processes
+        if folds is not None:
+            kwargs["folds"] = folds
+    if report_dir is not None:
+        start_report()
+    try:
+        with step(tool):
+            batch_runners[tool](input_paths, output_paths, sif_path,
+                                do_parcellation=do_parcellation, **kwargs)
+    finally:
+        if report_dir is not None:
+            # Also written for a failed batch, with the failed step
+            report_dir = Path(report_dir)
+            write_report(report_dir / "batch.json", collect_steps(),
+                         subject=f"{len(input_paths)} subjects", tool=tool)
+            merge_reports([report_dir / "batch.json"], report_dir / "run_report.csv")
+    print(f"\nBatch complete! Results written to {output_dir}")
+    return output_paths
+
+
+def run_batch_parallel(tool, inputs, output_dir, sif_paths, do_parcellation=False,
+                       cores=None, mem_gb=None, max_jobs=None, registration="default",
+                       folds=None, processes=1, report_dir=None):
+    """
+    Runs `tool` once per subject, with several subjects running concurrently.
+    The number of concurrent jobs is sized from the core/memory budget, see
+    brainseg.scheduler. For the hybrid pipeline, `inputs` are (T1, T2) pairs and
+    `sif_paths` holds the GOUHFI and SynthStrip containers, `registration` is
+    the preset of its T2 -> T1 registration. `folds` and `processes` configure
+    GOUHFI in the gouhfi and hybrid_gouhfi_T2 runs. With `report_dir`, the run
+    report of every subject is written to <report_dir>/<subject>.json and all
+    of them are merged into <report_dir>/run_report.csv.
+    """
+    from brainseg.report import merge_reports, write_report
+    from brainseg.scheduler import run_jobs
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs = []
+    for subject_inputs in inputs:
+        if not isinstance(subject_inputs, (tuple, list)):
+            subject_inputs = (subject_inputs,)
+        output_path = batch_output_paths(subject_inputs[:1], output_dir, tool)[0]
+        kwargs = {}
+        if tool in ["synthseg", "gouhfi", "fastsurfer", "hybrid_gouhfi_T2"]:
+            kwargs["do_parcellation"] = do_parcellation
+        if tool == "hybrid_gouhfi_T2":
+            kwargs["registration"] = registration
+        if tool in ["gouhfi", "hybrid_gouhfi_T2"]:
+            kwargs["processes"] = processes
+            if folds is not None:
+                kwargs["folds"] = folds
+        jobs.append({
+            "name": subject_id(subject_inputs[0]),
+            "tool": tool,
+            "args": (*subject_inputs, output_path, *sif_paths),
+            "kwargs": kwargs,
+            "report": report_dir is not None,
+        })
+
+    results = run_jobs(jobs, tool, cores=cores, mem_gb=mem_gb, max_jobs=max_jobs)
+    if report_dir is not None:
+        report_paths = []
+        for result in results:
+            report_paths.append(Path(report_dir) / f"{result['name']}.json")
+            write_report(report_paths[-1], result["steps"], subject=result["name"], tool=tool)
+        print(f"\nRun report: {Path(report_dir) / 'run_report.csv'}")
+        merge_reports(report_paths, Path(report_dir) / "run_report.csv")
+    return results
@@ -1,43 +1,41 @@
-from brainseg.utils import get_container_runtime, run_command
-import brainseg.data
-from importlib import resources
-from brainseg.remap import remap_file
+import nibabel as nib
+from brainseg.utils import container_command, input_bind, run_command, staging_dir
+from brainseg.remap import label_data, remap_file
+from brainseg.nifti_io import save_image
+from brainseg.report import instrumented
 
-def run_fastsurfer(input_path, output_path, sif_path, do_parcellation=False):
+@instrumented
+def run_fastsurfer(input_path, output_path, sif_path, do_parcellation=False, threads=8):
     """
     Runs fastsurfer.
     """
     # 1. Prepare Bind Paths
-    
-    bind_args = [
-        "--bind", f"{input_path.parent}:/data_in",
-        "--bind", f"{ output_path.parent}:/data_out"
-    ]
+    # FastSurfer writes its subject directory into a staging directory next to
+    # the output, the .mgz segmentation is converted on the host in one pass
+    with staging_dir(output_path) as job_dir:
+        in_bind, container_input = input_bind(input_path)
+        binds = [
+            in_bind,
+            (job_dir, "/data_job"),
+        ]
 
-    fs_outfile = "aparc.DKTatlas+aseg.deep.mgz"
-    # 2. Construct the Internal Command
-    internal_cmd = (
-        "mkdir -p /tmp/out && "
-        "/opt/FastSurfer/run_fastsurfer.sh "
-        f"--t1 /data_in/{input_path.name} "
-        "--sd  /tmp/out --sid sub1 --py python3 "
-        f"--seg_only --threads 8 --no_biasfield --no_cereb --no_hypothal --3T && "
-        f"rm /data_out/{output_path.name} && "
-        f"nib-convert /tmp/out/sub1/mri/{fs_outfile} /data_out/{output_path.name}"
-    )
+        fs_outfile = "aparc.DKTatlas+aseg.deep.mgz"
+        # 2. Construct the Internal Command
+        internal_cmd = (
+            "/opt/FastSurfer/run_fastsurfer.sh "
+            f"--t1 {container_input} "
+            "--sd /data_job --sid sub1 --py python3 "
+            f"--seg_only --threads {threads} --no_biasfield --no_cereb --no_hypothal --3T"
+        )
 
-    # 3. Build Full Apptainer Command
-    cmd = [
-        get_container_runtime(), "exec",
-        "--cleanenv",
-        *bind_args,
-        str(sif_path),
-        "bash", "-c", internal_cmd
-    ]
+        # 3. Build Full Apptainer Command
+        cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
 
-    run_command(cmd, f"Running FastSurfer on {input_path.name}")
+        run_command(cmd, f"Running FastSurfer on {input_path.name}")
 
-    if not do_parcellation:
-        old_label_txt = resources.files(brainseg.data).joinpath("freesurfer-label-list-full-lut.txt")
-        new_label_txt = resources.files(brainseg.data).joinpath("freesurfer-label-list-reduced-lut.txt")
-        remap_file(output_path, old_label_txt, new_label_txt, output_path)
\ No newline at end of file
+        seg_path = job_dir / "sub1" / "mri" / fs_outfile
+        if do_parcellation:
+            seg_img = nib.load(seg_path)
+            save_image(nib.Nifti1Image(label_data(seg_img), seg_img.affine), output_path)
+        else:
+            remap_file(seg_path, "freesurfer-full", "freesurfer-reduced", output_path, inplace=True)
@@ -1,180 +1,468 @@
-from brainseg.utils import get_container_runtime, run_command,is_skull_stripped
-import brainseg.data
-from importlib import resources
-from brainseg.remap import remap, load_label_map
+from brainseg.utils import container_command, run_command,is_skull_stripped, mask_bbox
+from brainseg.utils import staging_dir, stage_input
+from brainseg.remap import label_data, lookup, translate, translation_table
 import numpy as np
 import nibabel as nib
 from brainseg.clients import coregister_images, merge_csf_and_anatomy, extract_csf_mask
 import tempfile
 from pathlib import Path
 from brainseg.tools.synthstrip import run_synthstrip
+from brainseg.tools.batch import subject_id
+from brainseg.pipeline import run_dag, checkpointed, step_key
+from brainseg.cache import image_digest, file_digest
+from brainseg.nifti_io import save_image, temp_suffix
+from brainseg.report import instrumented, recorded
+import json
 import sys
+import time
 
-def run_gouhfi(input_path, output_path, sif_path, do_parcellation=False, folds="0 1 2 3 4"):
+# FreeSurfer labels of the cortex, replaced by the parcellation
+CORTEX_LABELS = [3, 42]
+PARC_DILATION_RADIUS = 2
+# Folds of the GOUHFI model ensemble
+ALL_FOLDS = "0 1 2 3 4"
+
+
+def fold_string(folds):
+    """Normalizes a fold selection (e.g. [0, 2] or "0 2") to GOUHFI's "0 2" form."""
+    if folds is None:
+        return ALL_FOLDS
+    if isinstance(folds, str):
+        folds = folds.split()
+    folds = sorted({int(f) for f in folds})
+    unknown = [f for f in folds if str(f) not in ALL_FOLDS.split()]
+    if not folds or unknown:
+        sys.exit(f"Error: Invalid GOUHFI folds {folds}. Choose from {ALL_FOLDS}.")
+    return " ".join(str(f) for f in folds)
+
+
+@instrumented
+def run_gouhfi(input_path, output_path, sif_path, do_parcellation=False, folds=ALL_FOLDS,
+               threads=None, processes=1):
     """
     Runs GOUHFI.
+    `folds` selects the models of the ensemble (fewer folds run faster),
+    `processes` is the number of parallel GOUHFI processes (--np).
+    `threads` limits the number of threads used for inference (default: all cores).
     """
-    # 1. Prepare Bind Paths
-    # Input parent -> /data_in
-    # Output folder -> /data_out
-    bind_args = [
-        "--bind", f"{input_path.parent}:/data_in",
-        "--bind", f"{output_path.parent}:/data_out"
-    ]
-
     stripped = is_skull_stripped(input_path)
     
     if stripped:
-        print(f"Auto-detected skull-stripped input for {input_path.name}. Running GOUHFI conforming ...")
+        print(f"Auto-detected skull-stripped input for {input_path.name}. "
+              "Running GOUHFI conforming ...")
         # Skip run_preprocessing
-        prep_cmd = "run_conforming -i /tmp/in -o /tmp/masked && "
+        prep_cmd = "run_conforming -i /data_job/in -o $T/masked && "
     else:
         print(f"Auto-detected raw input for {input_path.name}. Running GOUHFI preprocessing...")
-        prep_cmd = "run_preprocessing -i /tmp/in -o /tmp/masked && "
+        prep_cmd = "run_preprocessing -i /data_job/in -o $T/masked && "
 
     if do_parcellation:
         try:
-            from nbmorph import dilate_labels_spherical as dilate
+            import nbmorph  # noqa: F401
         except ImportError: 
-            sys.exit("GOUHFI parcellation requires nbmorph. Please install with 'pip install nbmorph'")
-
+            sys.exit("GOUHFI parcellation requires nbmorph. "
+                     "Please install with 'pip install nbmorph'")
         parc_flag = "" 
-        output_handling_cmd = (
-            f"cp /tmp/out/outputs_seg_postpro/subject.nii.gz /data_out/{output_path.name} && "
-            f"cp /tmp/out/outputs_parc_postpro/subject.nii.gz /data_out/tmp_parc_{output_path.name}"
-        )
     else: 
         parc_flag = "--skip_parc "
-        output_handling_cmd = (
-            f"cp /tmp/out/outputs_seg_postpro/subject.nii.gz /data_out/{output_path.name}"
+
+    # 1. Prepare Bind Paths
+    # GOUHFI reads folders of <case>_0000.nii.gz files: the input is staged as
+    # a symlink in a job directory next to the output, which GOUHFI also writes
+    # its results to. The post-processing reads them from there, no copies.
+    with staging_dir(output_path) as job_dir:
+        binds = [
+            stage_input(input_path, job_dir / "in" / "subject_0000.nii.gz"),
+            (job_dir, "/data_job"),
+        ]
+
+        # 2. Construct the internal command
+        internal_cmd = (
+            # A. Private scratch directory for the preprocessed image, so that
+            # concurrent runs on the same node don't share /tmp
+            "T=$(mktemp -d) && trap 'rm -rf $T' EXIT && "
+            "mkdir -p $T/masked && "
+            
+            # B. Run Preprocessing (Conditionally)
+             + prep_cmd +
+            
+            # C. Run GOUHFI (Segmentation)
+            "echo 'Running GOUHFI...' && "
+            "run_gouhfi "
+            "-i $T/masked "
+            "-o /data_job/out "
+            "--cpu "        # Force CPU mode
+            f"--np {processes} "
+            f"--folds '{fold_string(folds)}' "
+            f"{parc_flag}"
         )
 
-    # 2. Construct the internal command
-    internal_cmd = (
-        # A. Setup Staging
-        "mkdir -p /tmp/in /tmp/masked /tmp/out && "
-        f"cp /data_in/{input_path.name} /tmp/in/subject_0000.nii.gz && "
-        
-        # B. Run Preprocessing (Conditionally)
-         + prep_cmd +
-        
-        # C. Run GOUHFI (Segmentation)
-        "echo 'Running GOUHFI...' && "
-        "run_gouhfi "
-        "-i /tmp/masked "
-        "-o /tmp/out "
-        "--cpu "        # Force CPU mode
-        f"--np 1 "
-        f"--folds '{folds}' "
-        f"{parc_flag}"
-        " && ls -R /tmp/out"
-        f" && {output_handling_cmd}"
-    )
-
-    # 3. Build Full Apptainer Command
-    cmd = [
-        get_container_runtime(), "exec",
-        "--cleanenv",
-        *bind_args,
-        str(sif_path),
-        "bash", "-c", internal_cmd
-    ]
-
-    run_command(cmd, f"Running GOUHFI on {input_path.name}")
-
-    seg_img = nib.load(output_path)
-    gouhfi_seg_labels = load_label_map(resources.files(brainseg.data).joinpath("gouhfi-label-list-lut.txt"))
-    fs_labels = load_label_map(resources.files(brainseg.data).joinpath("freesurfer-label-list-lut.txt"))
-    seg_relabeled = remap(seg_img, gouhfi_seg_labels, fs_labels)
-
-    if not do_parcellation:
-        nib.save(seg_relabeled, output_path)
+        # 3. Build Full Apptainer Command
+        cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
+
+        run_command(cmd, f"Running GOUHFI on {input_path.name}")
+
+        seg_path = job_dir / "out" / "outputs_seg_postpro" / "subject.nii.gz"
+        parc_path = None
+        if do_parcellation:
+            parc_path = job_dir / "out" / "outputs_parc_postpro" / "subject.nii.gz"
+        return postprocess_gouhfi(seg_path, output_path, parc_path=parc_path)
+
+
+@instrumented
+def postprocess_gouhfi(seg_path, output_path, parc_path=None):
+    """
+    Remaps the GOUHFI labels to FreeSurfer labels and, if a parcellation
+    is given, transfers the cortical parcellation into the segmentation.
+    Returns the final segmentation image and saves it to output_path.
+    """
+    seg_img = nib.load(seg_path)
+    seg_relabeled = translate(seg_img, "gouhfi", "freesurfer")
+
+    if parc_path is None:
+        save_image(seg_relabeled, output_path)
+        return seg_relabeled
 
     else:
-        out_dir = output_path.parent
-        tmp_parc_path = out_dir / f"tmp_parc_{output_path.name}"
-        gouhfi_parc_labels = load_label_map(resources.files(brainseg.data).joinpath("gouhfi-label-list-cortex-lut.txt"))
-        parc_img = nib.load(tmp_parc_path)
-        parc_relabeled = remap(parc_img, gouhfi_parc_labels, fs_labels)
-
-        seg_data = seg_relabeled.get_fdata().astype(np.int32)
-        parc_data = parc_relabeled.get_fdata().astype(np.int32)
-        
-        is_parc_cortex = parc_data > 0
-        is_seg_cortex = np.isin(seg_data, [3, 42])
-        intersection = np.logical_and(is_parc_cortex, is_seg_cortex).sum()
-        overlap_ratio = intersection / is_parc_cortex.sum()
+        from nbmorph import dilate_labels_spherical as dilate
+
+        parc_img = nib.load(parc_path)
+        parc_raw = label_data(parc_img)
+        parc_table = translation_table("gouhfi-cortex", "freesurfer")
+
+        seg_data = np.asanyarray(seg_relabeled.dataobj)
+        is_seg_cortex = np.isin(seg_data, CORTEX_LABELS)
+
+        # The dilated parcellation is only used in the cortex, so the remap and
+        # the dilation run on the bounding box of the cortex, extended by the
+        # dilation radius (+1 for the kernel border)
+        bbox = mask_bbox(is_seg_cortex)
+        if bbox is not None:
+            margin = PARC_DILATION_RADIUS + 1
+            bbox = tuple(
+                slice(max(s.start - margin, 0), min(s.stop + margin, n))
+                for s, n in zip(bbox, seg_data.shape)
+            )
+            parc_data = lookup(parc_table, parc_raw[bbox])
+            seg_cortex = is_seg_cortex[bbox]
+        else:
+            parc_data = np.zeros((0, 0, 0), dtype=parc_table.dtype)
+            seg_cortex = np.zeros((0, 0, 0), dtype=bool)
+
+        # Cortex voxels of the whole parcellation, counted on the GOUHFI labels
+        parc_counts = np.bincount(parc_raw.ravel())
+        parc_cortex_voxels = parc_counts[lookup(parc_table, np.arange(len(parc_counts))) > 0].sum()
+        intersection = np.logical_and(parc_data > 0, seg_cortex).sum()
+        overlap_ratio = intersection / parc_cortex_voxels
         print(f"Cortical agreement: {overlap_ratio * 100:.2f}%")
-        seg_data[is_seg_cortex] = dilate(parc_data, radius=2)[is_seg_cortex]
-        assert np.isin(seg_data, [3, 42]).sum() == 0
+        if bbox is not None:
+            seg_data = seg_data.astype(np.result_type(seg_data, parc_data), copy=False)
+            seg_data[bbox][seg_cortex] = dilate(parc_data, radius=PARC_DILATION_RADIUS)[seg_cortex]
+            assert np.isin(seg_data[bbox], CORTEX_LABELS).sum() == 0
 
         # Save the final combined file
         merged_img = nib.Nifti1Image(seg_data, seg_img.affine)
-        nib.save(merged_img, output_path)
+        save_image(merged_img, output_path)
+        return merged_img
 
 
+@instrumented
+def run_gouhfi_batch(input_paths, output_paths, sif_path, do_parcellation=False, folds=ALL_FOLDS,
+                     threads=None, processes=1):
+    """
+    Runs GOUHFI on many inputs in a single container invocation.
+    GOUHFI works on folders, so all subjects are staged into one input folder
+    and the models are initialized only once per batch. The label remapping
+    and parcellation merge run per subject on the host afterwards.
+    """
+    if do_parcellation:
+        try:
+            import nbmorph  # noqa: F401
+        except ImportError:
+            sys.exit("GOUHFI parcellation requires nbmorph. "
+                     "Please install with 'pip install nbmorph'")
+        parc_flag = ""
+    else:
+        parc_flag = "--skip_parc "
+
+    subjects = [subject_id(p) for p in input_paths]
+
+    # Skull-stripped and raw inputs need different preprocessing, they are
+    # staged as symlinks into two separate input folders of the job directory.
+    # GOUHFI writes its results to the job directory as well.
+    with staging_dir(output_paths[0], prefix=".brainseg_batch_") as batch_dir:
+        binds = [(batch_dir, "/data_job")]
+        groups = set()
+        for subject, input_path in zip(subjects, input_paths):
+            if is_skull_stripped(input_path):
+                print(f"Auto-detected skull-stripped input for {input_path.name}.")
+                group = "stripped"
+            else:
+                print(f"Auto-detected raw input for {input_path.name}.")
+                group = "raw"
+            groups.add(group)
+            staged_path = batch_dir / "in" / group / f"{subject}_0000.nii.gz"
+            binds.append(stage_input(input_path, staged_path))
+
+        prep_cmd = ""
+        if "stripped" in groups:
+            prep_cmd += "run_conforming -i /data_job/in/stripped -o $T/masked && "
+        if "raw" in groups:
+            prep_cmd += "run_preprocessing -i /data_job/in/raw -o $T/masked && "
+
+        internal_cmd = (
+            "T=$(mktemp -d) && trap 'rm -rf $T' EXIT && "
+            "mkdir -p $T/masked && "
+            + prep_cmd +
+            "echo 'Running GOUHFI...' && "
+            "run_gouhfi "
+            "-i $T/masked "
+            "-o /data_job/out "
+            "--cpu "
+            f"--np {processes} "
+            f"--folds '{fold_string(folds)}' "
+            f"{parc_flag}"
+        )
+
+        cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
+
+        run_command(cmd, f"Running GOUHFI on {len(input_paths)} subjects")
+
+        for subject, output_path in zip(subjects, output_paths):
+            print(f"Post-processing {subject}...")
+            seg_path = batch_dir / "out" / "outputs_seg_postpro" / f"{subject}.nii.gz"
+            parc_path = None
+            if do_parcellation:
+                parc_path = batch_dir / "out" / "outputs_parc_postpro" / f"{subject}.nii.gz"
+            postprocess_gouhfi(seg_path, output_path, parc_path=parc_path)
+
+
+
+def segmentation_agreement(seg_a, seg_b):
+    """
+    Agreement of two label volumes: the fraction of voxels with the same label
+    and the Dice score of every label (except background) present in either volume.
+    """
+    a = np.asarray(label_data(seg_a)).ravel()
+    b = np.asarray(label_data(seg_b)).ravel()
+    size = int(max(a.max(initial=0), b.max(initial=0))) + 1
+    same = a == b
+    counts_a = np.bincount(a, minlength=size)
+    counts_b = np.bincount(b, minlength=size)
+    intersection = np.bincount(a[same], minlength=size)
+    labels = np.flatnonzero(counts_a[1:] + counts_b[1:]) + 1
+    dice = {
+        int(label): float(2 * intersection[label] / (counts_a[label] + counts_b[label]))
+        for label in labels
+    }
+    return {"voxel_agreement": float(same.mean()), "dice": dice}
+
+
+def benchmark_gouhfi_folds(input_path, output_dir, sif_path, folds, reference_folds=ALL_FOLDS,
+                           threads=None, processes=1):
+    """
+    Runs every fold of `reference_folds` on its own to time it, then the
+    ensembles of `folds` and of `reference_folds`, and compares the two
+    segmentations (see segmentation_agreement). The segmentations and a
+    report (fold_benchmark.json) are written to `output_dir`. Single-fold
+    runtimes include the container start and the preprocessing.
+    """
+    folds, reference_folds = fold_string(folds), fold_string(reference_folds)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    def timed_run(fold_selection, output_path):
+        start = time.perf_counter()
+        run_gouhfi(input_path, output_path, sif_path, folds=fold_selection,
+                   threads=threads, processes=processes)
+        return time.perf_counter() - start
+
+    fold_times = {}
+    for fold in reference_folds.split():
+        print(f"\n--- Timing GOUHFI fold {fold} ---")
+        fold_times[fold] = timed_run(fold, output_dir / f"fold_{fold}.nii.gz")
+
+    ensembles = {}
+    for fold_selection in dict.fromkeys([folds, reference_folds]):
+        print(f"\n--- Running GOUHFI ensemble of folds {fold_selection} ---")
+        output_path = output_dir / f"folds_{fold_selection.replace(' ', '')}.nii.gz"
+        ensembles[fold_selection] = (output_path, timed_run(fold_selection, output_path))
+
+    agreement = segmentation_agreement(nib.load(ensembles[folds][0]),
+                                       nib.load(ensembles[reference_folds][0]))
+    report = {
+        "input": str(input_path),
+        "folds": folds,
+        "reference_folds": reference_folds,
+        "processes": processes,
+        "fold_seconds": fold_times,
+        "ensemble_seconds": {f: seconds for f, (_, seconds) in ensembles.items()},
+        **agreement,
+    }
+    (output_dir / "fold_benchmark.json").write_text(json.dumps(report, indent=2))
+
+    print("\nFold   Runtime [s]")
+    for fold, seconds in fold_times.items():
+        print(f"{fold:>4}   {seconds:11.1f}")
+    for fold_selection, (_, seconds) in ensembles.items():
+        print(f"Ensemble {fold_selection}: {seconds:.1f} s")
+    dice = agreement["dice"]
+    print(f"Voxel agreement of folds {folds} vs {reference_folds}: "
+          f"{agreement['voxel_agreement'] * 100:.2f}%")
+    print(f"Mean Dice: {np.mean(list(dice.values())):.4f}, "
+          f"lowest: label {min(dice, key=dice.get)} ({min(dice.values()):.4f})")
+    print(f"Report written to {output_dir / 'fold_benchmark.json'}")
+    return report
 
 
 def run_hybrid_gouhfi_T2(t1_path, t2_path, output_path,
                          gouhfi_sif, synthstrip_sif,
-                         do_parcellation=False, save_tmp_files = False):
+                         do_parcellation=False, save_tmp_files = False, threads=None,
+                         workdir=None, registration="default", folds=ALL_FOLDS, processes=1):
     """
     Runs the hybrid T1+T2 pipeline for high-fidelity CFD meshing:
     1. Coregister T2 -> T1
     2. SynthStrip on T2
-    3. apply SynthStrip mask from T2 to the T1
-    3. Extract CSF mask from stripped T2
-    4. GOUHFI on T1
-    5. Merge GOUHFI anatomy with T2 CSF mask
+    3. SynthStrip on T1
+    4. Extract CSF mask from stripped T2
+    5. GOUHFI on T1
+    6. Merge GOUHFI anatomy with T2 CSF mask
+    Steps 1, 2, 4 and steps 3, 5 are independent chains and run in parallel.
+
+    If `workdir` is given, the intermediate files are kept there under names
+    derived from their inputs, and a re-run resumes from the first step whose
+    inputs changed or whose outputs are missing. `save_tmp_files` uses
+    <output dir>/segmentation_tmp_files as work directory.
+    `registration` is the preset of the T2 -> T1 registration, see
+    brainseg.clients.coregister.REGISTRATION_PRESETS. `folds` and `processes`
+    are passed on to run_gouhfi.
     """
     print(f"\nStarting Hybrid T1+T2 GOUHFI Pipeline...")
     print(f"Target Output: {output_path}")
 
-    # Use a temporary directory 
-    with tempfile.TemporaryDirectory() as tmpdir:
-
-        tmp_dir = Path(tmpdir)
-        
-        coreg_t2_path = tmp_dir / "T2_coreg_to_T1.nii.gz"
-        stripped_t2_path = tmp_dir / "T2_stripped.nii.gz"
-        csf_mask_path = tmp_dir / "T2_csf_mask.nii.gz"
-        stripped_t1_path = tmp_dir / "T1_stripped.nii.gz"
-        gouhfi_seg_path = tmp_dir / "gouhfi_anatomy.nii.gz"
-        
-        # Step 1: Coregister T2 to T1
+    if save_tmp_files and workdir is None:
+        workdir = output_path.parent / "segmentation_tmp_files"
+
+    if workdir is None:
+        # Use a temporary directory 
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _run_hybrid_steps(t1_path, t2_path, output_path, gouhfi_sif, synthstrip_sif,
+                              do_parcellation, threads, Path(tmpdir), resumable=False,
+                              registration=registration, folds=folds, processes=processes)
+    else:
+        workdir = Path(workdir).resolve()
+        workdir.mkdir(parents=True, exist_ok=True)
+        _run_hybrid_steps(t1_path, t2_path, output_path, gouhfi_sif, synthstrip_sif,
+                          do_parcellation, threads, workdir, resumable=True,
+                          registration=registration, folds=folds, processes=processes)
+        print(f"Intermediate files are kept in {workdir}")
+
+    print(f"\nHybrid Pipeline Complete! Successfully generated {output_path.name}")
+
+
+def _run_hybrid_steps(t1_path, t2_path, output_path, gouhfi_sif, synthstrip_sif,
+                      do_parcellation, threads, work_dir, resumable, registration="default",
+                      folds=ALL_FOLDS, processes=1):
+
+    if resumable:
+        # Chain the step keys: every key depends on the keys of its inputs,
+        # so a changed T1 only invalidates the T1 branch and the merge.
+        t1_digest, t2_digest = image_digest(t1_path), image_digest(t2_path)
+        synthstrip_digest, gouhfi_digest = file_digest(synthstrip_sif), file_digest(gouhfi_sif)
+        keys = {"coregister": step_key("coregister", t1_digest, t2_digest, registration)}
+        keys["strip_t2"] = step_key("strip_t2", keys["coregister"], synthstrip_digest, "-b 2")
+        keys["csf_mask"] = step_key("csf_mask", keys["strip_t2"])
+        keys["strip_t1"] = step_key("strip_t1", t1_digest, synthstrip_digest, "--no-csf")
+        keys["gouhfi"] = step_key("gouhfi", keys["strip_t1"], gouhfi_digest, do_parcellation,
+                                  fold_string(folds))
+        keys["merge"] = step_key("merge", keys["csf_mask"], keys["gouhfi"])
+        def name(stem, step, suffix):
+            return work_dir / f"{stem}_{keys[step][:12]}{suffix}"
+    else:
+        def name(stem, step, suffix):
+            return work_dir / f"{stem}{suffix}"
+
+    # Intermediates that only pass between the host and SynthStrip use the fast
+    # temporary format (uncompressed by default). GOUHFI needs .nii.gz input
+    # and writes .nii.gz output.
+    coreg_t2_path = name("T2_coreg_to_T1", "coregister", temp_suffix())
+    stripped_t2_path = name("T2_stripped", "strip_t2", temp_suffix())
+    csf_mask_path = name("T2_csf_mask", "csf_mask", temp_suffix())
+    stripped_t1_path = name("T1_stripped", "strip_t1", ".nii.gz")
+    gouhfi_seg_path = name("gouhfi_anatomy", "gouhfi", ".nii.gz")
+    
+    # Host-side results that are handed to the next step in memory. Only data
+    # going into a container (or needed to resume from the work directory)
+    # is written to disk.
+    results = {}
+
+    # Step 1: Coregister T2 to T1
+    def coregister():
         print("\n--- STEP 1: Coregistering T2 to T1 ---")
-        coregister_images(t1_path, t2_path, coreg_t2_path)
-        
-        # Step 2: Run SynthStrip on the coregistered T2
+        coregister_images(t1_path, t2_path, coreg_t2_path, preset=registration, threads=threads)
+    
+    # Step 2: Run SynthStrip on the coregistered T2
+    def strip_t2():
         print("\n--- STEP 2: Running SynthStrip on Coregistered T2 ---")
         run_synthstrip(coreg_t2_path, stripped_t2_path, synthstrip_sif,
-                       additional_cmds="-b 2")
+                       additional_cmds="-b 2", threads=threads)
 
-        # Step 3: Apply the SynthStrip mask to the T1
+    # Step 3: Apply the SynthStrip mask to the T1
+    def strip_t1():
         print("\n--- STEP 3: Skull-stripping T1 with SynthStrip Mask ---")
         #apply_brain_mask(t1_path, synthstrip_mask_path, stripped_t1_path)
         run_synthstrip(t1_path, stripped_t1_path , synthstrip_sif,
-                       additional_cmds="--no-csf")
+                       additional_cmds="--no-csf", threads=threads)
 
-        # Step 4: Extract CSF mask using Li Thresholding
+    # Step 4: Extract CSF mask using Li Thresholding
+    def csf_mask():
         print("\n--- STEP 4: Extracting CSF Mask ---")
-        extract_csf_mask(stripped_t2_path, csf_mask_path)
-        
-        # Step 5: Run GOUHFI on the stripped T1
+        results["csf_mask"] = extract_csf_mask(stripped_t2_path,
+                                               csf_mask_path if resumable else None)
+    
+    # Step 5: Run GOUHFI on the stripped T1
+    def gouhfi():
         print("\n--- STEP 5: Running GOUHFI on stripped T1 ---")
-        run_gouhfi(stripped_t1_path, gouhfi_seg_path, gouhfi_sif,
-                   do_parcellation=do_parcellation)
-        
-        # Step 6: Merge CSF mask with GOUHFI seg
+        results["gouhfi"] = run_gouhfi(stripped_t1_path, gouhfi_seg_path, gouhfi_sif,
+                                       do_parcellation=do_parcellation, folds=folds,
+                                       threads=threads, processes=processes)
+    
+    # Step 6: Merge CSF mask with GOUHFI seg
+    def merge():
         print("\n--- STEP 6: Merging T2 CSF with T1 Anatomy ---")
-        merge_csf_and_anatomy(gouhfi_seg_path, csf_mask_path, output_path)
-        
-        if save_tmp_files:
-            saved_tmp_dir = output_path.parent / f"segmentation_tmp_files"
-            saved_tmp_dir.mkdir(exist_ok=True)
-            for tmp_file in [coreg_t2_path, stripped_t2_path, csf_mask_path, stripped_t1_path, gouhfi_seg_path]:
-                if tmp_file.exists():
-                    (saved_tmp_dir / tmp_file.name).write_bytes(tmp_file.read_bytes())
-            print(f"Saved intermediate files to {saved_tmp_dir}")
-        
-        print(f"\nHybrid Pipeline Complete! Successfully generated {output_path.name}")
\ No newline at end of file
+        # Steps skipped when resuming have their results only on disk
+        merge_csf_and_anatomy(results.get("gouhfi", gouhfi_seg_path),
+                              results.get("csf_mask", csf_mask_path), output_path)
+
+    # (function, dependencies, input files, output files) of each step
+    steps = {
+        "coregister": (coregister, [], [], [coreg_t2_path]),
+        "strip_t2": (strip_t2, ["coregister"], [coreg_t2_path], [stripped_t2_path]),
+        "csf_mask": (csf_mask, ["strip_t2"], [stripped_t2_path], [csf_mask_path]),
+        "strip_t1": (strip_t1, [], [], [stripped_t1_path]),
+        "gouhfi": (gouhfi, ["strip_t1"], [stripped_t1_path], [gouhfi_seg_path]),
+        "merge": (merge, ["csf_mask", "gouhfi"], [csf_mask_path, gouhfi_seg_path], [output_path]),
+    }
+    # Every executed step goes into the run report, steps skipped when resuming don't
+    external_inputs = {"coregister": [t1_path, t2_path], "strip_t1": [t1_path]}
+    steps = {
+        step: (recorded(step, func, [*external_inputs.get(step, []), *inputs], outputs),
+               deps, inputs, outputs)
+        for step, (func, deps, inputs, outputs) in steps.items()
+    }
+    if resumable:
+        digests = {
+            "coregister": {str(t1_path): t1_digest, str(t2_path): t2_digest},
+            "strip_t1": {str(t1_path): t1_digest},
+        }
+        steps = {
+            step: (checkpointed(work_dir, step, keys[step], outputs, func, inputs=inputs,
+                                digests=digests.get(step)), deps)
+            for step, (func, deps, inputs, outputs) in steps.items()
+        }
+    else:
+        steps = {step: (func, deps) for step, (func, deps, _, _) in steps.items()}
+
+    # The T2 branch (coregistration -> strip -> CSF mask) and the
+    # T1 branch (strip -> GOUHFI) are independent and run concurrently.
+    run_dag(steps)
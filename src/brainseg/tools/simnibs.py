@@ -1,34 +1,34 @@
-from brainseg.utils import get_container_runtime, run_command
+import os
+from brainseg.utils import container_command, input_bind, run_command, staging_dir
+from brainseg.report import instrumented
 
-def run_simnibs(input_path, output_path, sif_path):
+@instrumented
+def run_simnibs(input_path, output_path, sif_path, threads=None):
     """
     Runs simnibs.
     """
     # 1. Prepare Bind Paths
-    
-    bind_args = [
-        "--bind", f"{input_path.parent}:/data_in",
-        "--bind", f"{ output_path.parent}:/data_out"
-    ]
+    # charm runs in a staging directory next to the output, so that its
+    # label image can be moved to the output path without a copy
+    with staging_dir(output_path) as job_dir:
+        in_bind, container_input = input_bind(input_path)
+        binds = [
+            in_bind,
+            (job_dir, "/data_job"),
+        ]
 
-    # 2. Construct the Internal Command
-    internal_cmd = (
-        "mkdir -p /tmp/out && cd /tmp/out && "
-        "charm sub1 "
-        f" /data_in/{input_path.name} "
-        "--forcesform --forcerun && "
-        "cp m2m_sub1/label_prep/tissue_labeling_upsampled.nii.gz "
-        f"/data_out/{output_path.name}"
+        # 2. Construct the Internal Command
+        internal_cmd = (
+            "cd /data_job && "
+            "charm sub1 "
+            f" {container_input} "
+            "--forcesform --forcerun"
+        )
 
-    )
+        # 3. Build Full Apptainer Command
+        cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
 
-    # 3. Build Full Apptainer Command
-    cmd = [
-        get_container_runtime(), "exec",
-        "--cleanenv",
-        *bind_args,
-        str(sif_path),
-        "bash", "-c", internal_cmd
-    ]
+        run_command(cmd, f"Running simnibs on {input_path.name}")
 
-    run_command(cmd, f"Running simnibs on {input_path.name}")
\ No newline at end of file
+        os.replace(job_dir / "m2m_sub1" / "label_prep" / "tissue_labeling_upsampled.nii.gz",
+                   output_path)
@@ -1,33 +1,73 @@
-from brainseg.utils import get_container_runtime, run_command
+from brainseg.utils import container_command, input_bind, run_command
+from brainseg.report import instrumented
+import tempfile
+from pathlib import Path
 
-def run_synthseg(input_path, output_path, sif_path, do_parcellation=False):
+@instrumented
+def run_synthseg(input_path, output_path, sif_path, do_parcellation=False, threads=8):
     """
     Runs SynthSeg.
     Logic: Input File -> Output File.
     """
     # 1. Prepare Bind Paths
+    # Only the input file is bound, the output is written to its final location
     parc_flag = "--parc" if do_parcellation else ""
-    bind_args = [
-        "--bind", f"{input_path.parent}:/data_in",
-        "--bind", f"{ output_path.parent}:/data_out"
+    in_bind, container_input = input_bind(input_path)
+    binds = [
+        in_bind,
+        (output_path.parent, "/data_out"),
     ]
 
     # 2. Construct the Internal Command
     # SynthSeg takes specific file paths.
     internal_cmd = (
         "python /opt/synthseg/scripts/commands/SynthSeg_predict.py "
-        f"--i /data_in/{input_path.name} "
+        f"--i {container_input} "
         f"--o /data_out/{output_path.name} "
-        f"--cpu --threads 8 {parc_flag}"
+        f"--cpu --threads {threads} {parc_flag}"
     )
 
     # 3. Build Full Apptainer Command
-    cmd = [
-        get_container_runtime(), "exec",
-        "--cleanenv",
-        *bind_args,
-        str(sif_path),
-        "bash", "-c", internal_cmd
-    ]
+    cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
+
+    run_command(cmd, f"Running SynthSeg on {input_path.name}")
+
+
+@instrumented
+def run_synthseg_batch(input_paths, output_paths, sif_path, do_parcellation=False, threads=8):
+    """
+    Runs SynthSeg on many inputs in a single container invocation.
+    SynthSeg reads the input and output paths from text files, so the
+    model is loaded only once for the whole batch.
+    """
+    parc_flag = "--parc" if do_parcellation else ""
+    output_dir = output_paths[0].parent
+
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".brainseg_batch_") as tmpdir:
+        batch_dir = Path(tmpdir)
+
+        # Bind every input file individually, no copies are made
+        binds = [
+            (batch_dir, "/data_batch"),
+            (output_dir, "/data_out"),
+        ]
+        for input_path in input_paths:
+            binds.append((input_path, f"/data_in/{input_path.name}", "ro"))
+
+        (batch_dir / "inputs.txt").write_text(
+            "".join(f"/data_in/{p.name}\n" for p in input_paths)
+        )
+        (batch_dir / "outputs.txt").write_text(
+            "".join(f"/data_out/{p.name}\n" for p in output_paths)
+        )
+
+        internal_cmd = (
+            "python /opt/synthseg/scripts/commands/SynthSeg_predict.py "
+            "--i /data_batch/inputs.txt "
+            "--o /data_batch/outputs.txt "
+            f"--cpu --threads {threads} {parc_flag}"
+        )
+
+        cmd = container_command(sif_path, binds, ["bash", "-c", internal_cmd], threads=threads)
 
-    run_command(cmd, f"Running SynthSeg on {input_path.name}")
\ No newline at end of file
+        run_command(cmd, f"Running SynthSeg on {len(input_paths)} subjects")
@@ -1,25 +1,32 @@
-from brainseg.utils import get_container_runtime, run_command
+from brainseg.utils import container_command, input_bind, run_command
+from brainseg.nifti_io import split_nifti_name
+from brainseg.report import instrumented
 
 
-def run_synthstrip(input_path, output_path, sif_path, additional_cmds=None):
+def mask_path(output_path):
+    """Path of the brain mask SynthStrip writes next to `output_path`."""
+    stem, suffix = split_nifti_name(output_path)
+    return output_path.parent / f"{stem}_mask{suffix}"
+
+
+@instrumented
+def run_synthstrip(input_path, output_path, sif_path, additional_cmds=None, threads=None):
     """
     Runs SynthStrip for robust brain extraction.
     """
-    bind_args = [
-        "--bind", f"{input_path.parent}:/data_in",
-        "--bind", f"{output_path.parent}:/data_out"
+    in_bind, container_input = input_bind(input_path)
+    binds = [
+        in_bind,
+        (output_path.parent, "/data_out"),
     ]
 
     # The freesurfer/synthstrip container's entrypoint takes the arguments directly
-    cmd = [
-        get_container_runtime(), "run",
-        "--cleanenv",
-        *bind_args,
-        str(sif_path),
-        "-i", f"/data_in/{input_path.name}",
+    args = [
+        "-i", container_input,
         "-o", f"/data_out/{output_path.name}",
-        "-m", f"/data_out/{output_path.name.replace('.nii.gz', '_mask.nii.gz')}",
+        "-m", f"/data_out/{mask_path(output_path).name}",
     ]
     if not additional_cmds is None:
-        cmd.append(additional_cmds)
+        args.append(additional_cmds)
+    cmd = container_command(sif_path, binds, args, action="run", threads=threads)
     run_command(cmd, f"Running SynthStrip on {input_path.name}")
\ No newline at end of file
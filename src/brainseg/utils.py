@@ -5,6 +5,12 @@ import shutil
 import os
 from pathlib import Path
 import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from brainseg.nifti_io import save_slabs
+from brainseg.slabs import iter_slabs, scaling, slab_size, use_slabs
+from brainseg.cache import cache_dir, memoized
 
 # Default container names (users can override with --container)
 DEFAULT_IMAGES = {
@@ -23,7 +29,19 @@ CONTAINER_URIS = {
     "synthstrip": "docker://freesurfer/synthstrip:latest"
 }
 
-def is_skull_stripped(image_path, brain_threshold_cc=1800):
+def as_image(img_or_path):
+    """Returns the image itself for nibabel images, loads it for file paths."""
+    if isinstance(img_or_path, nib.spatialimages.SpatialImage):
+        return img_or_path
+    return nib.load(img_or_path)
+
+def describe_image(img_or_path):
+    """Short name of an image for log messages."""
+    if isinstance(img_or_path, nib.spatialimages.SpatialImage):
+        return "in-memory image"
+    return str(img_or_path)
+
+def is_skull_stripped(image_path, brain_threshold_cc=1800, stride=2):
     """
     Determines if an MRI is skull-stripped based on the physical volume 
     of non-zero (or non-noise) voxels.
@@ -31,21 +49,31 @@ def is_skull_stripped(image_path, brain_threshold_cc=1800):
     Parameters:
     - brain_threshold_cc: Maximum volume in cubic centimeters (cm^3) 
       expected for a stripped brain. Default is 1800cc.
+    - stride: The volume is estimated from every stride-th voxel along each
+      axis, read slab by slab in the stored dtype. The estimate is memoized
+      per input file, so repeated runs on the same image skip the scan.
     """
-    img = nib.load(image_path)
-    data = img.get_fdata()
-    
-    # Calculate volume of a single voxel in mm^3
-    voxel_dims = img.header.get_zooms()[:3]
-    voxel_volume_mm3 = np.prod(voxel_dims)
-    
-    # Use a small intensity threshold to avoid counting background noise
-    # (Typical raw MRI noise is low, but not zero)
-    nonzero_mask = (data > (np.max(data) * 0.02)) & (~np.isnan(data))
-    nonzero_count = np.sum(nonzero_mask)
-    
-    # Convert mm^3 to cm^3 (cc)
-    total_nonzero_volume_cc = (nonzero_count * voxel_volume_mm3) / 1000.0
+    def compute(path):
+        img = nib.load(path)
+        if len(img.shape) == 3 and nib.is_proxy(img.dataobj):
+            size = max(stride, slab_size(img) // stride * stride)
+            sample = np.concatenate([
+                data[::stride, ::stride, ::stride] for _, _, (data,) in iter_slabs(img, size=size)
+            ], axis=2)
+        else:
+            sample = np.asanyarray(img.dataobj)[::stride, ::stride, ::stride]
+
+        # Volume represented by a single sampled voxel in mm^3
+        voxel_volume_mm3 = np.prod(img.header.get_zooms()[:3]) * np.prod(img.shape) / sample.size
+
+        # Use a small intensity threshold to avoid counting background noise
+        # (Typical raw MRI noise is low, but not zero). NaNs are never counted.
+        nonzero_count = np.sum(sample > (np.nanmax(sample) * 0.02))
+
+        # Convert mm^3 to cm^3 (cc)
+        return str((nonzero_count * voxel_volume_mm3) / 1000.0)
+
+    total_nonzero_volume_cc = float(memoized(f"brain_volume_{stride}", image_path, compute))
     
     print(f"Non-zero Volume: {total_nonzero_volume_cc:.2f} cc")
     
@@ -55,82 +83,434 @@ def is_skull_stripped(image_path, brain_threshold_cc=1800):
 
 
 
+# Start of every SIF file: a 32 byte launch script followed by the magic
+SIF_MAGIC = b"SIF_MAGIC"
+SIF_MAGIC_OFFSET = 32
+
+
+# A lock file the holder hasn't touched for this long is left over from a crashed job
+LOCK_STALE_SECONDS = 300
+
+@contextmanager
+def file_lock(lock_path, poll_seconds=1.0, stale_seconds=LOCK_STALE_SECONDS):
+    """
+    Exclusive lock shared by all processes on all nodes that see `lock_path`.
+    The lock is held by the process that creates the file (O_EXCL, which is
+    atomic on NFS and parallel file systems, unlike flock) and released by
+    removing it. The holder touches the file while it holds the lock, lock
+    files untouched for `stale_seconds` are removed. Used so that concurrent
+    jobs don't build or copy the same container at the same time.
+    """
+    import socket
+    import threading
+
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - lock_path.stat().st_mtime > stale_seconds:
+                print(f"Removing stale lock {lock_path}")
+                lock_path.unlink(missing_ok=True)
+                continue
+        except FileNotFoundError:
+            # Released in the meantime
+            continue
+        time.sleep(poll_seconds)
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+    released = threading.Event()
+
+    def heartbeat():
+        while not released.wait(stale_seconds / 4):
+            try:
+                os.utime(lock_path)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        released.set()
+        thread.join()
+        lock_path.unlink(missing_ok=True)
+
+def is_valid_sif(sif_path):
+    """Whether `sif_path` looks like a complete SIF image (header magic present)."""
+    try:
+        with open(sif_path, "rb") as f:
+            f.seek(SIF_MAGIC_OFFSET)
+            return f.read(len(SIF_MAGIC)) == SIF_MAGIC
+    except OSError:
+        return False
+
+def _build_container(tool, sif_path):
+    uri = CONTAINER_URIS.get(tool)
+    if not uri:
+        sys.exit(f"Error: No download URI defined for tool '{tool}'.")
+
+    # Other jobs may be building the same image: the first one builds it, the
+    # others wait for the lock and then find the finished image
+    with file_lock(sif_path.with_name(f".{sif_path.name}.lock")):
+        if sif_path.exists():
+            return sif_path
+        print(f"Building from {uri} to {sif_path}...")
+        runtime = get_container_runtime()
+        # Build to a temporary name, so that an interrupted build never
+        # leaves a partial image under the final name
+        tmp_path = sif_path.with_name(f".{sif_path.name}.{os.getpid()}.tmp")
+        try:
+            run_command([*runtime, "build", str(tmp_path), uri],
+                        f"Building SIF container for {tool}")
+            os.replace(tmp_path, sif_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return sif_path
+
+def stage_container(sif_path):
+    """
+    Copies a container to the node-local directory $BRAINSEG_LOCAL_CONTAINER_DIR
+    (e.g. local scratch) once per node and returns the local copy, so that
+    container starts read a local file instead of the shared file system.
+    Returns `sif_path` unchanged if the variable isn't set.
+    """
+    local_dir = os.environ.get("BRAINSEG_LOCAL_CONTAINER_DIR")
+    if not local_dir:
+        return sif_path
+    local_dir = Path(local_dir).resolve()
+    if local_dir == sif_path.parent:
+        return sif_path
+
+    local_path = local_dir / sif_path.name
+
+    def up_to_date():
+        # Same size and modification time as the (possibly rebuilt) source
+        source, local = sif_path.stat(), local_path.stat()
+        return local.st_size == source.st_size and local.st_mtime_ns == source.st_mtime_ns
+
+    if local_path.exists() and up_to_date():
+        return local_path
+    with file_lock(local_dir / f".{sif_path.name}.lock"):
+        if not (local_path.exists() and up_to_date()):
+            print(f"Staging {sif_path.name} to {local_dir}...")
+            tmp_path = local_dir / f".{sif_path.name}.{os.getpid()}.tmp"
+            try:
+                shutil.copy2(sif_path, tmp_path)
+                os.replace(tmp_path, local_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+    return local_path
+
 def find_container(tool):
-    """Finds the container locally, or builds it in ~/.brainseg_containers."""
+    """
+    Finds the container locally, or builds it in $BRAINSEG_CONTAINER_DIR
+    (default ~/.brainseg_containers). With $BRAINSEG_LOCAL_CONTAINER_DIR set,
+    the container is used from a node-local copy, see stage_container.
+    """
     image_name = DEFAULT_IMAGES[tool]
 
     # 1. Check current directory and .containers
     if Path(image_name).exists():
-        return Path(image_name).resolve()
+        return stage_container(Path(image_name).resolve())
     elif (Path(".containers") / image_name).exists():
-        return (Path(".containers") / image_name).resolve()
+        return stage_container((Path(".containers") / image_name).resolve())
 
     # 2. Check BRAINSEG_CONTAINER_DIR environment variable
     env_container_dir = os.environ.get("BRAINSEG_CONTAINER_DIR")
     if env_container_dir and (Path(env_container_dir) / image_name).exists():
-        return (Path(env_container_dir) / image_name).resolve()
+        return stage_container((Path(env_container_dir) / image_name).resolve())
 
     # 3. Check the global ~/.brainseg_containers directory
     global_container_dir = Path.home() / ".brainseg_containers"
+    if os.environ.get("BRAINSEG_RUNTIME") == "standin":
+        # Placeholder images of the stand-in runtime are kept apart, so that
+        # they are never picked up by a real container runtime
+        global_container_dir = cache_dir() / "standin_containers"
+        env_container_dir = None
     sif_path = global_container_dir / image_name
     
     if sif_path.exists():
-        return sif_path.resolve()
+        return stage_container(sif_path.resolve())
         
-    # 3. If missing entirely, attempt to build it from the Docker registry
+    # 4. If missing entirely, attempt to build it from the Docker registry
     print(f"Container '{image_name}' not found locally.")
-    uri = CONTAINER_URIS.get(tool)
-    if not uri:
-        sys.exit(f"Error: No download URI defined for tool '{tool}'.")
-        
     if env_container_dir:
-        global_container_dir = Path(env_container_dir)
-        sif_path = global_container_dir / image_name
-    print(f"Building from {uri} to {sif_path}...")
-    global_container_dir.mkdir(parents=True, exist_ok=True)
-    
-    runtime = get_container_runtime()
-    
-    # Execute the apptainer/singularity build command
-    build_cmd = [runtime, "build", str(sif_path), uri]
-    run_command(build_cmd, f"Building SIF container for {tool}")
-    
+        sif_path = Path(env_container_dir) / image_name
+    sif_path.parent.mkdir(parents=True, exist_ok=True)
+    _build_container(tool, sif_path.resolve())
+
     if sif_path.exists():
-        return sif_path.resolve()
+        return stage_container(sif_path.resolve())
     else:
         sys.exit(f"Error: Failed to build container to {sif_path}.")
 
-def apply_brain_mask(image_path, mask_path, output_path):
-    print(f"Applying brain mask {mask_path.name} to {image_path.name}...")
-    img = nib.load(image_path)
-    mask_img = nib.load(mask_path)
-    
-    # Ensure the mask is boolean
-    mask_data = mask_img.get_fdata() > 0
-    
-    # Multiply the image data by the mask (background becomes 0)
-    masked_data = img.get_fdata() * mask_data
-    
-    # Save the skull-stripped image
-    nib.save(nib.Nifti1Image(masked_data, img.affine, img.header), output_path)
+def find_containers(tools):
+    """Finds or builds the containers of several tools in parallel, see find_container."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(tools)) as executor:
+        return list(executor.map(find_container, tools))
+
+def pull_containers(tools=None, max_workers=None):
+    """
+    Builds the missing containers of `tools` (default: all) in parallel,
+    checks that every image is a complete SIF file and stages them to
+    $BRAINSEG_LOCAL_CONTAINER_DIR if set. Returns the tools that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    tools = list(tools or DEFAULT_IMAGES)
+
+    def pull(tool):
+        try:
+            sif_path = find_container(tool)
+        except SystemExit as e:
+            return f"build failed ({e})"
+        if not is_valid_sif(sif_path):
+            return f"{sif_path} is not a valid SIF image, remove it to rebuild"
+        return sif_path
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tools)) as executor:
+        results = dict(zip(tools, executor.map(pull, tools)))
+
+    print("\nContainers:")
+    for tool, result in results.items():
+        status = "ok " if isinstance(result, Path) else "ERR"
+        print(f"  {status} {tool:<12} {result}")
+    return [tool for tool, result in results.items() if not isinstance(result, Path)]
+
+def mask_bbox(mask_data):
+    """Bounding box of the non-zero voxels of a 3D mask as a tuple of slices (None if empty)."""
+    return _bbox([np.any(mask_data, axis=axes) for axes in [(1, 2), (0, 2), (0, 1)]])
+
+def _bbox(any_along_axes):
+    bbox = []
+    for nonzero in any_along_axes:
+        indices = np.flatnonzero(nonzero)
+        if len(indices) == 0:
+            return None
+        bbox.append(slice(indices[0], indices[-1] + 1))
+    return tuple(bbox)
+
+def _cropped_affine(affine, bbox):
+    affine = affine.copy()
+    if bbox is not None:
+        offset = [s.start for s in bbox]
+        affine[:3, 3] = affine[:3, :3] @ offset + affine[:3, 3]
+    return affine
+
+def apply_brain_mask(image_path, mask_path, output_path=None, crop=False, inplace=False):
+    """
+    Masks an image with a brain mask. Image and mask can be given as paths or as
+    nibabel images, the masked image is returned and saved if output_path is given.
+    The image keeps its stored dtype and scaling. Images loaded from disk are
+    masked in their freshly read data array; in-memory images are copied unless
+    `inplace` is set. With `crop`, the result is cropped to the bounding box of
+    the mask (the affine is adjusted accordingly).
+    Very large volumes are streamed to output_path slab by slab, see brainseg.slabs.
+    """
+    print(f"Applying brain mask {describe_image(mask_path)} to {describe_image(image_path)}...")
+    img = as_image(image_path)
+    mask_img = as_image(mask_path)
+    if img.shape != mask_img.shape:
+        sys.exit(f"Error: Image shape {img.shape} does not match mask shape {mask_img.shape}.")
+
+    slope, inter = scaling(img)
+    # Stored value that represents 0 after scaling
+    background = np.array(-inter / slope).astype(img.get_data_dtype())
+
+    if output_path is not None and use_slabs(img, mask_img):
+        # Out-of-core: stream both images slab by slab, keeping the stored values
+        bbox = None
+        if crop:
+            x_any, y_any, z_any = False, False, []
+            for _, _, (mask_data,) in iter_slabs(mask_img):
+                mask_data = mask_data > 0
+                x_any = x_any | np.any(mask_data, axis=(1, 2))
+                y_any = y_any | np.any(mask_data, axis=(0, 2))
+                z_any.append(np.any(mask_data, axis=(0, 1)))
+            bbox = _bbox([x_any, y_any, np.concatenate(z_any)])
+        x, y, z = bbox or (slice(None),) * 3
+        z_start, z_stop, _ = z.indices(img.shape[2])
+
+        def masked_slabs():
+            for z0, z1, (data, mask_data) in iter_slabs(img, mask_img, scaled=False):
+                if z1 <= z_start or z0 >= z_stop:
+                    continue
+                zs = slice(max(z_start - z0, 0), min(z_stop, z1) - z0)
+                yield np.where(mask_data[x, y, zs] > 0, data[x, y, zs], background)
+
+        shape = tuple(len(range(*s.indices(n))) for s, n in zip((x, y, z), img.shape))
+        save_slabs(masked_slabs(), output_path, shape, img.get_data_dtype(),
+                   _cropped_affine(img.affine, bbox), header=img.header, scaling=(slope, inter))
+        return nib.load(output_path)
+
+    mask_data = np.asanyarray(mask_img.dataobj) > 0
+    if nib.is_proxy(img.dataobj):
+        # Freshly read (or copy-on-write memory-mapped) stored values
+        data = img.dataobj.get_unscaled()
+    else:
+        data = np.asanyarray(img.dataobj)
+
+    bbox = mask_bbox(mask_data) if crop else None
+    if bbox is not None:
+        data, mask_data = data[bbox], mask_data[bbox]
+    if not nib.is_proxy(img.dataobj) and not inplace:
+        data = data.copy()
+
+    # Background becomes 0
+    if background == 0:
+        np.multiply(data, mask_data, out=data, casting="unsafe")
+    else:
+        data[~mask_data] = background
+
+    affine = _cropped_affine(img.affine, bbox)
+    if output_path is not None:
+        save_slabs([data], output_path, data.shape, data.dtype, affine,
+                   header=img.header, scaling=(slope, inter))
+        if nib.is_proxy(img.dataobj):
+            return nib.load(output_path)
+    if (slope, inter) != (1.0, 0.0):
+        data = data * np.float32(slope) + np.float32(inter)
+    masked_img = nib.Nifti1Image(data, affine, img.header)
+    masked_img.set_data_dtype(data.dtype)
+    return masked_img
 
 
 def get_container_runtime():
-    """Returns the command for the available runtime or raises an error."""
+    """
+    Returns the command of the container runtime (a list) or raises an error:
+    $BRAINSEG_RUNTIME if set (apptainer, singularity, `standin` for the local
+    stand-in of brainseg.standin, or any executable taking apptainer's command
+    line), otherwise the available one of apptainer and singularity.
+    """
+    runtime = os.environ.get("BRAINSEG_RUNTIME")
+    if runtime:
+        if runtime == "standin":
+            if shutil.which("brainseg_standin"):
+                return ["brainseg_standin"]
+            # Not installed as a script, e.g. when running from a source tree
+            return [sys.executable, "-m", "brainseg.standin"]
+        if not shutil.which(runtime):
+            raise RuntimeError(f"Container runtime '{runtime}' ($BRAINSEG_RUNTIME) not found.")
+        return [runtime]
     for tool in ["apptainer", "singularity"]:
         if shutil.which(tool):
-            return tool
+            return [tool]
     raise RuntimeError(
         "No container runtime found! Please install Apptainer / Singularity"
         "If using Conda, try: 'conda install -c conda-forge apptainer'"
     )
 
+def thread_env_args(threads):
+    """
+    Container arguments that limit the threads used by the numerical
+    libraries (OpenMP, MKL, ITK, TensorFlow) inside the container.
+    """
+    if threads is None:
+        return []
+    env_vars = [
+        "OMP_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+        "TF_NUM_INTRAOP_THREADS",
+    ]
+    env_args = []
+    for var in env_vars:
+        env_args += ["--env", f"{var}={threads}"]
+    return env_args
+
+def input_bind(input_path, container_dir="/data_in"):
+    """
+    Read-only bind of a single input file to <container_dir>/<file name>.
+    Returns the bind and the path of the file in the container. Only the file
+    itself becomes visible in the container, nothing is copied.
+    """
+    container_path = f"{container_dir}/{Path(input_path).name}"
+    return (Path(input_path), container_path, "ro"), container_path
+
+@contextmanager
+def staging_dir(output_path, prefix=".brainseg_job_"):
+    """
+    Per-job directory next to `output_path`, which is removed on exit. Tools
+    write into it, and their results are renamed to or read from there by
+    brainseg, which is on the same file system as the final output and so
+    avoids a copy. Inputs that a tool expects under a certain name are
+    staged as symlinks (see stage_input).
+    """
+    with tempfile.TemporaryDirectory(dir=Path(output_path).parent, prefix=prefix) as tmpdir:
+        yield Path(tmpdir)
+
+def stage_input(input_path, staged_path):
+    """
+    Makes `input_path` available as `staged_path` (in a staging directory)
+    through a symlink and returns the bind that resolves the link inside the
+    container: the input file at its own host path.
+    """
+    input_path = Path(input_path).resolve()
+    Path(staged_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(staged_path).symlink_to(input_path)
+    return (input_path, str(input_path), "ro")
+
+def container_command(sif_path, binds, args, action="exec", threads=None):
+    """
+    Builds the command running `args` in the container `sif_path`.
+    `binds` is a list of (host path, container path) tuples, optionally with
+    mount options as third entry (e.g. "ro"). If warm instances are enabled
+    (see brainseg.instances), the command is sent to a running instance.
+    """
+    from brainseg.instances import instance_command
+
+    runtime = get_container_runtime()
+    cmd = instance_command(runtime, sif_path, binds, args, action=action,
+                           env_args=thread_env_args(threads))
+    if cmd is not None:
+        return cmd
+
+    bind_args = []
+    for bind in binds:
+        bind_args += ["--bind", ":".join(str(b) for b in bind)]
+    return [
+        *runtime, action,
+        "--cleanenv",
+        *bind_args,
+        *thread_env_args(threads),
+        str(sif_path),
+        *args,
+    ]
+
 def run_command(cmd, description):
-    """Helper to run a subprocess command with error handling."""
+    """
+    Helper to run a subprocess command with error handling. The wall time and
+    resource usage of the command are added to the run report, see brainseg.report.
+    """
+    from brainseg.report import record_container
+
     print(f"--- {description} ---")
     #print(f"running command: {str(cmd)}")
+    start = time.perf_counter()
     try:
-        subprocess.run(cmd, check=True)
+        proc = subprocess.Popen(cmd)
+        try:
+            # Unlike subprocess.run, wait4 also returns the resource usage
+            # (CPU time, peak RSS, block I/O) of the command's process tree
+            _, status, rusage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        record_container(description, time.perf_counter() - start, rusage)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
         print("Done.\n")
     except subprocess.CalledProcessError as e:
         print(f"Error: {description} failed with exit code {e.returncode}")
@@ -138,4 +518,6 @@ def run_command(cmd, description):
     except FileNotFoundError:
         print(f"Error: Could not find the executable '{cmd[0]}'. Is Apptainer installed?")
         sys.exit(1)
-
+    finally:
+        from brainseg.instances import release_instance
+        release_instance(cmd)
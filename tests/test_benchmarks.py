@@ -0,0 +1,73 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+BENCHMARK_SCRIPT = Path(__file__).parents[1] / "benchmarks" / "run_benchmarks.py"
+# Only the pure helpers are used in-process, the suite itself runs as a script
+_spec = importlib.util.spec_from_file_location("run_benchmarks", BENCHMARK_SCRIPT)
+run_benchmarks = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(run_benchmarks)
+
+# A quick subset of the suite at 1 mm
+SMOKE_KERNELS = ["load_label_map", "remap", "apply_brain_mask", "extract_csf_mask"]
+
+
+def run_suite(tmp_path, *args):
+    """Runs the benchmark script on the smoke kernels, returns the process and its results."""
+    output = tmp_path / "results.json"
+    result = subprocess.run(
+        [sys.executable, str(BENCHMARK_SCRIPT), "--resolutions", "1", "--repeat", "2",
+         "--kernels", *SMOKE_KERNELS, "--data-dir", str(tmp_path / "phantoms"),
+         "--output", str(output), *args],
+        capture_output=True, text=True)
+    assert output.exists(), result.stdout + result.stderr
+    return result, json.loads(output.read_text())["results"]
+
+
+@pytest.mark.benchmark
+def test_benchmarks_measure_every_kernel(tmp_path):
+    # An empty baseline file leaves only the CLI import checks
+    _, results = run_suite(tmp_path, "--baseline", str(tmp_path / "baselines.json"))
+    for kernel in SMOKE_KERNELS:
+        name = kernel if kernel == "load_label_map" else f"1.0mm/{kernel}"
+        assert results[name]["seconds"] > 0, name
+        assert results[name]["peak_mb"] >= 0, name
+    assert results["cli_import"]["heavy_modules"] == []
+
+
+@pytest.mark.benchmark
+def test_no_regressions_against_baselines(tmp_path):
+    baselines, _ = run_benchmarks.load_baselines(run_benchmarks.BASELINE_PATH)
+    if not baselines:
+        pytest.skip(f"no baselines recorded with {os.cpu_count()} CPUs")
+    result, _ = run_suite(tmp_path)
+    assert result.returncode == 0, result.stdout
+
+
+def test_compare_reports_regressions():
+    baselines = {"1.0mm/remap": {"seconds": 1.0, "peak_mb": 100.0}}
+    results = {
+        "cli_import": {"seconds": 0.01, "heavy_modules": []},
+        "1.0mm/remap": {"seconds": 1.4, "peak_mb": 110.0},
+        "1.0mm/new_kernel": {"seconds": 10.0, "peak_mb": 1000.0},
+    }
+    assert run_benchmarks.compare(results, baselines) == []
+
+    results["1.0mm/remap"] = {"seconds": 2.0, "peak_mb": 200.0}
+    results["cli_import"] = {"seconds": 1.0, "heavy_modules": ["numpy"]}
+    assert len(run_benchmarks.compare(results, baselines)) == 4
+
+
+def test_baselines_are_per_cpu_count(tmp_path):
+    path = tmp_path / "baselines.json"
+    run_benchmarks.update_baselines(path, {"remap": {"seconds": 0.5, "peak_mb": 10.0},
+                                           "skipped": {"skipped": "missing dependency"}})
+    baselines, recorded_on = run_benchmarks.load_baselines(path)
+    assert baselines == {"remap": {"seconds": 0.5, "peak_mb": 10.0}}
+    assert recorded_on == run_benchmarks.machine()
+    assert run_benchmarks.load_baselines(path, cpus=os.cpu_count() + 1) == ({}, None)
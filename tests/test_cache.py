@@ -0,0 +1,60 @@
+import os
+import time
+
+import pytest
+
+from brainseg import cache
+
+
+@pytest.fixture(autouse=True)
+def cache_root(tmp_path, monkeypatch):
+    monkeypatch.setenv("BRAINSEG_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def test_store_and_lookup_all_outputs(tmp_path):
+    outputs = [tmp_path / "out.nii.gz", tmp_path / "out_mask.nii.gz"]
+    for i, path in enumerate(outputs):
+        path.write_bytes(b"x" * (i + 1))
+    cache.store("key", outputs, description="tool")
+    assert cache.list_entries()[0]["size"] == 3
+
+    restored = [tmp_path / "restored" / p.name for p in outputs]
+    restored[0].parent.mkdir()
+    assert cache.lookup("key", restored)
+    assert [p.read_bytes() for p in restored] == [b"x", b"xx"]
+    # A run with another number of outputs doesn't match the entry
+    assert not cache.lookup("key", restored[:1])
+    assert not cache.lookup("other", restored)
+
+
+def test_memoized_digests_are_pruned(tmp_path, cache_root):
+    calls = []
+    source = tmp_path / "input.txt"
+    source.write_text("data")
+
+    def compute(path):
+        calls.append(path)
+        return "digest"
+
+    assert cache.memoized("file", source, compute) == "digest"
+    assert cache.memoized("file", source, compute) == "digest"
+    assert len(calls) == 1
+
+    (memo_path,) = (cache_root / "digests" / "file").iterdir()
+    assert cache.prune_digests() == 0
+    expired = time.time() - (cache.DIGEST_MAX_AGE_DAYS + 1) * 24 * 3600
+    os.utime(memo_path, (expired, expired))
+    assert cache.prune(cache.max_cache_size()) == 0
+    assert not memo_path.exists()
+
+
+def test_info_and_clear_include_digests(tmp_path, cache_root, capsys):
+    source = tmp_path / "input.txt"
+    source.write_text("data")
+    cache.file_digest(source)
+
+    cache.manage_cache("info")
+    assert "Memoized digests: 1" in capsys.readouterr().out
+    cache.manage_cache("clear")
+    assert not (cache_root / "digests").exists()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+from brainseg.clients.coregister import _set_threads, registration_params
+
+THREADS_VAR = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+
+def test_threads_are_set_before_ants_is_loaded(monkeypatch):
+    monkeypatch.delitem(sys.modules, "ants", raising=False)
+    monkeypatch.delenv(THREADS_VAR, raising=False)
+    _set_threads(None)
+    assert THREADS_VAR not in os.environ
+    _set_threads(3)
+    assert os.environ[THREADS_VAR] == "3"
+
+
+def test_threads_are_per_process(monkeypatch, capsys):
+    # Once ants is loaded, ITK keeps the thread count it started with
+    monkeypatch.setitem(sys.modules, "ants", object())
+    monkeypatch.setenv(THREADS_VAR, "2")
+    _set_threads(4)
+    assert os.environ[THREADS_VAR] == "2"
+    assert "keeps 2 threads" in capsys.readouterr().out
+
+
+def test_registration_params():
+    assert registration_params() == {}
+    params = registration_params("fast", resample_mm=2.0, sampling_rate=None)
+    assert params["resample_mm"] == 2.0
+    assert params["sampling_rate"] == 0.1
@@ -0,0 +1,42 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from brainseg import phantoms
+from brainseg.clients.T2_based_csf_mask import _csf_mask_fast, _csf_mask_reference, li_threshold
+
+skimage_filters = pytest.importorskip("skimage.filters")
+
+
+def t2_phantom(dtype, voxel_size=2.0):
+    """Skull-stripped T2 of a phantom as an in-memory image of `dtype`."""
+    shape, affine = phantoms.phantom_grid(voxel_size)
+    tissue, _ = phantoms.tissue_map(shape, (voxel_size,) * 3)
+    rng = np.random.default_rng(0)
+    data = phantoms.T2_INTENSITY[tissue] + rng.normal(0, phantoms.NOISE, shape)
+    data[tissue < phantoms.CSF] = 0
+    if np.issubdtype(dtype, np.integer):
+        data = np.rint(data)
+    return nib.Nifti1Image(np.clip(data, 0, None).astype(dtype), affine)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+def test_li_threshold_matches_skimage(dtype):
+    data = np.asanyarray(t2_phantom(dtype).dataobj)
+    brain_voxels = data[data > 0]
+    expected = skimage_filters.threshold_li(brain_voxels.astype(np.float64))
+    assert li_threshold(brain_voxels) == pytest.approx(expected, rel=1e-12)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+def test_fast_csf_mask_matches_reference(dtype):
+    img = t2_phantom(dtype)
+    fast = _csf_mask_fast(img)
+    reference = _csf_mask_reference(img)
+    assert fast.dtype == reference.dtype == np.uint8
+    assert np.array_equal(fast, reference)
+    assert fast.sum() > 0
+
+
+def test_li_threshold_of_constant_values():
+    assert li_threshold(np.full(10, 7, dtype=np.int16)) == 7
@@ -0,0 +1,35 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from brainseg.utils import file_lock
+
+
+def hold_lock(lock_path, log_path):
+    with file_lock(lock_path, poll_seconds=0.01):
+        with open(log_path, "a") as f:
+            f.write(f"start {os.getpid()}\n")
+        time.sleep(0.1)
+        with open(log_path, "a") as f:
+            f.write(f"end {os.getpid()}\n")
+
+
+def test_lock_is_exclusive(tmp_path):
+    lock_path, log_path = tmp_path / ".image.lock", tmp_path / "log"
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        for future in [executor.submit(hold_lock, lock_path, log_path) for _ in range(3)]:
+            future.result()
+    events = log_path.read_text().split("\n")[:-1]
+    # Every holder finishes before the next one starts
+    assert [e.split()[0] for e in events] == ["start", "end"] * 3
+    assert not lock_path.exists()
+
+
+def test_stale_lock_is_removed(tmp_path):
+    lock_path = tmp_path / ".image.lock"
+    lock_path.write_text("crashed-node 1234\n")
+    old = time.time() - 60
+    os.utime(lock_path, (old, old))
+    with file_lock(lock_path, poll_seconds=0.01, stale_seconds=30):
+        assert "crashed-node" not in lock_path.read_text()
+    assert not lock_path.exists()
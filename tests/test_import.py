@@ -0,0 +1,63 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Import time budget of the CLI entry point, see brainseg.clients.runner
+CLI_IMPORT_BUDGET_SECONDS = 0.2
+HEAVY_MODULES = ["numpy", "nibabel", "fastremap", "ants", "skimage", "nbmorph"]
+TOOL_MODULES = [
+    "brainseg.tools.batch",
+    "brainseg.tools.fastsurfer",
+    "brainseg.tools.gouhfi",
+    "brainseg.tools.simnibs",
+    "brainseg.tools.synthseg",
+    "brainseg.tools.synthstrip",
+    "brainseg.utils",
+    "brainseg.pipeline",
+]
+
+
+def import_cli():
+    """Imports the CLI in a fresh interpreter, returns the import time and the loaded modules."""
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import brainseg.clients.runner\n"
+        "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True)
+    return json.loads(result.stdout)
+
+
+def test_cli_import_is_lazy():
+    _, modules = import_cli()
+    loaded = [m for m in HEAVY_MODULES + TOOL_MODULES if m in modules]
+    assert loaded == []
+
+
+def test_cli_import_time():
+    # Best of a few runs, to be robust against a busy machine
+    seconds = min(import_cli()[0] for _ in range(3))
+    assert seconds < CLI_IMPORT_BUDGET_SECONDS
+
+
+@pytest.mark.parametrize("package, table", [
+    ("brainseg.tools", "_RUNNERS"),
+    ("brainseg.clients", "_FUNCTIONS"),
+])
+def test_lazy_names_resolve_to_functions(package, table):
+    module = __import__(package, fromlist=[table])
+    for name in getattr(module, table):
+        assert callable(getattr(module, name)), name
+        # Also through a from-import, which binds the submodule of the same name
+        assert callable(getattr(__import__(package, fromlist=[name]), name)), name
+
+
+def test_tool_commands_resolve_to_functions():
+    from brainseg.clients.runner import TOOL_COMMANDS, load_command
+
+    for tool in TOOL_COMMANDS:
+        assert callable(load_command(tool)), tool
@@ -0,0 +1,27 @@
+import pytest
+
+from brainseg.instances import _rewrite_paths
+
+REPLACEMENTS = {"/data": "/host/data", "/data_in": "/host/in", "/data_in/raw": "/host/raw"}
+
+
+@pytest.mark.parametrize("arg, expected", [
+    ("/data", "/host/data"),
+    ("/data/out.nii.gz", "/host/data/out.nii.gz"),
+    ("/data_in/raw/sub-01.nii.gz", "/host/raw/sub-01.nii.gz"),
+    ("--i=/data_in/inputs.txt", "--i=/host/in/inputs.txt"),
+    ("mkdir -p /data/out && cd '/data_in' && run -o /data/out",
+     "mkdir -p /host/data/out && cd '/host/in' && run -o /host/data/out"),
+    # Other paths that share a prefix with a bind are left alone
+    ("/data_job/out", "/data_job/out"),
+    ("/mnt/data/out", "/mnt/data/out"),
+    ("/data.bak", "/data.bak"),
+    ("relative/data", "relative/data"),
+])
+def test_rewrite_paths(arg, expected):
+    assert _rewrite_paths(arg, REPLACEMENTS) == expected
+
+
+def test_rewrite_paths_replaces_once():
+    # A host path below another container path is not rewritten again
+    assert _rewrite_paths("/a /b", {"/a": "/b/a", "/b": "/c"}) == "/b/a /c"
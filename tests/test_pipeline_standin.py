@@ -0,0 +1,158 @@
+"""
+End-to-end runs of the brainseg CLI on the stand-in container runtime (see
+brainseg.standin), on copies of a coarse phantom.
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from brainseg.phantoms import make_phantom
+from brainseg.report import read_report
+
+SUBJECTS = ["sub-00_T1w", "sub-01_T1w", "sub-02_T1w"]
+
+
+@pytest.fixture(scope="module")
+def phantom(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("phantom")
+    paths = make_phantom(directory, voxel_size=2.0)
+    input_dir = directory / "inputs"
+    input_dir.mkdir()
+    for subject in SUBJECTS:
+        shutil.copyfile(paths["t1_head"], input_dir / f"{subject}.nii.gz")
+    return {**paths, "inputs": input_dir}
+
+
+@pytest.fixture
+def env(tmp_path):
+    """Environment of a fresh cache and stand-in state, without the stand-in script on PATH."""
+    environment = dict(os.environ, BRAINSEG_CACHE_DIR=str(tmp_path / "cache"),
+                       BRAINSEG_STANDIN_STATE_DIR=str(tmp_path / "standin_state"),
+                       BRAINSEG_STANDIN_LATENCY="0", BRAINSEG_STANDIN_SUBJECT_LATENCY="0")
+    environment.pop("BRAINSEG_WARM_INSTANCES", None)
+    return environment
+
+
+def brainseg(env, *args):
+    """Runs the brainseg CLI on the stand-in runtime and returns its output."""
+    result = subprocess.run(
+        [sys.executable, "-m", "brainseg.clients.runner", *map(str, args), "--runtime", "standin"],
+        env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+
+def assert_labels(path, reference):
+    img = nib.load(path)
+    assert img.shape == nib.load(reference).shape
+    assert np.count_nonzero(np.asanyarray(img.dataobj)) > 0
+
+
+def test_runtime_falls_back_to_module(monkeypatch, tmp_path):
+    from brainseg.utils import get_container_runtime
+
+    monkeypatch.setenv("PATH", str(tmp_path))
+    monkeypatch.setenv("BRAINSEG_RUNTIME", "standin")
+    assert get_container_runtime() == [sys.executable, "-m", "brainseg.standin"]
+
+
+def test_batch_single_invocation(phantom, env, tmp_path):
+    output_dir, report_dir = tmp_path / "out", tmp_path / "report"
+    brainseg(env, "batch", "-t", "gouhfi", "-i", phantom["inputs"], "-o", output_dir,
+             "--report", report_dir)
+
+    for subject in SUBJECTS:
+        assert_labels(output_dir / f"{subject}_gouhfi.nii.gz", phantom["t1_head"])
+    # Staging directories are removed
+    assert sorted(p.name for p in output_dir.iterdir()) == [f"{s}_gouhfi.nii.gz" for s in SUBJECTS]
+
+    rows = read_report(report_dir / "batch.json")
+    steps = [row["step"] for row in rows]
+    assert steps.count("run_gouhfi_batch") == 1
+    assert steps.count("postprocess_gouhfi") == len(SUBJECTS)
+    batch = next(row for row in rows if row["step"] == "run_gouhfi_batch")
+    assert batch["container_calls"] == 1
+    assert all(row["status"] == "ok" and row["tool"] == "gouhfi" for row in rows)
+    assert (report_dir / "run_report.csv").exists()
+
+
+@pytest.mark.parametrize("warm", [False, True])
+def test_batch_parallel(phantom, env, tmp_path, warm):
+    output_dir, report_dir = tmp_path / "out", tmp_path / "report"
+    args = ["batch", "-t", "synthseg", "-i", phantom["inputs"], "-o", output_dir, "--parallel",
+            "--jobs", "2", "--report", report_dir]
+    output = brainseg(env, *args, *(["--warm"] if warm else []))
+
+    for subject in SUBJECTS:
+        assert_labels(output_dir / f"{subject}_synthseg.nii.gz", phantom["t1_head"])
+        rows = read_report(report_dir / f"{subject}.json")
+        assert {row["subject"] for row in rows} == {subject}
+        assert sum(row["container_calls"] for row in rows if row["step"] == "synthseg") == 1
+    merged = read_report(report_dir / "run_report.csv")
+    assert {row["subject"] for row in merged} == set(SUBJECTS)
+
+    if warm:
+        assert "Starting warm container instance" in output
+        # All instances were stopped when the batch finished
+        assert list((tmp_path / "standin_state").iterdir()) == []
+
+
+def test_result_cache_hit(phantom, env, tmp_path):
+    first, second = tmp_path / "first" / "seg.nii.gz", tmp_path / "second" / "seg.nii.gz"
+    assert "Cache hit" not in brainseg(env, "synthseg", "-i", phantom["t1_head"], "-o", first)
+    output = brainseg(env, "synthseg", "-i", phantom["t1_head"], "-o", second)
+    assert "Cache hit: restored synthseg result" in output
+    assert first.read_bytes() == second.read_bytes()
+
+    output = brainseg(env, "synthseg", "-i", phantom["t1_head"], "-o", second, "--parc")
+    assert "Cache hit" not in output
+
+
+def test_result_cache_restores_side_outputs(phantom, env, tmp_path):
+    # SynthStrip also writes the brain mask next to its output
+    first, second = tmp_path / "first" / "t1.nii.gz", tmp_path / "second" / "t1.nii.gz"
+    brainseg(env, "synthstrip", "-i", phantom["t1_head"], "-o", first)
+    output = brainseg(env, "synthstrip", "-i", phantom["t1_head"], "-o", second)
+    assert "Cache hit: restored synthstrip result" in output
+    assert sorted(p.name for p in second.parent.iterdir()) == ["t1.nii.gz", "t1_mask.nii.gz"]
+    for name in ["t1.nii.gz", "t1_mask.nii.gz"]:
+        assert (second.parent / name).read_bytes() == (first.parent / name).read_bytes()
+
+
+def test_hybrid_resumes_from_workdir(phantom, env, tmp_path):
+    output, workdir, report = tmp_path / "seg.nii.gz", tmp_path / "work", tmp_path / "run.json"
+    args = ["hybrid_gouhfi_T2", "-i", phantom["t1_head"], "--t2", phantom["t2_stripped"],
+            "-o", output, "--workdir", workdir, "--registration", "fast"]
+    assert "Skipping" not in brainseg(env, *args)
+    assert_labels(output, phantom["t1_head"])
+    assert (workdir / "manifest.json").exists()
+    first = output.read_bytes()
+
+    rerun = brainseg(env, *args, "--report", report)
+    for name in ["strip_t1", "coregister", "strip_t2", "csf_mask", "gouhfi", "merge"]:
+        assert f"Skipping {name}: up to date" in rerun
+    assert output.read_bytes() == first
+    # No container runs on the resumed run
+    rows = read_report(report)
+    assert sum(row["container_calls"] for row in rows) == 0
+    assert rows[-1]["step"] == "hybrid_gouhfi_T2"
+
+
+def test_hybrid_report_nests_pipeline_steps(phantom, env, tmp_path):
+    # The pipeline steps run on run_dag worker threads, but belong to the hybrid step
+    output, report = tmp_path / "seg.nii.gz", tmp_path / "run.json"
+    brainseg(env, "hybrid_gouhfi_T2", "-i", phantom["t1_head"], "--t2", phantom["t2_stripped"],
+             "-o", output, "--registration", "fast", "--report", report)
+    rows = read_report(report)
+    parent = rows[-1]
+    assert parent["step"] == "hybrid_gouhfi_T2" and parent["parent"] == ""
+    children = [row for row in rows if row["parent"] == "hybrid_gouhfi_T2"]
+    assert sorted(row["step"] for row in children) == [
+        "coregister", "csf_mask", "gouhfi", "merge", "strip_t1", "strip_t2"]
+    # The container runs of the threads roll up into the hybrid step
+    assert parent["container_calls"] == sum(row["container_calls"] for row in children) == 3
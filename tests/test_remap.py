@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from brainseg import remap
+
+
+@pytest.fixture
+def table_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("BRAINSEG_CACHE_DIR", str(tmp_path))
+    remap.translation_table.cache_clear()
+    yield tmp_path / "labels"
+    remap.translation_table.cache_clear()
+
+
+def test_translation_table_is_cached_on_disk(table_cache):
+    table = remap.translation_table("freesurfer", "gouhfi")
+    assert len(list(table_cache.iterdir())) == 1
+
+    remap.translation_table.cache_clear()
+    assert np.array_equal(remap.translation_table("freesurfer", "gouhfi"), table)
+    assert len(list(table_cache.iterdir())) == 1
+
+
+def test_translation_table_key(table_cache, monkeypatch):
+    remap.translation_table("freesurfer", "gouhfi")
+    # Another chain of schemas, even with the same label files, gets its own table
+    remap.translation_table("gouhfi", "freesurfer")
+    assert len(list(table_cache.iterdir())) == 2
+
+    # Tables of another format version are not reused
+    monkeypatch.setattr(remap, "TABLE_FORMAT", remap.TABLE_FORMAT + 1)
+    remap.translation_table.cache_clear()
+    remap.translation_table("freesurfer", "gouhfi")
+    assert len(list(table_cache.iterdir())) == 3
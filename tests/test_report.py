@@ -0,0 +1,24 @@
+import resource
+
+from brainseg import report
+
+
+def test_steps_are_only_recorded_with_a_report():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    report.stop_report()
+    with report.step("outside"):
+        report.record_container("call", 0.1, usage)
+    report.record_container("call outside of a step", 0.1, usage)
+    assert report.collect_steps() == []
+
+    report.start_report()
+    try:
+        with report.step("subject"):
+            with report.step("tool"):
+                report.record_container("call", 0.1, usage)
+        steps = report.collect_steps()
+    finally:
+        report.stop_report()
+    assert [(s["step"], s["parent"]) for s in steps] == [("tool", "subject"), ("subject", "")]
+    assert [s["container_calls"] for s in steps] == [1, 1]
+    assert report.collect_steps() == []
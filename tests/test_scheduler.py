@@ -0,0 +1,34 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np  # noqa: F401 (loads the BLAS pool before the workers fork)
+import pytest
+
+from brainseg.scheduler import THREAD_ENV_VARS, _init_worker, plan_concurrency, thread_limits
+
+
+def test_plan_concurrency():
+    assert plan_concurrency("gouhfi", cores=16, mem_gb=64) == (4, 4)
+    # Memory bound
+    assert plan_concurrency("gouhfi", cores=16, mem_gb=24) == (2, 4)
+    assert plan_concurrency("gouhfi", cores=16, mem_gb=64, max_jobs=1) == (1, 4)
+    assert plan_concurrency("synthseg", cores=2, mem_gb=64) == (1, 2)
+
+
+def test_thread_limits_reach_the_workers(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "7")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with thread_limits(2), ProcessPoolExecutor(
+        max_workers=1, initializer=_init_worker, initargs=(2,)
+    ) as executor:
+        for var in THREAD_ENV_VARS:
+            assert executor.submit(os.getenv, var).result() == "2"
+    assert os.environ["OMP_NUM_THREADS"] == "7"
+    assert "MKL_NUM_THREADS" not in os.environ
+
+
+def test_workers_limit_loaded_thread_pools():
+    threadpoolctl = pytest.importorskip("threadpoolctl")
+    with ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(1,)) as executor:
+        pools = executor.submit(threadpoolctl.threadpool_info).result()
+    assert all(pool["num_threads"] == 1 for pool in pools)